@@ -0,0 +1,222 @@
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+from pymongo import MongoClient
+
+
+class ModelDemand(BaseModel):
+    """Observed load on one model.
+
+    Attributes:
+        queued (int): Jobs approved for the model and not yet finished (waiting or running).
+        service_seconds (Optional[float]): Moving average of the time a replica spends on one job.
+    """
+
+    queued: int = 0
+    service_seconds: Optional[float] = None
+
+    @property
+    def work_seconds(self) -> float:
+        """Replica-seconds needed to drain the queue."""
+
+        return self.queued * (self.service_seconds or 0)
+
+
+def ensure_indexes(client: MongoClient) -> None:
+
+    client["ndif_database"]["responses"].create_index(
+        [("status", 1), ("model_key", 1), ("updated", 1)]
+    )
+
+
+def _moving_average(field: str, value: float, alpha: float) -> Dict:
+
+    return {
+        "$ifNull": [
+            {"$add": [{"$multiply": [1 - alpha, f"${field}"]}, alpha * value]},
+            value,
+        ]
+    }
+
+
+def record_service_time(
+    client: MongoClient,
+    model_key: str,
+    seconds: float,
+    flops_per_second: Optional[float] = None,
+    alpha: float = 0.2,
+) -> None:
+    """Folds the service time of one job into the model's exponential moving average, and
+    the throughput it executed its estimated FLOPs at (see cost.py), if known."""
+
+    averages = {"service_seconds": _moving_average("service_seconds", seconds, alpha)}
+
+    if flops_per_second is not None:
+
+        averages["flops_per_second"] = _moving_average(
+            "flops_per_second", flops_per_second, alpha
+        )
+
+    client["ndif_database"]["model_stats"].update_one(
+        {"_id": model_key},
+        [{"$set": {**averages, "updated": "$$NOW"}}],
+        upsert=True,
+    )
+
+
+def record_replicas(client: MongoClient, replicas: Dict[str, int]) -> None:
+    """Records the replicas of each model, for the Request app's queue time estimates."""
+
+    for model_key, count in replicas.items():
+
+        client["ndif_database"]["model_stats"].update_one(
+            {"_id": model_key}, {"$set": {"replicas": count}}, upsert=True
+        )
+
+
+def record_size(client: MongoClient, model_key: str, size_GB: float) -> None:
+    """Records the measured size of a model, so a restarted controller deploys it at that
+    size rather than measuring it again."""
+
+    client["ndif_database"]["model_stats"].update_one(
+        {"_id": model_key}, {"$set": {"size_GB": size_GB}}, upsert=True
+    )
+
+
+def load_sizes(client: MongoClient) -> Dict[str, float]:
+    """Measured size of each model, in GB."""
+
+    return {
+        doc["_id"]: doc["size_GB"]
+        for doc in client["ndif_database"]["model_stats"].find(
+            {"size_GB": {"$ne": None}}, {"size_GB": True}
+        )
+    }
+
+
+def load_demand(client: MongoClient, window_seconds: float) -> Dict[str, ModelDemand]:
+    """Demand per model key.
+
+    Jobs not updated within window_seconds are assumed lost (e.g. their replica died) and
+    not counted as queued.
+    """
+
+    database = client["ndif_database"]
+
+    since = datetime.utcnow() - timedelta(seconds=window_seconds)
+
+    demand: Dict[str, ModelDemand] = {}
+
+    for doc in database["responses"].aggregate(
+        [
+            {"$match": {"status": "APPROVED", "updated": {"$gte": since}}},
+            {"$group": {"_id": "$model_key", "queued": {"$sum": 1}}},
+        ]
+    ):
+        demand[doc["_id"]] = ModelDemand(queued=doc["queued"])
+
+    for doc in database["model_stats"].find():
+        demand.setdefault(doc["_id"], ModelDemand()).service_seconds = doc.get(
+            "service_seconds"
+        )
+
+    return demand
+
+
+def desired_replicas(
+    demand: ModelDemand,
+    target_queue_seconds: float,
+    min_replicas: int,
+    max_replicas: int,
+) -> int:
+    """Replicas needed to drain the model's queue within target_queue_seconds."""
+
+    desired = math.ceil(demand.work_seconds / target_queue_seconds)
+
+    return max(min_replicas, min(max_replicas, desired))
+
+
+def bin_pack(
+    capacities_MB: List[float], replicas: List[Tuple[str, float]]
+) -> Dict[str, int]:
+    """Places replicas first-fit onto nodes, in the given order.
+
+    Args:
+        capacities_MB (List[float]): cuda_memory_MB of each node.
+        replicas (List[Tuple[str, float]]): Model key and cuda_memory_MB of each replica.
+
+    Returns:
+        Dict[str, int]: Number of replicas placed per model key.
+    """
+
+    free_MB = list(capacities_MB)
+
+    placed: Dict[str, int] = {}
+
+    for model_key, memory_MB in replicas:
+
+        for node, node_free_MB in enumerate(free_MB):
+
+            if memory_MB <= node_free_MB:
+
+                free_MB[node] -= memory_MB
+
+                placed[model_key] = placed.get(model_key, 0) + 1
+
+                break
+
+    return placed
+
+
+def plan(
+    capacities_MB: List[float],
+    memory_MB: Dict[str, float],
+    demand: Dict[str, ModelDemand],
+    minimum: Dict[str, int],
+    desired: Dict[str, int],
+) -> Dict[str, int]:
+    """Replicas per model key that fit on the cluster.
+
+    Minimum replicas of every model are placed first, largest first (first-fit decreasing).
+    Remaining capacity goes to extra replicas in order of the queue work each would take on,
+    so models with the most demand get GPUs first. Models of unknown size are not packed.
+    """
+
+    replicas = {model_key: desired[model_key] for model_key in desired}
+
+    packed = [model_key for model_key in desired if memory_MB.get(model_key)]
+
+    required = sorted(
+        (
+            (model_key, memory_MB[model_key])
+            for model_key in packed
+            for _ in range(minimum[model_key])
+        ),
+        key=lambda replica: replica[1],
+        reverse=True,
+    )
+
+    extra = sorted(
+        (
+            (model_key, index)
+            for model_key in packed
+            for index in range(minimum[model_key] + 1, desired[model_key] + 1)
+        ),
+        key=lambda replica: demand.get(replica[0], ModelDemand()).work_seconds
+        / replica[1],
+        reverse=True,
+    )
+
+    placed = bin_pack(
+        capacities_MB,
+        required + [(model_key, memory_MB[model_key]) for model_key, _ in extra],
+    )
+
+    for model_key in packed:
+
+        # Keep the minimum even if it does not fit now, Ray schedules it once space frees up.
+        replicas[model_key] = max(minimum[model_key], placed.get(model_key, 0))
+
+    return replicas
@@ -0,0 +1,885 @@
+import contextvars
+import logging
+import threading
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+import torch
+from pydantic import BaseModel
+from transformers import DynamicCache
+
+from nnsight import util
+from nnsight.contexts.Tracer import Tracer
+from nnsight.intervention import HookHandler, InterventionHandler, InterventionProtocol
+from nnsight.tracing import protocols
+from nnsight.tracing.Graph import Graph
+
+from ..telemetry import metrics
+from .cost import DEFAULT_MAX_NEW_TOKENS
+from .job_control import CURRENT_JOB, JobStopped
+
+# Generation options the batcher decodes with. Jobs passing others run on their own.
+GENERATION_KWARGS = {"max_new_tokens", "do_sample", "temperature", "top_k", "top_p"}
+
+# Protocols a batched job's graph may use. The others need the model to themselves while the
+# job runs (gradients, calls of its modules), or aren't a single trace.
+BATCHABLE_PROTOCOLS = (
+    InterventionProtocol,
+    protocols.LockProtocol,
+    protocols.ValueProtocol,
+    protocols.SwapProtocol,
+    protocols.EarlyStopProtocol,
+)
+
+# Module whose output is the generated tokens, as the model's generator.
+GENERATOR_OUTPUT = "generator.output"
+
+
+class ContinuousBatchingArgs(BaseModel):
+
+    # Most sequences decoded together. Jobs wait to join until their prompts fit.
+    max_batch_size: int = 32
+
+
+class GenerationOptions(BaseModel):
+    """How a job's sequences are decoded. Defaults are those of the model's generation config,
+    as for model.generate."""
+
+    max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_k: Optional[int] = None
+    top_p: float = 1.0
+
+
+class _Pending:
+    """Work handed to the scheduler thread, waited on by the thread of its request."""
+
+    def __init__(self) -> None:
+
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+
+        self._done = threading.Event()
+
+    def resolve(self, result: Any) -> None:
+
+        self.result = result
+        self._done.set()
+
+    def fail(self, exception: BaseException) -> None:
+
+        self.exception = exception
+        self._done.set()
+
+    def wait(self) -> Any:
+
+        self._done.wait()
+
+        if self.exception is not None:
+            raise self.exception
+
+        return self.result
+
+
+class _Exclusive(_Pending):
+    """A job run on its own between two steps of the batch."""
+
+    def __init__(self, fn: Callable[[], Any]) -> None:
+
+        super().__init__()
+
+        self.fn = fn
+
+        # Runs in its request's context, so its job control applies on the scheduler thread.
+        self.context = contextvars.copy_context()
+
+    def run(self) -> None:
+
+        try:
+            self.resolve(self.context.run(self.fn))
+        except BaseException as exception:
+            self.fail(exception)
+
+
+class _Job(_Pending):
+    """Prompts generated from together, resolved to their padded prompts followed by the
+    generated tokens, as model.generate returns them.
+
+    Attributes:
+        input_ids (torch.Tensor): Padded prompts.
+        rows (List[_Row]): Sequence of each prompt.
+        options (GenerationOptions): How its sequences are decoded.
+        handler (Optional[InterventionHandler]): Intervention graph of the job, and how many
+            times each of its interventions was reached, as in model.generate.
+        module_keys (List[str]): Inputs and outputs of modules it intervenes on while its
+            sequences are decoded, as "<module path>.<input/output>".
+        early_stopped (bool): Whether its graph stopped the generation.
+    """
+
+    def __init__(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        options: GenerationOptions,
+        handler: Optional[InterventionHandler] = None,
+    ) -> None:
+
+        super().__init__()
+
+        self.input_ids = input_ids
+        self.options = options
+        self.handler = handler
+
+        self.module_keys = (
+            [
+                key
+                for key in InterventionProtocol.get_interventions(handler.graph)
+                if not key.endswith(GENERATOR_OUTPUT)
+            ]
+            if handler is not None
+            else []
+        )
+
+        self.early_stopped = False
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        self.rows = [
+            _Row(self, prompt[mask.bool()])
+            for prompt, mask in zip(input_ids, attention_mask)
+        ]
+
+        self.remaining = len(self.rows)
+
+        self.control = CURRENT_JOB.get()
+
+    def stopped(self) -> Optional[JobStopped]:
+        """What the job was stopped with (see JobControl), or None."""
+
+        return self.control.exception() if self.control is not None else None
+
+    @property
+    def scoped(self) -> bool:
+        """Whether it intervenes on modules. Its prompts are then prefilled on their own, and
+        its sequences stay in the batch until all of them are done, as in model.generate.
+        """
+
+        return bool(self.module_keys)
+
+    def ended(self) -> bool:
+        """Whether all of its sequences leave the batch."""
+
+        if self.exception is not None or self.early_stopped:
+            return True
+
+        return all(row.done for row in self.rows)
+
+    def intervene(self, activations: Any, module_path: str, key: str) -> Any:
+        """Runs the job's interventions on the input or output of a module, given the job's
+        rows of it. An intervention that fails only fails this job."""
+
+        if self.exception is not None or self.early_stopped:
+            return activations
+
+        try:
+
+            return InterventionProtocol.intervene(
+                activations, module_path, key, self.handler
+            )
+
+        except protocols.EarlyStopProtocol.EarlyStopException:
+
+            self.early_stopped = True
+
+        except Exception as exception:
+
+            self.fail(exception)
+
+        return activations
+
+    def finish(self, pad_token_id: int) -> None:
+
+        # Stopped, and already failed.
+        if self.exception is not None:
+            return
+
+        self.remaining -= 1
+
+        if self.remaining > 0:
+            return
+
+        width = max(len(row.tokens) for row in self.rows)
+
+        output = torch.full(
+            (len(self.rows), self.input_ids.shape[1] + width),
+            pad_token_id,
+            dtype=self.input_ids.dtype,
+        )
+
+        output[:, : self.input_ids.shape[1]] = self.input_ids
+
+        for index, row in enumerate(self.rows):
+            output[index, self.input_ids.shape[1] :][: len(row.tokens)] = torch.tensor(
+                row.tokens
+            )
+
+        self.resolve(output)
+
+
+class _Row:
+    """One sequence of the running batch."""
+
+    def __init__(self, job: _Job, prompt: torch.Tensor) -> None:
+
+        self.job = job
+        self.prompt = prompt
+
+        self.tokens: List[int] = []
+        self.done = False
+
+
+class ContinuousBatcher:
+    """Decodes generate jobs of a model in one batch that jobs join and leave at token
+    boundaries, from a scheduler thread that owns the model.
+
+    A job waiting to join is prefilled on its own, and its KV cache is left-padded into the
+    batch's. Every step then decodes one token of each sequence, and a sequence leaves the
+    batch when it reaches an EOS token or its job's max_new_tokens. A job resolves once all
+    of its sequences have, so a short job no longer waits for a long one to finish.
+
+    Interventions fire on their own job's rows and steps only. During each forward pass of
+    the batch, the modules its jobs intervene on are hooked, and every job's interventions
+    are given its own rows of their inputs and outputs. Calls are counted per job as in
+    model.generate, the prefill being a module's first call and each step the next. Jobs
+    intervening on modules are prefilled without other jobs, so their prompts are padded as
+    model.generate pads them, and their sequences stay in the batch, fed padding, until all
+    of them are done.
+
+    Jobs that can't be decoded this way (forward passes, gradients, calls of modules,
+    sessions) run on their own between two steps, so they wait for at most one step of the
+    batch rather than for every sequence in it.
+
+    Jobs cancelled or out of time are checked at every step, and leave the batch with their
+    exception.
+
+    Attributes:
+        model (torch.nn.Module): Decoder-only transformers model with a DynamicCache.
+        model_key (str): Model key of metrics.
+        max_batch_size (int): Most sequences decoded together.
+        pad_token_id (int): Pads generated tokens of sequences shorter than the longest of
+            their job.
+        eos_token_ids (List[int]): Tokens ending a sequence.
+        defaults (GenerationOptions): Options of jobs that don't set them.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        model_key: str,
+        max_batch_size: int,
+        pad_token_id: Optional[int] = None,
+    ) -> None:
+
+        self.model = model
+        self.model_key = model_key
+        self.max_batch_size = max_batch_size
+
+        config = model.generation_config
+
+        eos_token_ids = config.eos_token_id
+
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+
+        self.eos_token_ids = list(eos_token_ids)
+
+        if pad_token_id is None:
+            pad_token_id = config.pad_token_id
+
+        if pad_token_id is None:
+            pad_token_id = self.eos_token_ids[0] if self.eos_token_ids else 0
+
+        self.pad_token_id = pad_token_id
+
+        # nnsight always passes max_new_tokens, so only the config's sampling options apply.
+        self.defaults = GenerationOptions(
+            **{
+                key: getattr(config, key)
+                for key in GenerationOptions.model_fields
+                if key != "max_new_tokens" and getattr(config, key, None) is not None
+            }
+        )
+
+        self.device = next(model.parameters()).device
+
+        self.condition = threading.Condition()
+        self.pending: Deque[_Job] = deque()
+        self.exclusive: Deque[_Exclusive] = deque()
+
+        # The running batch. Keys and values of each layer are [batch, heads, length, dim],
+        # left-padded to the longest sequence, with mask marking which positions are real.
+        self.rows: List[_Row] = []
+        self.cache: DynamicCache = None
+        self.mask: torch.Tensor = None
+        self.positions: torch.Tensor = None
+        self.next_tokens: torch.Tensor = None
+
+        self.logger = logging.getLogger(__name__)
+
+        self.thread = threading.Thread(
+            target=self.run, name="continuous-batching", daemon=True
+        )
+        self.thread.start()
+
+    def execute(self, tracer: Any) -> Graph:
+        """Executes a deserialized object like its local_backend_execute, blocking until done.
+
+        Returns:
+            Graph: The object's graph, with the values of its nodes.
+        """
+
+        if not self.batchable(tracer):
+            return self.run_exclusive(tracer.local_backend_execute)
+
+        model = tracer.model
+
+        # Prepared and batched as NNsightModel.interleave does, to narrow the activations
+        # of each invoke alike.
+        batch_groups = []
+        batch_start = 0
+        batched_inputs = None
+
+        for inputs in tracer._invoker_inputs:
+
+            inputs, batch_size = model._prepare_inputs(*inputs)
+
+            batch_groups.append((batch_start, batch_size))
+            batch_start += batch_size
+
+            batched_inputs = model._batch_inputs(batched_inputs, *inputs)
+
+        (inputs,), _ = model._prepare_inputs(*batched_inputs)
+
+        options = {
+            key: value for key, value in tracer._kwargs.items() if key != "generate"
+        }
+
+        graph = tracer.graph
+
+        graph.reset()
+        graph.execute()
+
+        job = _Job(
+            inputs["input_ids"].cpu(),
+            (
+                inputs["attention_mask"].cpu()
+                if inputs.get("attention_mask") is not None
+                else None
+            ),
+            self.defaults.model_copy(update=options),
+            InterventionHandler(graph, batch_groups, batch_start),
+        )
+
+        output = self.submit(job).to(self.device)
+
+        if job.early_stopped:
+
+            # As NNsightModel.interleave does when a graph stops the generation.
+            for node in graph.nodes.values():
+                if not node.executed():
+                    node.clean()
+
+        else:
+
+            for key in InterventionProtocol.get_interventions(graph):
+
+                if key.endswith(GENERATOR_OUTPUT):
+                    InterventionProtocol.intervene(
+                        output, key[: -len(".output")], "output", job.handler
+                    )
+
+        graph.alive = False
+
+        return graph
+
+    def batchable(self, tracer: Any) -> bool:
+        """Whether the object is a generate trace the batch can decode: one with generation
+        options it supports, whose graph only intervenes on modules and the generated
+        tokens."""
+
+        if not isinstance(tracer, Tracer) or not tracer._invoker_inputs:
+            return False
+
+        kwargs = dict(tracer._kwargs)
+
+        if not kwargs.pop("generate", False) or not set(kwargs) <= GENERATION_KWARGS:
+            return False
+
+        for node in tracer.graph.nodes.values():
+
+            if not isinstance(node.target, type):
+                continue
+
+            if not issubclass(node.target, protocols.Protocol):
+                continue
+
+            if not issubclass(node.target, BATCHABLE_PROTOCOLS):
+                return False
+
+        return True
+
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+        options: GenerationOptions,
+    ) -> torch.Tensor:
+        """Generates from padded prompts in the running batch, blocking until done.
+
+        Returns:
+            torch.Tensor: The prompts followed by their generated tokens, on the CPU.
+        """
+
+        return self.submit(
+            _Job(
+                input_ids.cpu(),
+                attention_mask.cpu() if attention_mask is not None else None,
+                options,
+            )
+        )
+
+    def submit(self, job: _Job) -> torch.Tensor:
+        """Queues a job to join the batch, blocking until it is done."""
+
+        with self.condition:
+
+            self.pending.append(job)
+            self.condition.notify()
+
+        return job.wait()
+
+    def run_exclusive(self, fn: Callable[[], Any]) -> Any:
+        """Runs fn on the scheduler thread between two steps, blocking until done."""
+
+        work = _Exclusive(fn)
+
+        with self.condition:
+
+            self.exclusive.append(work)
+            self.condition.notify()
+
+        return work.wait()
+
+    def run(self) -> None:
+
+        while True:
+
+            with self.condition:
+
+                while not (self.pending or self.exclusive or self.rows):
+                    self.condition.wait()
+
+                exclusive = list(self.exclusive)
+                self.exclusive.clear()
+
+                self.drop_stopped()
+
+                # Jobs join in order while they fit. One too large for any batch joins an
+                # empty one.
+                joining = []
+                rows = len(self.rows)
+
+                while self.pending and (
+                    rows == 0 or rows + len(self.pending[0].rows) <= self.max_batch_size
+                ):
+
+                    job = self.pending.popleft()
+
+                    rows += len(job.rows)
+
+                    joining.append(job)
+
+            for work in exclusive:
+                work.run()
+
+            try:
+
+                with torch.no_grad():
+
+                    if joining:
+                        self.join(joining)
+
+                    if self.rows:
+                        self.step()
+
+                    if self.rows:
+                        self.stop()
+
+            except Exception as exception:
+
+                self.logger.exception(f"Failed to decode batch: {exception}")
+
+                self.reset(exception)
+
+            metrics.BATCH_SEQUENCES.set(len(self.rows), self.model_key)
+
+    def drop_stopped(self) -> None:
+        """Fails jobs stopped while waiting to join. Called holding the condition."""
+
+        pending = deque()
+
+        for job in self.pending:
+
+            exception = job.stopped()
+
+            if exception is None:
+                pending.append(job)
+            else:
+                job.fail(exception)
+
+        self.pending = pending
+
+    def stop(self) -> None:
+        """Fails the jobs of the batch that were stopped, removing their sequences."""
+
+        for job in {id(row.job): row.job for row in self.rows}.values():
+
+            exception = job.stopped()
+
+            if exception is None:
+                continue
+
+            job.fail(exception)
+
+            for row in job.rows:
+                row.done = True
+
+        self.leave()
+
+    def join(self, jobs: List[_Job]) -> None:
+        """Adds jobs to the running batch. Jobs intervening on modules are prefilled on their
+        own, the others together."""
+
+        unscoped = [job for job in jobs if not job.scoped]
+
+        if unscoped:
+            self.prefill(unscoped)
+
+        for job in jobs:
+            if job.scoped:
+                self.prefill([job])
+
+    def prefill(self, jobs: List[_Job]) -> None:
+        """Prefills the prompts of jobs and adds them to the running batch."""
+
+        rows = [row for job in jobs for row in job.rows]
+
+        length = max(len(row.prompt) for row in rows)
+
+        input_ids = torch.full((len(rows), length), self.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(rows), length), dtype=torch.long)
+
+        for index, row in enumerate(rows):
+
+            input_ids[index, length - len(row.prompt) :] = row.prompt
+            mask[index, length - len(row.prompt) :] = 1
+
+        input_ids = input_ids.to(self.device)
+        mask = mask.to(self.device)
+
+        try:
+
+            with self.intervening(rows):
+                output = self.model(
+                    input_ids=input_ids,
+                    attention_mask=mask,
+                    position_ids=(mask.cumsum(-1) - 1).clamp(min=0),
+                    past_key_values=DynamicCache(),
+                    use_cache=True,
+                )
+
+        except Exception as exception:
+
+            # Only the joining jobs are lost, the batch carries on.
+            for job in jobs:
+                job.fail(exception)
+
+            return
+
+        cache = output.past_key_values
+
+        if self.rows:
+
+            length = max(self.mask.shape[1], mask.shape[1])
+
+            cache = _cache(
+                [
+                    (
+                        torch.cat([_pad(key, length, -2), _pad(new_key, length, -2)]),
+                        torch.cat(
+                            [_pad(value, length, -2), _pad(new_value, length, -2)]
+                        ),
+                    )
+                    for (key, value), (new_key, new_value) in zip(
+                        _cache_layers(self.cache), _cache_layers(cache)
+                    )
+                ]
+            )
+
+            mask = torch.cat([_pad(self.mask, length, -1), _pad(mask, length, -1)])
+            positions = torch.cat([self.positions, mask[-len(rows) :].sum(-1)])
+            next_tokens = torch.cat(
+                [self.next_tokens, self.choose(rows, output.logits[:, -1])]
+            )
+
+        else:
+
+            positions = mask.sum(-1)
+            next_tokens = self.choose(rows, output.logits[:, -1])
+
+        self.rows = self.rows + rows
+        self.cache = cache
+        self.mask = mask
+        self.positions = positions
+        self.next_tokens = next_tokens
+
+        self.leave()
+
+    def step(self) -> None:
+        """Decodes the next token of every sequence in the batch."""
+
+        mask = torch.cat([self.mask, self.mask.new_ones((len(self.rows), 1))], dim=-1)
+
+        with self.intervening(self.rows):
+            output = self.model(
+                input_ids=self.next_tokens[:, None],
+                attention_mask=mask,
+                position_ids=self.positions[:, None],
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+
+        self.cache = output.past_key_values
+        self.mask = mask
+        self.positions = self.positions + 1
+        self.next_tokens = self.choose(self.rows, output.logits[:, -1])
+
+        self.leave()
+
+    def choose(self, rows: List[_Row], logits: torch.Tensor) -> torch.Tensor:
+        """Picks the next token of each row from its logits, marking the rows it ends."""
+
+        tokens = logits.argmax(-1)
+
+        decoded = 0
+
+        for index, row in enumerate(rows):
+
+            # Done, and waiting for the rest of its job. Fed padding, as model.generate does.
+            if row.done:
+                tokens[index] = self.pad_token_id
+                continue
+
+            if row.job.options.do_sample:
+                tokens[index] = _sample(logits[index].float(), row.job.options)
+
+        for row, token in zip(rows, tokens.tolist()):
+
+            if row.done:
+                continue
+
+            row.tokens.append(token)
+
+            row.done = (
+                token in self.eos_token_ids
+                or len(row.tokens) >= row.job.options.max_new_tokens
+            )
+
+            decoded += 1
+
+        metrics.GENERATED_TOKENS.inc(self.model_key, decoded)
+
+        return tokens
+
+    def leave(self) -> None:
+        """Removes finished sequences from the batch, resolving jobs they complete."""
+
+        keep = []
+
+        for index, row in enumerate(self.rows):
+
+            if row.job.ended() or (row.done and not row.job.scoped):
+                row.job.finish(self.pad_token_id)
+            else:
+                keep.append(index)
+
+        if len(keep) == len(self.rows):
+            return
+
+        self.rows = [self.rows[index] for index in keep]
+
+        if not self.rows:
+
+            self.cache = self.mask = self.positions = self.next_tokens = None
+
+            return
+
+        index = torch.tensor(keep, device=self.mask.device)
+
+        mask = self.mask.index_select(0, index)
+
+        # Drop the padding no remaining sequence needs.
+        start = int(mask.any(0).nonzero()[0])
+
+        self.cache = _cache(
+            [
+                (
+                    key.index_select(0, index.to(key.device))[:, :, start:],
+                    value.index_select(0, index.to(value.device))[:, :, start:],
+                )
+                for key, value in _cache_layers(self.cache)
+            ]
+        )
+        self.mask = mask[:, start:]
+        self.positions = self.positions.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+
+    def intervening(self, rows: List[_Row]) -> Any:
+        """Hooks the modules the jobs of rows intervene on, for a forward pass of rows."""
+
+        # A job's rows are next to each other, as jobs join whole and rows leave in order.
+        segments = []
+
+        for index, row in enumerate(rows):
+
+            if segments and segments[-1][0] is row.job:
+
+                job, start, size = segments[-1]
+
+                segments[-1] = (job, start, size + 1)
+
+            else:
+
+                segments.append((row.job, index, 1))
+
+        module_keys = {key for job, _, _ in segments for key in job.module_keys}
+
+        if not module_keys:
+            return nullcontext()
+
+        return HookHandler(
+            self.model,
+            list(module_keys),
+            input_hook=partial(self.intervene, segments, len(rows), "input"),
+            output_hook=partial(self.intervene, segments, len(rows), "output"),
+        )
+
+    def intervene(
+        self,
+        segments: List[Tuple[_Job, int, int]],
+        batch_size: int,
+        key: str,
+        activations: Any,
+        module_path: str,
+    ) -> Any:
+        """Gives each job's interventions on a module its own rows of the module's inputs or
+        outputs, as NNsightModel.interleave narrows them to an invoke's."""
+
+        for job, start, size in segments:
+
+            if f"{module_path}.{key}" not in job.module_keys:
+                continue
+
+            if size == batch_size:
+
+                activations = job.intervene(activations, module_path, key)
+
+                continue
+
+            narrowed = util.apply(
+                activations,
+                lambda acts: (
+                    acts.narrow(0, start, size) if acts.shape[0] == batch_size else acts
+                ),
+                torch.Tensor,
+            )
+
+            value = job.intervene(narrowed, module_path, key)
+
+            # Edits of the narrowed views are already in activations, swaps are not.
+            if value is not narrowed:
+                activations = InterventionProtocol.concat(
+                    activations, value, start, size, batch_size
+                )
+
+        return activations
+
+    def reset(self, exception: BaseException) -> None:
+        """Fails every job in the batch and empties it."""
+
+        for job in {id(row.job): row.job for row in self.rows}.values():
+            job.fail(exception)
+
+        self.rows = []
+        self.cache = self.mask = self.positions = self.next_tokens = None
+
+
+def _cache_layers(cache: Any) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Keys and values of each layer of a cache, across transformers versions."""
+
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+
+    return [(key, value) for key, value in cache]
+
+
+def _cache(layers: List[Tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+
+    cache = DynamicCache()
+
+    for layer_idx, (key, value) in enumerate(layers):
+        cache.update(key, value, layer_idx)
+
+    return cache
+
+
+def _pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    """Left-pads dim of tensor with zeros to length."""
+
+    padding = [0, 0] * (-dim - 1) + [length - tensor.shape[dim], 0]
+
+    return torch.nn.functional.pad(tensor, padding)
+
+
+def _sample(logits: torch.Tensor, options: GenerationOptions) -> torch.Tensor:
+    """Samples a token with temperature, top-k and top-p filtering, as model.generate does."""
+
+    logits = logits / options.temperature
+
+    if options.top_k:
+
+        kth = torch.topk(logits, min(options.top_k, logits.shape[-1])).values[-1]
+
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+
+    if options.top_p < 1.0:
+
+        sorted_logits, indices = torch.sort(logits, descending=True)
+
+        probs = sorted_logits.softmax(-1)
+
+        # Keep the most likely tokens until their probability reaches top_p.
+        remove = probs.cumsum(-1) - probs > options.top_p
+
+        logits = logits.masked_fill(remove.scatter(0, indices, remove), float("-inf"))
+
+    return torch.multinomial(logits.softmax(-1), 1)[0]
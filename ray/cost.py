@@ -0,0 +1,376 @@
+import math
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from pydantic import BaseModel
+
+# Characters per token assumed for prompts given as text.
+CHARS_PER_TOKEN = 4
+
+# Tokens generated when max_new_tokens is not given, as by nnsight's generate.
+DEFAULT_MAX_NEW_TOKENS = 1
+
+# Modules whose outputs are as wide as the vocabulary.
+LOGITS_MODULES = ("lm_head", "embed_out", "logits")
+
+INTERVENTION = "nnsight.intervention.InterventionProtocol"
+LOCK = "nnsight.tracing.protocols.LockProtocol"
+
+
+class CostExceeded(ValueError):
+    """Raised for requests estimated to exceed what a replica can run."""
+
+
+class ModelProfile(BaseModel):
+    """Shape of a model, as needed to estimate the cost of requests against it.
+
+    Attributes:
+        parameters (int): Number of parameters.
+        hidden_size (int): Width of the residual stream.
+        layers (int): Number of transformer layers.
+        heads (int): Number of attention heads.
+        kv_size (int): Width of keys and values, smaller than hidden_size with grouped-query attention.
+        vocab_size (int): Width of the logits.
+        dtype_bytes (int): Bytes per parameter and activation element.
+        device_bytes (Optional[int]): Device memory of a replica left for activations. None when unknown.
+    """
+
+    parameters: int
+    hidden_size: int
+    layers: int
+    heads: int
+    kv_size: int
+    vocab_size: int
+    dtype_bytes: int
+    device_bytes: Optional[int] = None
+
+    @classmethod
+    def from_model(
+        cls, model: torch.nn.Module, device_bytes: Optional[int] = None
+    ) -> Optional["ModelProfile"]:
+        """Profile of a loaded transformers model, or None if its config lacks the fields needed."""
+
+        config = getattr(model, "config", None)
+
+        if config is None:
+            return None
+
+        config = config.to_dict()
+        # Multimodal models nest the language model's config.
+        config = {**config, **config.get("text_config", {})}
+
+        hidden_size = _first(config, "hidden_size", "n_embd", "d_model")
+        layers = _first(config, "num_hidden_layers", "n_layer", "num_layers")
+        heads = _first(config, "num_attention_heads", "n_head")
+        vocab_size = config.get("vocab_size")
+
+        if None in (hidden_size, layers, heads, vocab_size):
+            return None
+
+        kv_heads = _first(config, "num_key_value_heads") or heads
+
+        parameters = 0
+        dtype_bytes = None
+
+        for parameter in model.parameters():
+
+            parameters += parameter.numel()
+
+            if dtype_bytes is None:
+                dtype_bytes = parameter.element_size()
+
+        return cls(
+            parameters=parameters,
+            hidden_size=hidden_size,
+            layers=layers,
+            heads=heads,
+            kv_size=hidden_size * kv_heads // heads,
+            vocab_size=vocab_size,
+            dtype_bytes=dtype_bytes or 4,
+            device_bytes=device_bytes,
+        )
+
+
+class CostEstimate(BaseModel):
+    """Predicted cost of a request.
+
+    Attributes:
+        batch_size (int): Prompts across all invokes.
+        prompt_tokens (int): Tokens of the longest prompt, which the batch is padded to.
+        new_tokens (int): Tokens generated per prompt.
+        saves (int): Values saved.
+        flops (float): Floating point operations of the forward passes.
+        activation_bytes (int): Peak device memory beyond the weights.
+        result_bytes (int): Size of the saved values.
+    """
+
+    batch_size: int = 0
+    prompt_tokens: int = 0
+    new_tokens: int = 0
+    saves: int = 0
+    flops: float = 0
+    activation_bytes: int = 0
+    result_bytes: int = 0
+
+    def seconds(self, flops_per_second: Optional[float]) -> Optional[float]:
+        """Predicted execution time at a model's measured throughput."""
+
+        if not flops_per_second:
+            return None
+
+        return self.flops / flops_per_second
+
+
+def _first(config: Dict[str, Any], *keys: str) -> Any:
+
+    for key in keys:
+
+        if config.get(key) is not None:
+            return config[key]
+
+    return None
+
+
+def _get(value: Any, name: str, default: Any = None) -> Any:
+    # Objects are pydantic models when submitted as JSON, dicts when unstaged.
+
+    if isinstance(value, dict):
+        return value.get(name, default)
+
+    return getattr(value, name, default)
+
+
+def _find_tracers(value: Any) -> Iterator[Any]:
+    """Tracers within an object. A session holds its tracers in the args of its graph's nodes."""
+
+    type_name = _get(value, "type_name")
+
+    if type_name == "TRACER":
+
+        yield value
+
+    elif type_name in ("SESSION", "ITERATOR"):
+
+        for node in _get(_get(value, "graph"), "nodes", {}).values():
+            for arg in _get(node, "args", []):
+                yield from _find_tracers(arg)
+
+    elif type_name in ("LIST", "TUPLE"):
+
+        for item in _get(value, "values", []):
+            yield from _find_tracers(item)
+
+
+def _shape(value: Any) -> Tuple[int, int]:
+    """Prompts and tokens of the longest prompt of one invoker input."""
+
+    type_name = _get(value, "type_name")
+
+    if type_name == "TUPLE":
+
+        values = _get(value, "values")
+
+        return _shape(values[0]) if values else (0, 0)
+
+    if type_name == "DICT":
+
+        return _shape(_get(value, "values", {}).get("input_ids"))
+
+    if type_name == "PRIMITIVE":
+
+        primitive = _get(value, "value")
+
+        if isinstance(primitive, str):
+            return 1, math.ceil(len(primitive) / CHARS_PER_TOKEN)
+
+        return 1, 1
+
+    if type_name == "TENSOR":
+
+        values = _get(value, "values")
+
+        if isinstance(values, torch.Tensor):
+
+            shape = list(values.shape)
+
+        else:
+
+            shape = []
+
+            while isinstance(values, list):
+
+                shape.append(len(values))
+
+                values = values[0] if values else None
+
+        if not shape:
+            return 1, 1
+
+        return (1, shape[0]) if len(shape) == 1 else (shape[0], shape[-1])
+
+    if type_name == "LIST":
+
+        items = [_shape(item) for item in _get(value, "values", [])]
+
+        # A list of token ids is one prompt.
+        if items and all(
+            _get(item, "type_name") == "PRIMITIVE"
+            and not isinstance(_get(item, "value"), str)
+            for item in _get(value, "values")
+        ):
+            return 1, len(items)
+
+        return sum(prompts for prompts, _ in items), max(
+            (tokens for _, tokens in items), default=0
+        )
+
+    return 0, 0
+
+
+def _saved_modules(graph: Any) -> List[Optional[str]]:
+    """Module path each saved value comes from, or None when it doesn't trace back to one."""
+
+    nodes = _get(graph, "nodes", {})
+
+    paths = []
+
+    for node in nodes.values():
+
+        if _get(_get(node, "target"), "function_name") != LOCK:
+            continue
+
+        path = None
+
+        seen = set()
+
+        while node is not None and id(node) not in seen:
+
+            seen.add(id(node))
+
+            args = _get(node, "args", [])
+
+            if _get(_get(node, "target"), "function_name") == INTERVENTION:
+
+                path = _get(args[0], "value") if args else None
+
+                break
+
+            references = [
+                _get(arg, "name")
+                for arg in args
+                if _get(arg, "type_name") == "NODE_REFERENCE"
+            ]
+
+            node = nodes.get(references[0]) if references else None
+
+        paths.append(path)
+
+    return paths
+
+
+def estimate(object: Any, profile: ModelProfile) -> CostEstimate:
+    """Estimates the cost of running a request's object (a tracer or session) on a model.
+
+    Each forward pass costs two FLOPs per parameter per token, plus attention over the
+    sequence. Peak memory is the KV cache, the logits (upcast to float32), the attention
+    scores of the prompt and the saved values, which stay on the device until the end.
+    Tracers of a session run one after another, so their FLOPs and results add up and
+    their memory does not.
+    """
+
+    total = CostEstimate()
+
+    for tracer in _find_tracers(object):
+
+        kwargs = _get(tracer, "kwargs", {})
+
+        generate = _get(kwargs.get("generate"), "value", False)
+
+        batch_size = prompt_tokens = 0
+
+        for invoker_input in _get(tracer, "invoker_inputs", []):
+
+            prompts, tokens = _shape(invoker_input)
+
+            batch_size += prompts
+            prompt_tokens = max(prompt_tokens, tokens)
+
+        new_tokens = (
+            _get(kwargs.get("max_new_tokens"), "value", DEFAULT_MAX_NEW_TOKENS)
+            if generate
+            else 0
+        )
+
+        sequence = prompt_tokens + new_tokens
+
+        flops = 2 * profile.parameters * batch_size * sequence
+        flops += 2 * profile.layers * batch_size * sequence**2 * profile.hidden_size
+
+        result_bytes = 0
+
+        saves = _saved_modules(_get(tracer, "graph"))
+
+        for path in saves:
+
+            if path is not None and any(name in path for name in LOGITS_MODULES):
+                width = profile.vocab_size
+            else:
+                width = profile.hidden_size
+
+            result_bytes += batch_size * prompt_tokens * width * profile.dtype_bytes
+
+        activation_bytes = (
+            2 * profile.layers * batch_size * sequence * profile.kv_size
+        ) * profile.dtype_bytes
+        activation_bytes += batch_size * prompt_tokens * profile.vocab_size * 4
+        activation_bytes += (
+            batch_size * profile.heads * prompt_tokens**2 * profile.dtype_bytes
+        )
+        activation_bytes += result_bytes
+
+        total.batch_size = max(total.batch_size, batch_size)
+        total.prompt_tokens = max(total.prompt_tokens, prompt_tokens)
+        total.new_tokens = max(total.new_tokens, new_tokens)
+        total.saves += len(saves)
+        total.flops += flops
+        total.activation_bytes = max(total.activation_bytes, activation_bytes)
+        total.result_bytes += result_bytes
+
+    return total
+
+
+def check(
+    estimate: CostEstimate,
+    profile: ModelProfile,
+    memory_fraction: float = 0.9,
+    max_seconds: Optional[float] = None,
+    flops_per_second: Optional[float] = None,
+) -> None:
+    """Raises CostExceeded if the request would not fit within memory_fraction of the
+    replica's free device memory, or would run longer than max_seconds.
+
+    Raises:
+        CostExceeded: Describing which limit is exceeded and by how much.
+    """
+
+    if (
+        profile.device_bytes is not None
+        and estimate.activation_bytes > profile.device_bytes * memory_fraction
+    ):
+
+        raise CostExceeded(
+            f"Your job is estimated to need {estimate.activation_bytes * 1e-9:.1f}GB of "
+            f"device memory ({estimate.batch_size} prompts of up to "
+            f"{estimate.prompt_tokens + estimate.new_tokens} tokens, {estimate.saves} saves), "
+            f"more than the {profile.device_bytes * memory_fraction * 1e-9:.1f}GB available. "
+            "Try a smaller batch, shorter prompts or fewer saves."
+        )
+
+    seconds = estimate.seconds(flops_per_second)
+
+    if max_seconds is not None and seconds is not None and seconds > max_seconds:
+
+        raise CostExceeded(
+            f"Your job is estimated to run for {seconds:.0f} seconds, longer than the "
+            f"{max_seconds:.0f} seconds allowed. Try a smaller batch or fewer tokens."
+        )
@@ -1,5 +1,8 @@
+import logging
 import os
-from typing import Dict
+import threading
+import time
+from typing import Dict, Optional
 
 from pydantic import BaseModel
 from ray import serve
@@ -18,12 +21,14 @@ class ControllerDeployment:
         ray_dashboard_url: str,
         database_url: str,
         api_url: str,
+        config_watch_interval_seconds: Optional[float],
     ):
         self.ray_config_path = ray_config_path
         self.service_config_path = service_config_path
         self.ray_dashboard_url = ray_dashboard_url
         self.database_url = database_url
         self.api_url = api_url
+        self.config_watch_interval_seconds = config_watch_interval_seconds
 
         self.state = RayState(
             self.ray_config_path,
@@ -32,9 +37,81 @@ class ControllerDeployment:
             self.database_url,
             self.api_url,
         )
-        
+
         self.state.apply()
-        
+
+        self.logger = logging.getLogger(__name__)
+
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def tick_seconds(self) -> float:
+
+        intervals = [
+            self.config_watch_interval_seconds,
+            self.state.service_config.autoscale_interval_seconds,
+        ]
+
+        return min(
+            [interval for interval in intervals if interval is not None], default=60
+        )
+
+    def run(self) -> None:
+        """Reloads the config files when they change and autoscales, applying the result.
+
+        Either is skipped while its interval is None.
+        """
+
+        last_watch = last_autoscale = time.monotonic()
+
+        while not self._stopped.wait(self.tick_seconds()):
+
+            now = time.monotonic()
+
+            changed = False
+
+            watch_interval = self.config_watch_interval_seconds
+            autoscale_interval = self.state.service_config.autoscale_interval_seconds
+
+            try:
+
+                if watch_interval is not None and now - last_watch >= watch_interval:
+
+                    last_watch = now
+
+                    if self.state.config_changed():
+
+                        self.logger.info("Config files changed, reloading.")
+
+                        self.state.load()
+
+                        changed = True
+
+                if (
+                    autoscale_interval is not None
+                    and now - last_autoscale >= autoscale_interval
+                ):
+
+                    last_autoscale = now
+
+                    changed = self.state.autoscale() or changed
+
+                if changed:
+                    self.state.apply()
+
+            except Exception as exception:
+
+                self.logger.exception(f"Controller update failed: {exception}")
+
+    # Ray checks this method and restarts replica if it raises an exception
+    def check_health(self):
+
+        if not self._thread.is_alive():
+            raise RuntimeError("Controller thread died.")
+
+
 class ControllerDeploymentArgs(BaseModel):
 
     ray_config_path: str = os.environ.get('RAY_CONFIG_PATH', None)
@@ -42,6 +119,8 @@ class ControllerDeploymentArgs(BaseModel):
     ray_dashboard_url: str = os.environ.get('RAY_DASHBOARD_URL', None)
     database_url: str = os.environ.get('DATABASE_URL', None)
     api_url: str = os.environ.get('API_URL', None)
+    # Seconds between checks of the config files for changes. None disables watching.
+    config_watch_interval_seconds: Optional[float] = 10
 
 
 def app(args: ControllerDeploymentArgs) -> Application:
@@ -1,11 +1,13 @@
+import asyncio
 import gc
 import inspect
 import logging
 import os
 import socket
 import time
-from datetime import timedelta
-from typing import Dict
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
 
 import ray
 import torch
@@ -13,17 +15,40 @@ import torch.distributed
 from pymongo import MongoClient
 from ray import serve
 from ray.serve import Application
+from ray.util.placement_group import get_current_placement_group
+from ray.util.scheduling_strategies import PlacementGroupSchedulingStrategy
+from ray.util.state import list_actors
 from transformers import PreTrainedModel
 
 from nnsight import LanguageModel, util
-from nnsight.pydantics.Request import RequestModel
+from nnsight.models.mixins import RemoteableMixin
 
+from ...schema.Request import RequestModel
 from ...schema.Response import ResponseModel, ResultModel
+from ...schema.Usage import UsageModel
+from ...telemetry import metrics, tracing
+from .. import cost
+from ..autoscale import record_service_time
+from ..cost import ModelProfile
 from ..distributed.parallel_dims import ParallelDims
 from ..distributed.tensor_parallelism import parallelize_model
 from ..distributed.util import load_hf_model_from_cache
+from ..job_control import (
+    CancellationWatcher,
+    DistributedJobControl,
+    JobStopped,
+    start_job,
+    time_limit,
+)
+from ..result_handoff import ResultHandoffClient
+from ..topology import within_island
+from ..util import get_free_cudamemory_bytes
+from ..warmup import WarmupArgs, warm_up
 from .model import ModelDeploymentArgs
 
+# Longest a health check waits for the workers' states, well within Serve's timeout.
+WORKER_STATE_TIMEOUT_SECONDS = 5
+
 
 @serve.deployment(ray_actor_options={"num_gpus": 1})
 class ModelDeployment:
@@ -32,6 +57,8 @@ class ModelDeployment:
         model_key: str,
         api_url: str,
         database_url: str,
+        result_handoff: Optional[Dict[str, Any]],
+        max_execution_seconds: Optional[float],
         torch_distributed_address: str,
         torch_distributed_port: int,
         torch_distributed_world_size: int,
@@ -40,13 +67,18 @@ class ModelDeployment:
         data_parallelism_size: int,
         tensor_parallelism_size: int,
         pipeline_parallelism_size: int,
+        warmup: Optional[Dict[str, Any]] = None,
+        require_island: bool = True,
     ):
 
-        self.replica_context = serve.get_replica_context()
+        # Each rank runs on the GPU Ray assigned it from its bundle of the replica's
+        # placement group, which Ray makes its only visible device.
+        self.head = torch_distributed_world_rank == 0
 
         self.model_key = model_key
         self.api_url = api_url
         self.database_url = database_url
+        self.max_execution_seconds = max_execution_seconds
         self.torch_distributed_address = torch_distributed_address
         self.torch_distributed_port = torch_distributed_port
         self.torch_distributed_world_size = torch_distributed_world_size
@@ -57,12 +89,18 @@ class ModelDeployment:
         self.data_parallelism_size = data_parallelism_size
         self.tensor_parallelism_size = tensor_parallelism_size
         self.pipeline_parallelism_size = pipeline_parallelism_size
+        self.warmup = warmup
+        self.require_island = require_island
 
         self.model = RemoteableMixin.from_model_key(self.model_key)
 
         self.logger = logging.getLogger(__name__)
 
-        self.head = torch_distributed_world_rank == 0
+        tracing.init(
+            "model",
+            model_key=self.model_key,
+            rank=self.torch_distributed_world_rank,
+        )
 
         if self.head:
 
@@ -70,6 +108,16 @@ class ModelDeployment:
 
             self.db_connection = MongoClient(self.database_url)
 
+            # Only the head watches cancellations, and tells the workers (see
+            # DistributedJobControl).
+            self.cancellations = CancellationWatcher(self.db_connection)
+
+            self.result_handoff = (
+                ResultHandoffClient(self.database_url, **result_handoff)
+                if result_handoff is not None
+                else None
+            )
+
             if self.torch_distributed_address is None:
 
                 ip_address = ray.get_runtime_context().worker.node_ip_address
@@ -81,12 +129,19 @@ class ModelDeployment:
 
             self.worker_deployments = []
 
+            placement_group = get_current_placement_group()
+
+            self.placement_group_id = placement_group.id.hex()
+
+            worker_class = ray.remote(ModelDeployment.func_or_class)
+
             for worker_world_rank in range(1, self.torch_distributed_world_size):
 
                 distributed_model_deployment_args = DistributedModelDeploymentArgs(
                     model_key=self.model_key,
                     api_url=self.api_url,
                     database_url=self.database_url,
+                    result_handoff=None,
                     torch_distributed_address=self.torch_distributed_address,
                     torch_distributed_world_size=self.torch_distributed_world_size,
                     torch_distributed_world_rank=worker_world_rank,
@@ -94,25 +149,26 @@ class ModelDeployment:
                     tensor_parallelism_size=self.tensor_parallelism_size,
                     data_parallelism_size=self.data_parallelism_size,
                     pipeline_parallelism_size=self.pipeline_parallelism_size,
+                    warmup=self.warmup,
                 )
 
-                print(f"=> Binding distributed worker: {worker_world_rank}...")
-
-                worker_application = ModelDeployment.bind(
-                    **distributed_model_deployment_args.model_dump()
-                )
+                print(f"=> Starting distributed worker: {worker_world_rank}...")
 
-                print(f"=> Bound distributed worker: {worker_world_rank}.")
-                print(f"=> Serving distributed worker: {worker_world_rank}...")
-
-                worker_deployment = serve._run(
-                    worker_application,
-                    _blocking=False,
-                    name=f"{self.replica_context.app_name}-{worker_world_rank}",
-                    route_prefix=f"/{self.replica_context.app_name}-{worker_world_rank}",
+                # Workers are actors in the head's placement group, one bundle per rank.
+                worker_deployment = worker_class.options(
+                    num_cpus=1,
+                    num_gpus=1,
+                    scheduling_strategy=PlacementGroupSchedulingStrategy(
+                        placement_group=placement_group,
+                        placement_group_bundle_index=worker_world_rank,
+                    ),
+                ).remote(
+                    **distributed_model_deployment_args.model_dump(
+                        exclude=SINGLE_REPLICA_ARGS
+                    )
                 )
 
-                print(f"=> Served distributed worker: {worker_world_rank}.")
+                print(f"=> Started distributed worker: {worker_world_rank}.")
 
                 self.worker_deployments.append(worker_deployment)
 
@@ -120,6 +176,59 @@ class ModelDeployment:
 
         self.init_distributed()
 
+        self.cost_profile = None
+
+        if self.head:
+
+            # Ids of the workers' actors, to tell which rank died. After init_distributed,
+            # as the workers only answer once theirs is done.
+            self.worker_actor_ids = ray.get(
+                [worker.actor_id.remote() for worker in self.worker_deployments]
+            )
+
+            self.check_devices()
+
+            free_bytes = get_free_cudamemory_bytes()
+
+            # Ranks hold equal shares of the weights and activations.
+            self.cost_profile = ModelProfile.from_model(
+                self.model._model,
+                device_bytes=(
+                    free_bytes * self.torch_distributed_world_size
+                    if free_bytes is not None
+                    else None
+                ),
+            )
+
+    def gpu_id(self) -> int:
+
+        return int(ray.get_gpu_ids()[0])
+
+    def actor_id(self) -> str:
+
+        return ray.get_runtime_context().get_actor_id()
+
+    def check_devices(self) -> None:
+        """Warns if the ranks' GPUs span NVLink islands although require_island is set.
+
+        The placement group only puts the ranks on a node with an island that fits them
+        (see RayState.gang_schedule). Ray, not the head, picks which of its GPUs they get.
+        """
+
+        devices = [
+            self.gpu_id(),
+            *ray.get([worker.gpu_id.remote() for worker in self.worker_deployments]),
+        ]
+
+        print(f"=> Ranks run on GPUs {devices}.")
+
+        if self.require_island and within_island(devices) is False:
+
+            self.logger.warning(
+                f"Ranks of `{self.model_key}` run on GPUs {devices}, which span NVLink "
+                "islands."
+            )
+
     def init_distributed(self):
 
         print(
@@ -177,52 +286,136 @@ class ModelDeployment:
 
         torch.cuda.empty_cache()
 
+        # Every rank runs the same synthetic requests, together as they run real ones. The
+        # head's __init__ returns, and Serve counts the replica as running, after.
+        if self.warmup is not None:
+            warm_up(self.model, self.model_key, WarmupArgs(**self.warmup))
+
     def __call__(self, request: RequestModel):
 
-        if self.head:
+        start = time.perf_counter()
+
+        with tracing.span(
+            "model.call",
+            request=request,
+            model_key=self.model_key,
+            rank=self.torch_distributed_world_rank,
+        ):
 
-            for worker_deployment in self.worker_deployments:
+            if self.head:
 
-                worker_deployment.remote(request)
+                try:
 
-        torch.distributed.barrier()
+                    # Marked RUNNING, or skipped if it was cancelled while queued. The
+                    # workers never see skipped jobs.
+                    if not start_job(
+                        request,
+                        self.cancellations.cancelled(request.id),
+                        self.db_connection,
+                        self.api_url,
+                        self.logger,
+                    ):
+                        return
 
-        try:
+                    # Workers have no database connection, send them the object itself.
+                    # Staged objects, and requests the Request app had no profile for, are
+                    # first estimated here.
+                    if request.staged or request.estimated_flops is None:
 
-            # Deserialize request
-            obj = request.deserialize(self.model)
+                        if request.staged:
+                            request = request.unstage(self.db_connection)
 
-            # Execute object.
-            local_result = obj.local_backend_execute()
+                        self.check_cost(request)
 
-            if self.head:
+                except Exception as exception:
 
-                ResponseModel(
-                    id=request.id,
-                    session_id=request.session_id,
-                    received=request.received,
-                    status=ResponseModel.JobStatus.COMPLETED,
-                    description="Your job has been completed.",
-                    result=ResultModel(
-                        id=request.id,
-                        value=obj.remote_backend_postprocess_result(local_result),
-                    ),
-                ).log(self.logger).save(self.db_connection).blocking_response(
-                    self.api_url
-                )
+                    self.respond_error(request, exception)
 
-        except Exception as exception:
+                    return
+
+                # Workers continue the trace as children of the head's span.
+                tracing.inject(request)
+
+                for worker_deployment in self.worker_deployments:
+
+                    worker_deployment.__call__.remote(request)
+
+            with tracing.span("distributed.barrier"):
+                torch.distributed.barrier()
 
             if self.head:
 
-                ResponseModel(
-                    id=request.id,
-                    session_id=request.session_id,
-                    received=request.received,
-                    status=ResponseModel.JobStatus.ERROR,
-                    description=str(exception),
-                ).log(self.logger).save(self.db_connection).blocking_response(
-                    self.api_url
+                metrics.QUEUE_WAIT.observe(
+                    (datetime.now() - request.received).total_seconds(), self.model_key
+                )
+
+            execute = None
+            local_result = None
+
+            # The head decides when the ranks stop, workers follow it.
+            control = DistributedJobControl(
+                request.id,
+                (
+                    time_limit(
+                        self.max_execution_seconds, request.max_execution_seconds
+                    )
+                    if self.head
+                    else None
+                ),
+                self.device,
+            )
+
+            try:
+
+                # Deserialize request
+                with metrics.DESERIALIZE.time(self.model_key), tracing.span(
+                    "model.deserialize"
+                ):
+                    obj = request.deserialize(self.model)
+
+                # Execute object.
+                with metrics.EXECUTE.time(self.model_key) as execute, tracing.span(
+                    "model.execute", rank=self.torch_distributed_world_rank
+                ), (
+                    self.cancellations.watch(control) if self.head else nullcontext()
+                ), control.running():
+                    local_result = obj.local_backend_execute()
+
+                if self.head:
+
+                    with metrics.POSTPROCESS.time(self.model_key), tracing.span(
+                        "model.postprocess"
+                    ):
+                        value = obj.remote_backend_postprocess_result(local_result)
+
+                    ResponseModel(
+                        id=request.id,
+                        session_id=request.session_id,
+                        received=request.received,
+                        model_key=self.model_key,
+                        key_id=request.key_id,
+                        status=ResponseModel.JobStatus.COMPLETED,
+                        description="Your job has been completed.",
+                        result=ResultModel(
+                            id=request.id,
+                            value=value,
+                        ),
+                    ).log(self.logger).save(
+                        self.db_connection, handoff=self.result_handoff
+                    ).blocking_response(
+                        self.api_url
+                    )
+
+            except Exception as exception:
+
+                if self.head:
+                    self.respond_error(request, exception)
+
+            if self.head and execute is not None:
+
+                # Every rank holds one GPU for the whole execution.
+                self.record_execution(
+                    request, execute.elapsed, time.perf_counter() - start
                 )
 
         del request
@@ -234,6 +427,78 @@ class ModelDeployment:
 
         torch.cuda.empty_cache()
 
+    def respond_error(self, request: RequestModel, exception: Exception) -> None:
+        """Saves the job's ERROR response and notifies the API. Runs on the head."""
+
+        reason = None
+
+        if isinstance(exception, JobStopped):
+
+            reason = exception.reason
+
+            metrics.JOBS_STOPPED.inc(reason)
+
+        ResponseModel(
+            id=request.id,
+            session_id=request.session_id,
+            received=request.received,
+            model_key=self.model_key,
+            status=ResponseModel.JobStatus.ERROR,
+            reason=reason,
+            description=str(exception),
+        ).log(self.logger).save(self.db_connection).blocking_response(self.api_url)
+
+    def record_execution(
+        self, request: RequestModel, execute_seconds: float, service_seconds: float
+    ) -> None:
+        """Records the job's usage against its API key, and its service time and throughput
+        for autoscaling and cost estimates."""
+
+        try:
+            UsageModel.record(
+                self.db_connection,
+                request.key_id,
+                execute_seconds * self.torch_distributed_world_size,
+            )
+            record_service_time(
+                self.db_connection,
+                self.model_key,
+                service_seconds,
+                flops_per_second=(
+                    request.estimated_flops / execute_seconds
+                    if request.estimated_flops and execute_seconds > 0
+                    else None
+                ),
+            )
+        except Exception as exception:
+            self.logger.error(
+                f"Failed to record execution of `{request.id}`: {exception}"
+            )
+
+    def check_cost(self, request: RequestModel) -> None:
+
+        if self.cost_profile is None:
+            return
+
+        # As in the Request app, requests the estimator can't walk run unchecked.
+        try:
+            estimate = cost.estimate(request.object, self.cost_profile)
+        except Exception as exception:
+
+            self.logger.warning(
+                f"Failed to estimate the cost of `{request.id}`: {exception}"
+            )
+
+            return
+
+        cost.check(estimate, self.cost_profile)
+
+        request.estimated_flops = estimate.flops
+
+    async def profile(self, model_key: str) -> Optional[ModelProfile]:
+
+        return self.cost_profile
+
     async def status(self):
 
         model: PreTrainedModel = self.model._model
@@ -249,6 +514,59 @@ class ModelDeployment:
         for device in range(torch.cuda.device_count()):
             torch.cuda.mem_get_info(device)
 
+        if self.head:
+            await asyncio.to_thread(self.check_workers)
+
+    def check_workers(self) -> None:
+        """Raises if a worker died.
+
+        Workers are plain actors, which Serve doesn't health check, and a dead one leaves
+        the head waiting at its next collective. The head restarting takes the workers it
+        owns down with it, so the replica restarts whole. Their state is read from Ray
+        rather than by calling them, as a worker executing a request answers only after.
+        One query covers every worker: the dead actors of the replica's placement group.
+        """
+
+        try:
+
+            dead = list_actors(
+                filters=[
+                    ("placement_group_id", "=", self.placement_group_id),
+                    ("state", "=", "DEAD"),
+                ],
+                detail=True,
+                timeout=WORKER_STATE_TIMEOUT_SECONDS,
+            )
+
+        except Exception as exception:
+
+            # The state API being slow or down says nothing about the workers.
+            self.logger.warning(
+                f"Failed to read distributed worker states: {exception}"
+            )
+
+            return
+
+        for state in dead:
+
+            if state.actor_id in self.worker_actor_ids:
+
+                rank = self.worker_actor_ids.index(state.actor_id) + 1
+
+                raise RuntimeError(
+                    f"Distributed worker {rank} died: {state.death_cause}"
+                )
+
+
+# Args of ModelDeploymentArgs the distributed deployment doesn't take.
+SINGLE_REPLICA_ARGS = {
+    "save_transfer",
+    "result_writer",
+    "continuous_batching",
+    "weight_cache",
+    "quantization",
+}
+
 
 class DistributedModelDeploymentArgs(ModelDeploymentArgs):
 
@@ -263,6 +581,20 @@ class DistributedModelDeploymentArgs(ModelDeploymentArgs):
     tensor_parallelism_size: int = 1
     pipeline_parallelism_size: int = 1
 
+    # Whether ranks must share an NVLink island, rather than only a node.
+    require_island: bool = True
+
+    # Saved values are copied by the head's postprocessing.
+    save_transfer: None = None
+    # The head saves responses before the ranks take the next request.
+    result_writer: None = None
+    # Ranks execute each request together, so requests aren't batched continuously.
+    continuous_batching: None = None
+    # Ranks load only their shards of the checkpoint (see load_hf_model_from_cache).
+    weight_cache: None = None
+    # Weights are sharded in bfloat16 by the tensor parallel plans.
+    quantization: None = None
+
 
 def app(args: DistributedModelDeploymentArgs) -> Application:
-    return ModelDeployment.bind(**args.model_dump())
+    return ModelDeployment.bind(**args.model_dump(exclude=SINGLE_REPLICA_ARGS))
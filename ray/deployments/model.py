@@ -1,7 +1,13 @@
+import abc
+import asyncio
 import gc
 import logging
 import os
-from typing import Dict
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import partial
+from typing import Any, Dict, Iterator, Optional
 
 import torch
 from pydantic import BaseModel
@@ -11,53 +17,213 @@ from ray.serve import Application
 from transformers import PreTrainedModel
 
 from nnsight.models.mixins import RemoteableMixin
-from nnsight.schema.Request import RequestModel
-
+from ...schema.Request import RequestModel
 from ...schema.Response import ResponseModel, ResultModel
-from ..util import set_cuda_env_var
+from ...schema.Usage import UsageModel
+from ...telemetry import metrics, tracing
+from .. import cost
+from ..autoscale import record_service_time
+from ..continuous_batching import ContinuousBatcher, ContinuousBatchingArgs
+from ..cost import ModelProfile
+from ..job_control import (
+    CancellationWatcher,
+    JobControl,
+    JobStopped,
+    start_job,
+    time_limit,
+)
+from ..quantization import QuantizationArgs, quantize
+from ..result_handoff import ResultHandoffArgs, ResultHandoffClient
+from ..result_writer import ResultWriter, ResultWriterArgs
+from ..save_transfer import SaveTransfer, SaveTransferArgs, SaveTransferPool
+from ..util import dispatch_across_gpus, get_free_cudamemory_bytes, set_cuda_env_var
+from ..warmup import WarmupArgs, warm_up
+from ..weight_cache import WeightCache, WeightCacheArgs
+
+
+class BaseModelDeployment(abc.ABC):
+    """Runs jobs against a model. Subclasses load models and provide the model of each
+    request through load.
+
+    Attributes:
+        api_url (str): URL of the API, notified of responses to blocking requests.
+        db_connection (MongoClient): Connection to the database.
+        gpus (int): GPUs a job holds while it executes, to record usage with.
+        result_handoff (Optional[ResultHandoffClient]): Results are offered to it before GridFS.
+        save_transfer (Optional[SaveTransferPool]): Saved values are copied into its host
+            memory while jobs execute. Otherwise they are copied by postprocessing.
+        result_writer (Optional[ResultWriter]): Saves final responses in the background.
+            Otherwise jobs save them before the next job starts.
+        profiles (Dict[str, ModelProfile]): Shape of each model served, to estimate the cost
+            of requests with. Models without one are not estimated.
+        cancellations (CancellationWatcher): Stops jobs cancelled while they run.
+        max_execution_seconds (Optional[float]): Longest a job may execute for, besides the
+            limit of its API key. None is unlimited.
+    """
 
+    api_url: str
+    db_connection: MongoClient
+    logger: logging.Logger
+    gpus: int
+    result_handoff: Optional[ResultHandoffClient] = None
+    save_transfer: Optional[SaveTransferPool] = None
+    result_writer: Optional[ResultWriter] = None
+    profiles: Dict[str, ModelProfile]
+    cancellations: CancellationWatcher
+    max_execution_seconds: Optional[float] = None
+
+    @contextmanager
+    @abc.abstractmethod
+    def load(self, request: RequestModel) -> Iterator[RemoteableMixin]:
+        """Yields the model to run request against."""
 
-@serve.deployment()
-class ModelDeployment:
-    def __init__(self, model_key: str, api_url: str, database_url: str):
+    def __call__(self, request: RequestModel):
 
-        set_cuda_env_var()
+        start = time.perf_counter()
 
-        self.model_key = model_key
-        self.api_url = api_url
-        self.database_url = database_url
+        model_key = request.model_key
 
-        self.model = RemoteableMixin.from_model_key(
-            self.model_key, device_map="auto", dispatch=True
-        )
-        
-        torch.cuda.empty_cache()
+        local_result = None
 
-        self.db_connection = MongoClient(self.database_url)
+        with tracing.span("model.call", request=request, model_key=model_key):
 
-        self.logger = logging.getLogger(__name__)
+            metrics.QUEUE_WAIT.observe(
+                (datetime.now() - request.received).total_seconds(), model_key
+            )
 
-    def __call__(self, request: RequestModel):
+            execute = None
+            transfer = None
 
-        try:
+            control = JobControl(
+                request.id,
+                time_limit(self.max_execution_seconds, request.max_execution_seconds),
+            )
 
-            # Deserialize request
-            obj = request.deserialize(self.model)
+            try:
 
-            # Execute object.
-            local_result = obj.local_backend_execute()
+                # Marked RUNNING, or skipped if it was cancelled while queued.
+                if not start_job(
+                    request,
+                    self.cancellations.cancelled(request.id),
+                    self.db_connection,
+                    self.api_url,
+                    self.logger,
+                ):
+                    return
 
-            ResponseModel(
-                id=request.id,
-                session_id=request.session_id,
-                received=request.received,
-                status=ResponseModel.JobStatus.COMPLETED,
-                description="Your job has been completed.",
-                result=ResultModel(
+                with self.load(request) as model, self.cancellations.watch(control):
+
+                    try:
+
+                        # Deserialize request
+                        with metrics.DESERIALIZE.time(model_key), tracing.span(
+                            "model.deserialize"
+                        ):
+                            if request.staged:
+                                request = request.unstage(self.db_connection)
+
+                            # Staged objects, and requests the Request app had no profile
+                            # for, are first seen here.
+                            if request.estimated_flops is None:
+                                self.check_cost(request)
+
+                            obj = request.deserialize(model)
+
+                        if self.save_transfer is not None:
+                            transfer = self.save_transfer.transfer(obj)
+
+                        # Execute object.
+                        with metrics.EXECUTE.time(model_key) as execute, tracing.span(
+                            "model.execute"
+                        ), transfer or nullcontext(), control.running():
+                            local_result = self.execute(obj)
+
+                        with metrics.POSTPROCESS.time(model_key), tracing.span(
+                            "model.postprocess"
+                        ):
+                            value = obj.remote_backend_postprocess_result(local_result)
+
+                    finally:
+
+                        model._model.zero_grad()
+
+                response = ResponseModel(
                     id=request.id,
-                    value=obj.remote_backend_postprocess_result(local_result),
-                ),
-            ).log(self.logger).save(self.db_connection).blocking_response(self.api_url)
+                    session_id=request.session_id,
+                    received=request.received,
+                    model_key=model_key,
+                    key_id=request.key_id,
+                    status=ResponseModel.JobStatus.COMPLETED,
+                    description="Your job has been completed.",
+                    result=ResultModel(
+                        id=request.id,
+                        value=value,
+                    ),
+                ).log(self.logger)
+
+            except Exception as exception:
+
+                reason = None
+
+                if isinstance(exception, JobStopped):
+
+                    reason = exception.reason
+
+                    metrics.JOBS_STOPPED.inc(reason)
+
+                response = ResponseModel(
+                    id=request.id,
+                    session_id=request.session_id,
+                    received=request.received,
+                    model_key=model_key,
+                    status=ResponseModel.JobStatus.ERROR,
+                    reason=reason,
+                    description=str(exception),
+                ).log(self.logger)
+
+            # The replica is free for the next job from here.
+            save = partial(
+                self.save_response,
+                request,
+                response,
+                transfer,
+                execute.elapsed if execute is not None else None,
+                time.perf_counter() - start,
+            )
+
+            if self.result_writer is None:
+                save()
+            else:
+                self.result_writer.submit(request.id, save)
+
+        del request
+        del local_result
+
+        gc.collect()
+
+        torch.cuda.empty_cache()
+
+    def execute(self, obj: Any) -> Any:
+        """Executes a deserialized object against its model."""
+
+        return obj.local_backend_execute()
+
+    def save_response(
+        self,
+        request: RequestModel,
+        response: ResponseModel,
+        transfer: Optional[SaveTransfer],
+        execute_seconds: Optional[float],
+        service_seconds: float,
+    ) -> None:
+        """Saves a job's final response and notifies the API, then records its execution.
+        Runs on the result writer if the replica has one."""
+
+        try:
+
+            response.save(
+                self.db_connection, handoff=self.result_handoff
+            ).blocking_response(self.api_url)
 
         except Exception as exception:
 
@@ -65,24 +231,81 @@ class ModelDeployment:
                 id=request.id,
                 session_id=request.session_id,
                 received=request.received,
+                model_key=request.model_key,
                 status=ResponseModel.JobStatus.ERROR,
                 description=str(exception),
             ).log(self.logger).save(self.db_connection).blocking_response(self.api_url)
 
-        del request
-        del local_result
+        finally:
 
-        self.model._model.zero_grad()
+            # The result is saved, so the host memory of its values can be reused.
+            if transfer is not None:
+                transfer.release()
 
-        gc.collect()
+        if execute_seconds is not None:
+            self.record_execution(request, execute_seconds, service_seconds)
 
-        torch.cuda.empty_cache()
+    def __del__(self):
 
-    async def status(self):
+        # Serve calls this on graceful shutdown. Responses already computed are still saved.
+        if self.result_writer is not None:
+            self.result_writer.shutdown()
 
-        model: PreTrainedModel = self.model._model
+    def record_execution(
+        self, request: RequestModel, execute_seconds: float, service_seconds: float
+    ) -> None:
+        """Records the job's usage against its API key, and its service time and throughput
+        for autoscaling and cost estimates."""
 
-        return model.config.to_json_string()
+        try:
+            UsageModel.record(
+                self.db_connection, request.key_id, execute_seconds * self.gpus
+            )
+            record_service_time(
+                self.db_connection,
+                request.model_key,
+                service_seconds,
+                flops_per_second=(
+                    request.estimated_flops / execute_seconds
+                    if request.estimated_flops and execute_seconds > 0
+                    else None
+                ),
+            )
+        except Exception as exception:
+            self.logger.error(
+                f"Failed to record execution of `{request.id}`: {exception}"
+            )
+
+    def check_cost(self, request: RequestModel) -> None:
+        """Estimates the request's cost against its model's profile.
+
+        Raises:
+            CostExceeded: If it would not fit in the device memory left for activations.
+        """
+
+        profile = self.profiles.get(request.model_key)
+
+        if profile is None:
+            return
+
+        # As in the Request app, requests the estimator can't walk run unchecked.
+        try:
+            estimate = cost.estimate(request.object, profile)
+        except Exception as exception:
+
+            self.logger.warning(
+                f"Failed to estimate the cost of `{request.id}`: {exception}"
+            )
+
+            return
+
+        cost.check(estimate, profile)
+
+        request.estimated_flops = estimate.flops
+
+    async def profile(self, model_key: str) -> Optional[ModelProfile]:
+
+        return self.profiles.get(model_key)
 
     # Ray checks this method and restarts replica if it raises an exception
     def check_health(self):
@@ -90,6 +313,130 @@ class ModelDeployment:
         for device in range(torch.cuda.device_count()):
             torch.cuda.mem_get_info(device)
 
+
+@serve.deployment()
+class ModelDeployment(BaseModelDeployment):
+    def __init__(
+        self,
+        model_key: str,
+        api_url: str,
+        database_url: str,
+        result_handoff: Optional[Dict[str, Any]],
+        save_transfer: Optional[Dict[str, Any]],
+        result_writer: Optional[Dict[str, Any]],
+        continuous_batching: Optional[Dict[str, Any]],
+        max_execution_seconds: Optional[float],
+        weight_cache: Optional[Dict[str, Any]],
+        quantization: Optional[Dict[str, Any]],
+        warmup: Optional[Dict[str, Any]],
+    ):
+
+        set_cuda_env_var()
+
+        self.model_key = model_key
+        self.api_url = api_url
+        self.database_url = database_url
+
+        # Quantized models are loaded on the CPU, and only their quantized weights are
+        # dispatched to the GPUs.
+        device_map = "auto" if quantization is None else None
+
+        self.weight_cache = None
+
+        if weight_cache is not None:
+
+            self.weight_cache = WeightCache(**weight_cache)
+
+            self.model = self.weight_cache.load(self.model_key, device_map=device_map)
+
+        else:
+
+            self.model = RemoteableMixin.from_model_key(
+                self.model_key, device_map=device_map, dispatch=True
+            )
+
+        if quantization is not None:
+
+            quantize(self.model._model, QuantizationArgs(**quantization))
+
+            self.model._model = dispatch_across_gpus(self.model._model)
+
+        # The model is dispatched across, and holds, every visible GPU.
+        self.gpus = max(1, torch.cuda.device_count())
+
+        torch.cuda.empty_cache()
+
+        profile = ModelProfile.from_model(
+            self.model._model, device_bytes=get_free_cudamemory_bytes()
+        )
+
+        self.profiles = {self.model_key: profile} if profile is not None else {}
+
+        # Serve counts the replica as running, and routes requests to it, only once
+        # __init__ returns, so the cold start is paid here rather than by the first user.
+        if warmup is not None:
+            warm_up(self.model, self.model_key, WarmupArgs(**warmup))
+
+        self.db_connection = MongoClient(self.database_url)
+
+        self.cancellations = CancellationWatcher(self.db_connection)
+        self.max_execution_seconds = max_execution_seconds
+
+        if result_handoff is not None:
+            self.result_handoff = ResultHandoffClient(
+                self.database_url, **result_handoff
+            )
+
+        if save_transfer is not None:
+            self.save_transfer = SaveTransferPool(**save_transfer)
+
+        if result_writer is not None:
+            self.result_writer = ResultWriter(**result_writer)
+
+        self.batcher = None
+
+        if continuous_batching is not None:
+            self.batcher = ContinuousBatcher(
+                self.model._model,
+                self.model_key,
+                pad_token_id=getattr(
+                    getattr(self.model, "tokenizer", None), "pad_token_id", None
+                ),
+                **continuous_batching,
+            )
+
+        self.logger = logging.getLogger(__name__)
+
+        tracing.init("model", model_key=self.model_key)
+
+    async def __call__(self, request: RequestModel):
+
+        if self.batcher is None:
+            return super().__call__(request)
+
+        # Jobs wait on the batcher in threads, so that several are in the batch at once.
+        await asyncio.get_running_loop().run_in_executor(
+            None, super().__call__, request
+        )
+
+    def execute(self, obj: Any) -> Any:
+
+        if self.batcher is None:
+            return super().execute(obj)
+
+        return self.batcher.execute(obj)
+
+    @contextmanager
+    def load(self, request: RequestModel) -> Iterator[RemoteableMixin]:
+
+        yield self.model
+
+    async def status(self):
+
+        model: PreTrainedModel = self.model._model
+
+        return model.config.to_json_string()
+
     def model_size(self) -> float:
 
         mem_params = sum(
@@ -112,6 +459,39 @@ class ModelDeploymentArgs(BaseModel):
     api_url: str
     database_url: str
 
+    # Hands large results to the API through the Ray object store. Enabled per model in the
+    # service config. None writes them to GridFS.
+    result_handoff: Optional[ResultHandoffArgs] = None
+
+    # Copies saved values to pinned host memory while requests execute. Enabled per model in
+    # the service config. None leaves them on the device until postprocessing.
+    save_transfer: Optional[SaveTransferArgs] = None
+
+    # Saves responses in the background while the next request runs. Enabled per model in
+    # the service config. None saves them first.
+    result_writer: Optional[ResultWriterArgs] = None
+
+    # Decodes generate requests in one batch they join and leave token by token. None runs
+    # requests one at a time.
+    continuous_batching: Optional[ContinuousBatchingArgs] = None
+
+    # Longest a request may execute for, in seconds. Requests are also held to the limit of
+    # their API key. None is unlimited.
+    max_execution_seconds: Optional[float] = None
+
+    # Builds the model from a snapshot of its weights shared by the replicas of the node.
+    # None loads it from the checkpoint on its own.
+    weight_cache: Optional[WeightCacheArgs] = None
+
+    # Stores the weights of linear layers as integers, dequantized to the compute dtype as
+    # they are used. Set per model by quantization in the service config. None keeps the
+    # checkpoint's dtype.
+    quantization: Optional[QuantizationArgs] = None
+
+    # Runs synthetic requests of these shapes before the replica takes real ones. Enabled per
+    # model in the service config. None leaves the cold start to the first request.
+    warmup: Optional[WarmupArgs] = None
+
 
 def app(args: ModelDeploymentArgs) -> Application:
 
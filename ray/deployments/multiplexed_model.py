@@ -0,0 +1,191 @@
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import torch
+from pydantic import BaseModel
+from pymongo import MongoClient
+from ray import serve
+from ray.serve import Application
+
+from nnsight.models.mixins import RemoteableMixin
+from ...schema.Request import RequestModel
+from ...schema.Response import ResponseModel
+from ...telemetry import metrics, tracing
+from ..cost import ModelProfile
+from ..job_control import CancellationWatcher
+from ..model_cache import ModelCache
+from ..result_handoff import ResultHandoffArgs, ResultHandoffClient
+from ..result_writer import ResultWriter, ResultWriterArgs
+from ..save_transfer import SaveTransferArgs, SaveTransferPool
+from ..weight_cache import WeightCache, WeightCacheArgs
+from .model import BaseModelDeployment
+
+
+@serve.deployment()
+class MultiplexedModelDeployment(BaseModelDeployment):
+    """Serves several models from one device, keeping those used recently on it.
+
+    Models are loaded on first use. When the device budget is exceeded, the least recently
+    used models are offloaded (see ModelCache), and the job's status reports the load and
+    offload times.
+    """
+
+    def __init__(
+        self,
+        model_keys: List[str],
+        api_url: str,
+        database_url: str,
+        device_budget_MB: Optional[float],
+        host_budget_MB: Optional[float],
+        snapshot_dir: Optional[str],
+        result_handoff: Optional[Dict[str, Any]],
+        save_transfer: Optional[Dict[str, Any]],
+        result_writer: Optional[Dict[str, Any]],
+        max_execution_seconds: Optional[float],
+        weight_cache: Optional[Dict[str, Any]],
+    ):
+
+        self.model_keys = model_keys
+        self.api_url = api_url
+        self.database_url = database_url
+
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+        if device_budget_MB is None:
+
+            # Leave room for activations.
+            device_budget_MB = torch.cuda.mem_get_info(device)[1] * 1e-6 * 0.8
+
+        # What the budget leaves of the device for activations.
+        self.activation_bytes = (
+            int(torch.cuda.mem_get_info(device)[1] - device_budget_MB * 1e6)
+            if device.type == "cuda"
+            else None
+        )
+
+        self.profiles = {}
+
+        self.weight_cache = (
+            WeightCache(**weight_cache) if weight_cache is not None else None
+        )
+
+        self.cache = ModelCache(
+            self.load_model,
+            device,
+            int(device_budget_MB * 1e6),
+            host_budget_bytes=(
+                int(host_budget_MB * 1e6) if host_budget_MB is not None else None
+            ),
+            snapshot_dir=snapshot_dir,
+        )
+
+        self.gpus = 1
+
+        self.db_connection = MongoClient(self.database_url)
+
+        self.cancellations = CancellationWatcher(self.db_connection)
+        self.max_execution_seconds = max_execution_seconds
+
+        if result_handoff is not None:
+            self.result_handoff = ResultHandoffClient(
+                self.database_url, **result_handoff
+            )
+
+        if save_transfer is not None:
+            self.save_transfer = SaveTransferPool(**save_transfer)
+
+        if result_writer is not None:
+            self.result_writer = ResultWriter(**result_writer)
+
+        self.logger = logging.getLogger(__name__)
+
+        tracing.init("model", model_key=",".join(self.model_keys))
+
+    def load_model(self, model_key: str) -> RemoteableMixin:
+
+        if self.weight_cache is not None:
+            model = self.weight_cache.load(model_key)
+        else:
+            model = RemoteableMixin.from_model_key(model_key, dispatch=True)
+
+        # Profiled once, as parameters are emptied while the model is snapshotted to disk.
+        profile = ModelProfile.from_model(
+            model._model, device_bytes=self.activation_bytes
+        )
+
+        if profile is not None:
+            self.profiles[model_key] = profile
+
+        return model
+
+    @contextmanager
+    def load(self, request: RequestModel) -> Iterator[RemoteableMixin]:
+
+        if request.model_key not in self.model_keys:
+            raise ValueError(f"Model `{request.model_key}` is not served here.")
+
+        with tracing.span("model.load"), self.cache.use(request.model_key) as event:
+
+            if event.load_seconds:
+
+                metrics.MODEL_LOAD.observe(event.load_seconds, request.model_key)
+
+                for offload in event.offloads:
+                    metrics.MODEL_OFFLOAD.observe(offload.seconds, offload.model_key)
+
+                ResponseModel(
+                    id=request.id,
+                    session_id=request.session_id,
+                    received=request.received,
+                    model_key=request.model_key,
+                    status=ResponseModel.JobStatus.RUNNING,
+                    description=str(event),
+                ).log(self.logger).save(self.db_connection).blocking_response(
+                    self.api_url
+                )
+
+            yield self.cache.get(request.model_key)
+
+    async def status(self):
+
+        return self.cache.status()
+
+
+class MultiplexedModelDeploymentArgs(BaseModel):
+
+    model_keys: List[str]
+    api_url: str
+    database_url: str
+
+    # Defaults to 80% of the device's memory. Required on the CPU.
+    device_budget_MB: Optional[float] = None
+    # Unbounded by default.
+    host_budget_MB: Optional[float] = None
+    # Without one, models pushed out of host memory are dropped and loaded from scratch.
+    snapshot_dir: Optional[str] = None
+
+    # Hands large results to the API through the Ray object store. Enabled per model in the
+    # service config. None writes them to GridFS.
+    result_handoff: Optional[ResultHandoffArgs] = None
+
+    # Copies saved values to pinned host memory while requests execute. Enabled per model in
+    # the service config. None leaves them on the device until postprocessing.
+    save_transfer: Optional[SaveTransferArgs] = None
+
+    # Saves responses in the background while the next request runs. Enabled per model in
+    # the service config. None saves them first.
+    result_writer: Optional[ResultWriterArgs] = None
+
+    # Longest a request may execute for, in seconds. Requests are also held to the limit of
+    # their API key. None is unlimited.
+    max_execution_seconds: Optional[float] = None
+
+    # Loads models from snapshots of their weights shared by the replicas of the node, so
+    # models first loaded into host memory aren't copied. None loads them on their own.
+    weight_cache: Optional[WeightCacheArgs] = None
+
+
+def app(args: MultiplexedModelDeploymentArgs) -> Application:
+
+    return MultiplexedModelDeployment.bind(**args.model_dump())
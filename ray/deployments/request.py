@@ -1,58 +1,219 @@
 import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel
 from pymongo import MongoClient
 from ray import serve
 from ray.serve import Application
 from ray.serve.handle import DeploymentHandle
+
 try:
     from slugify import slugify
 except:
     pass
 
-from nnsight.schema.Request import RequestModel
-
+from ...schema.Request import RequestModel
 from ...schema.Response import ResponseModel
+from ...telemetry import metrics, tracing
+from .. import cost
+from ..cost import ModelProfile
+
+# Seconds a model's profile is cached for.
+PROFILE_TTL_SECONDS = 300
+# Seconds approved jobs are counted as queued for.
+QUEUE_WINDOW_SECONDS = 3600
 
 
 @serve.deployment()
 class RequestDeployment:
-    def __init__(self, ray_dashboard_url: str, api_url: str, database_url: str):
+    def __init__(
+        self,
+        ray_dashboard_url: str,
+        api_url: str,
+        database_url: str,
+        model_apps: Dict[str, str],
+        max_memory_fraction: float,
+        max_estimated_seconds: Optional[float],
+        stats_ttl_seconds: float,
+    ):
 
         self.ray_dashboard_url = ray_dashboard_url
         self.api_url = api_url
         self.database_url = database_url
+        self.model_apps = model_apps
+        self.max_memory_fraction = max_memory_fraction
+        self.max_estimated_seconds = max_estimated_seconds
+        self.stats_ttl_seconds = stats_ttl_seconds
 
         self.db_connection = MongoClient(self.database_url)
 
+        # Model key to when it was fetched and the value.
+        self.profiles: Dict[str, Tuple[float, Optional[ModelProfile]]] = {}
+        self.stats: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
         self.logger = logging.getLogger(__name__)
 
+        tracing.init("request")
+
     async def __call__(self, request: RequestModel):
 
-        try:
+        with tracing.span("request.dispatch", request=request):
+
+            try:
+
+                # Models served by a multiplexed app, otherwise each has its own.
+                model_key = self.model_apps.get(
+                    request.model_key, f"Model:{slugify(request.model_key)}"
+                )
+
+                app_handle = self.get_ray_app_handle(model_key)
+
+                description = "Your job was approved and is waiting to be run."
+
+                # Staged objects are only loaded by the model replica, which estimates them.
+                if request.object is not None:
+                    description += await self.estimate(request, app_handle)
+
+                # The model replica continues the trace as a child of this span.
+                tracing.inject(request)
+
+                app_handle.remote(request)
+
+                metrics.DISPATCH.observe(
+                    (datetime.now() - request.received).total_seconds(),
+                    request.model_key,
+                )
+
+                response = ResponseModel(
+                    id=request.id,
+                    session_id=request.session_id,
+                    received=request.received,
+                    model_key=request.model_key,
+                    status=ResponseModel.JobStatus.APPROVED,
+                    description=description,
+                )
+
+                # Only while RECEIVED, as the replica may have started the job, or the API
+                # cancelled it, since it was dispatched.
+                if response.save_if(
+                    self.db_connection, [ResponseModel.JobStatus.RECEIVED]
+                ):
+                    response.log(self.logger).blocking_response(self.api_url)
+
+            except Exception as exception:
+                ResponseModel(
+                    id=request.id,
+                    session_id=request.session_id,
+                    received=request.received,
+                    status=ResponseModel.JobStatus.ERROR,
+                    description=str(exception),
+                ).log(self.logger).save(self.db_connection).blocking_response(
+                    self.api_url
+                )
+
+    async def estimate(
+        self, request: RequestModel, app_handle: DeploymentHandle
+    ) -> str:
+        """Estimates the cost of the request, setting its estimated_flops.
+
+        Returns:
+            str: When the request is expected to start, to add to its status. Empty if unknown.
+
+        Raises:
+            CostExceeded: If the request is too large to run.
+        """
+
+        with tracing.span("request.estimate"):
+
+            profile = await self.get_profile(request.model_key, app_handle)
+
+            if profile is None:
+                return ""
+
+            stats = self.get_stats(request.model_key)
 
-            model_key = f"Model:{slugify(request.model_key)}"
+            try:
+                estimate = cost.estimate(request.object, profile)
+            except Exception as exception:
 
-            app_handle = self.get_ray_app_handle(model_key)
+                self.logger.warning(
+                    f"Failed to estimate the cost of `{request.id}`: {exception}"
+                )
 
-            app_handle.remote(request)
+                return ""
 
-            ResponseModel(
-                id=request.id,
-                session_id=request.session_id,
-                received=request.received,
-                status=ResponseModel.JobStatus.APPROVED,
-                description="Your job was approved and is waiting to be run.",
-            ).log(self.logger).save(self.db_connection).blocking_response(self.api_url)
+            cost.check(
+                estimate,
+                profile,
+                memory_fraction=self.max_memory_fraction,
+                max_seconds=self.max_estimated_seconds,
+                flops_per_second=stats.get("flops_per_second"),
+            )
 
-        except Exception as exception:
-            ResponseModel(
-                id=request.id,
-                session_id=request.session_id,
-                received=request.received,
-                status=ResponseModel.JobStatus.ERROR,
-                description=str(exception),
-            ).log(self.logger).save(self.db_connection).blocking_response(self.api_url)
+            request.estimated_flops = estimate.flops
+
+        if not stats.get("service_seconds"):
+            return ""
+
+        # Jobs ahead of this one, drained by every replica of the model.
+        wait = stats["queued"] * stats["service_seconds"] / stats.get("replicas", 1)
+
+        return f" It is estimated to start in about {math.ceil(wait)} seconds."
+
+    async def get_profile(
+        self, model_key: str, app_handle: DeploymentHandle
+    ) -> Optional[ModelProfile]:
+
+        fetched, profile = self.profiles.get(model_key, (0, None))
+
+        if time.monotonic() - fetched > PROFILE_TTL_SECONDS:
+
+            try:
+                profile = await app_handle.profile.remote(model_key)
+            except Exception as exception:
+
+                self.logger.warning(f"Failed to profile `{model_key}`: {exception}")
+
+                profile = None
+
+            self.profiles[model_key] = (time.monotonic(), profile)
+
+        return profile
+
+    def get_stats(self, model_key: str) -> Dict[str, Any]:
+        """Model stats (see autoscale.py) and jobs queued for the model."""
+
+        fetched, stats = self.stats.get(model_key, (0, None))
+
+        if time.monotonic() - fetched > self.stats_ttl_seconds:
+
+            database = self.db_connection["ndif_database"]
+
+            stats = database["model_stats"].find_one({"_id": model_key}) or {}
+            stats["queued"] = database["responses"].count_documents(
+                {
+                    "status": "APPROVED",
+                    "model_key": model_key,
+                    # Older jobs are assumed lost, as by the autoscaler.
+                    "updated": {
+                        "$gte": datetime.utcnow()
+                        - timedelta(seconds=QUEUE_WINDOW_SECONDS)
+                    },
+                }
+            )
+
+            self.stats[model_key] = (time.monotonic(), stats)
+
+        return stats
+
+    async def batch(self, requests: List[RequestModel]) -> None:
+        """Dispatches a batch of requests submitted together by the API."""
+
+        for request in requests:
+            await self(request)
 
     def get_ray_app_handle(self, name: str) -> DeploymentHandle:
 
@@ -65,6 +226,16 @@ class RequestDeploymentArgs(BaseModel):
     api_url: str
     database_url: str
 
+    # App name of each model key served by a multiplexed app.
+    model_apps: Dict[str, str] = {}
+
+    # Requests estimated to need more of a replica's free device memory are rejected.
+    max_memory_fraction: float = 0.9
+    # Requests estimated to run longer are rejected. None allows any.
+    max_estimated_seconds: Optional[float] = None
+    # Seconds model stats and queue lengths are cached for.
+    stats_ttl_seconds: float = 5
+
 
 def app(args: RequestDeploymentArgs) -> Application:
     return RequestDeployment.bind(**args.model_dump())
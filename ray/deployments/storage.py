@@ -0,0 +1,366 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import gridfs
+from bson.objectid import ObjectId
+from pydantic import BaseModel
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+from ray import serve
+from ray.serve import Application
+
+from ...schema.Response import ResponseModel
+from ...telemetry import metrics
+
+# GridFS buckets in ndif_database.
+BUCKETS = ("results", "requests")
+
+FIRST_CHUNK_INDEX = "files_id_first_chunk"
+
+
+@serve.deployment()
+class StorageDeployment:
+    """Keeps the database's working set bounded.
+
+    Responses, results and staged requests expire through TTL indexes. Mongo removes expired
+    GridFS files documents but not their chunks, so every sweep_interval_seconds a background
+    thread deletes chunks whose file no longer exists, evicts the oldest results of keys over
+    their quota and of the whole store over the global quota, and exports storage metrics.
+    """
+
+    def __init__(
+        self,
+        database_url: str,
+        response_ttl_seconds: Optional[int],
+        result_ttl_seconds: Optional[int],
+        staged_request_ttl_seconds: Optional[int],
+        key_quota_bytes: Optional[int],
+        global_quota_bytes: Optional[int],
+        sweep_interval_seconds: float,
+        orphan_grace_seconds: float,
+        sweep_batch_size: int,
+    ):
+
+        self.database_url = database_url
+        self.response_ttl_seconds = response_ttl_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.staged_request_ttl_seconds = staged_request_ttl_seconds
+        self.key_quota_bytes = key_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.orphan_grace_seconds = orphan_grace_seconds
+        self.sweep_batch_size = sweep_batch_size
+
+        self.db_connection = MongoClient(self.database_url)
+        self.database = self.db_connection["ndif_database"]
+
+        self.logger = logging.getLogger(__name__)
+
+        self.last_sweep: Dict[str, Any] = {}
+        self.last_error: Optional[str] = None
+
+        self.ensure_indexes()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def ensure_ttl_index(
+        self, collection: Collection, field: str, seconds: Optional[int]
+    ) -> None:
+
+        if seconds is None:
+            return
+
+        try:
+
+            collection.create_index(field, expireAfterSeconds=seconds)
+
+        # An index on field exists with another TTL, update it in place.
+        except OperationFailure:
+
+            self.database.command(
+                "collMod",
+                collection.name,
+                index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds},
+            )
+
+    def ensure_indexes(self) -> None:
+
+        responses = self.database["responses"]
+
+        # Responses saved before TTL expiry was introduced have no updated field.
+        responses.update_many(
+            {"updated": {"$exists": False}}, {"$currentDate": {"updated": True}}
+        )
+
+        self.ensure_ttl_index(responses, "updated", self.response_ttl_seconds)
+        # Cancelled jobs have stopped long before their responses expire.
+        self.ensure_ttl_index(
+            self.database["cancellations"], "created", self.response_ttl_seconds
+        )
+        self.ensure_ttl_index(
+            self.database["results.files"], "uploadDate", self.result_ttl_seconds
+        )
+        self.ensure_ttl_index(
+            self.database["requests.files"],
+            "uploadDate",
+            self.staged_request_ttl_seconds,
+        )
+
+        for bucket in BUCKETS:
+
+            # Indexes one chunk per file, so finding orphans scans files rather than chunks.
+            self.database[f"{bucket}.chunks"].create_index(
+                "files_id", name=FIRST_CHUNK_INDEX, partialFilterExpression={"n": 0}
+            )
+
+        # For per-key quotas.
+        self.database["results.files"].create_index(
+            [("metadata.key_id", 1), ("uploadDate", 1)]
+        )
+
+    def sweep_orphaned_chunks(self, bucket: str) -> int:
+        """Deletes chunks of files whose files document is gone.
+
+        Chunks are written before their files document, so only chunks older than
+        orphan_grace_seconds are considered, to leave uploads in progress alone.
+
+        Returns:
+            int: Number of files whose chunks were deleted.
+        """
+
+        cutoff = ObjectId.from_datetime(
+            datetime.utcnow() - timedelta(seconds=self.orphan_grace_seconds)
+        )
+
+        chunks = self.database[f"{bucket}.chunks"]
+
+        swept = 0
+
+        while True:
+
+            files_ids = [
+                doc["files_id"]
+                for doc in chunks.aggregate(
+                    [
+                        # One chunk per file.
+                        {"$match": {"n": 0, "_id": {"$lt": cutoff}}},
+                        {
+                            "$lookup": {
+                                "from": f"{bucket}.files",
+                                "localField": "files_id",
+                                "foreignField": "_id",
+                                "as": "file",
+                            }
+                        },
+                        {"$match": {"file": {"$size": 0}}},
+                        {"$project": {"files_id": True}},
+                        {"$limit": self.sweep_batch_size},
+                    ],
+                    hint=FIRST_CHUNK_INDEX,
+                )
+            ]
+
+            if not files_ids:
+                break
+
+            chunks.delete_many({"files_id": {"$in": files_ids}})
+
+            swept += len(files_ids)
+
+        metrics.STORAGE_SWEPT.inc(f"orphaned_{bucket}", swept)
+
+        return swept
+
+    def evict(self, ids: List[ObjectId], reason: str) -> None:
+        """Deletes results and marks their responses as errored, so clients are told why."""
+
+        results = gridfs.GridFS(self.database, collection="results")
+
+        for id in ids:
+
+            results.delete(id)
+
+            self.database["responses"].update_one(
+                {"_id": id},
+                {
+                    "$set": {
+                        "status": ResponseModel.JobStatus.ERROR.value,
+                        "description": f"Your result was deleted before it was downloaded: {reason}.",
+                    },
+                    "$currentDate": {"updated": True},
+                },
+            )
+
+    def oldest_results(self, filter: Dict, nbytes: int) -> List[ObjectId]:
+        """Ids of the oldest results matching filter adding up to at least nbytes."""
+
+        ids = []
+
+        for doc in (
+            self.database["results.files"]
+            .find(filter, {"length": True})
+            .sort("uploadDate", 1)
+        ):
+
+            if nbytes <= 0:
+                break
+
+            ids.append(doc["_id"])
+
+            nbytes -= doc["length"]
+
+        return ids
+
+    def enforce_key_quota(self) -> int:
+
+        if self.key_quota_bytes is None:
+            return 0
+
+        evicted = 0
+
+        for doc in self.database["results.files"].aggregate(
+            [
+                {"$match": {"metadata.key_id": {"$ne": None}}},
+                {"$group": {"_id": "$metadata.key_id", "bytes": {"$sum": "$length"}}},
+                {"$match": {"bytes": {"$gt": self.key_quota_bytes}}},
+            ]
+        ):
+
+            ids = self.oldest_results(
+                {"metadata.key_id": doc["_id"]}, doc["bytes"] - self.key_quota_bytes
+            )
+
+            self.evict(ids, "storage quota of your API key exceeded")
+
+            evicted += len(ids)
+
+        metrics.STORAGE_SWEPT.inc("key_quota", evicted)
+
+        return evicted
+
+    def enforce_global_quota(self) -> int:
+
+        if self.global_quota_bytes is None:
+            return 0
+
+        total = next(
+            self.database["results.files"].aggregate(
+                [{"$group": {"_id": None, "bytes": {"$sum": "$length"}}}]
+            ),
+            {"bytes": 0},
+        )["bytes"]
+
+        if total <= self.global_quota_bytes:
+            return 0
+
+        ids = self.oldest_results({}, total - self.global_quota_bytes)
+
+        self.evict(ids, "storage is full")
+
+        metrics.STORAGE_SWEPT.inc("global_quota", len(ids))
+
+        return len(ids)
+
+    def collect_stats(self) -> Dict[str, Dict[str, int]]:
+
+        stats = {}
+
+        collections = ["responses"] + [
+            f"{bucket}.{kind}" for bucket in BUCKETS for kind in ("files", "chunks")
+        ]
+
+        for name in collections:
+
+            storage_stats = next(
+                self.database[name].aggregate([{"$collStats": {"storageStats": {}}}]),
+                {},
+            ).get("storageStats", {})
+
+            stats[name] = {
+                "bytes": storage_stats.get("size", 0),
+                "index_bytes": storage_stats.get("totalIndexSize", 0),
+                "documents": storage_stats.get("count", 0),
+            }
+
+            metrics.STORAGE_BYTES.set(stats[name]["bytes"], name)
+            metrics.STORAGE_INDEX_BYTES.set(stats[name]["index_bytes"], name)
+            metrics.STORAGE_DOCUMENTS.set(stats[name]["documents"], name)
+
+        return stats
+
+    def sweep(self) -> Dict[str, Any]:
+
+        start = datetime.utcnow()
+
+        sweep = {
+            "orphaned": {
+                bucket: self.sweep_orphaned_chunks(bucket) for bucket in BUCKETS
+            },
+            "evicted_key_quota": self.enforce_key_quota(),
+            "evicted_global_quota": self.enforce_global_quota(),
+            "stats": self.collect_stats(),
+        }
+
+        sweep["started"] = str(start)
+        sweep["seconds"] = (datetime.utcnow() - start).total_seconds()
+
+        return sweep
+
+    def run(self) -> None:
+
+        while not self._stopped.is_set():
+
+            try:
+
+                self.last_sweep = self.sweep()
+                self.last_error = None
+
+                self.logger.info(
+                    f"Storage sweep: orphaned {self.last_sweep['orphaned']}, "
+                    f"evicted {self.last_sweep['evicted_key_quota']} over key quota and "
+                    f"{self.last_sweep['evicted_global_quota']} over global quota."
+                )
+
+            except Exception as exception:
+
+                self.last_error = str(exception)
+
+                self.logger.exception(f"Storage sweep failed: {exception}")
+
+            self._stopped.wait(self.sweep_interval_seconds)
+
+    async def status(self):
+
+        return {"last_sweep": self.last_sweep, "last_error": self.last_error}
+
+    # Ray checks this method and restarts replica if it raises an exception
+    def check_health(self):
+
+        if not self._thread.is_alive():
+            raise RuntimeError("Storage sweeper thread died.")
+
+
+class StorageDeploymentArgs(BaseModel):
+
+    database_url: str
+
+    response_ttl_seconds: Optional[int] = 86400
+    result_ttl_seconds: Optional[int] = 86400
+    staged_request_ttl_seconds: Optional[int] = 86400
+
+    key_quota_bytes: Optional[int] = None
+    global_quota_bytes: Optional[int] = None
+
+    sweep_interval_seconds: float = 300
+    orphan_grace_seconds: float = 3600
+    sweep_batch_size: int = 1000
+
+
+def app(args: StorageDeploymentArgs) -> Application:
+
+    return StorageDeployment.bind(**args.model_dump())
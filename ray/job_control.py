@@ -0,0 +1,305 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import torch
+from pymongo import MongoClient
+
+from ..schema.Request import RequestModel
+from ..schema.Response import CANCELLED, QUEUED_STATUSES, TIMEOUT, ResponseModel
+
+# Seconds between lookups of the cancellations of running jobs.
+CANCEL_POLL_SECONDS = 1.0
+
+
+class JobStopped(Exception):
+    """Raised at a module boundary of a job that has to stop.
+
+    Attributes:
+        reason (str): CANCELLED or TIMEOUT, recorded with the job's ERROR response.
+    """
+
+    reason: str
+
+
+class JobCancelled(JobStopped):
+
+    reason = CANCELLED
+
+    def __init__(self) -> None:
+
+        super().__init__("Your job was cancelled.")
+
+
+class JobTimedOut(JobStopped):
+
+    reason = TIMEOUT
+
+    def __init__(self, max_seconds: Optional[float] = None) -> None:
+
+        super().__init__(
+            f"Your job exceeded the maximum execution time of {max_seconds} seconds."
+        )
+
+
+# Control of the job the current thread executes, checked before every module call.
+CURRENT_JOB: contextvars.ContextVar[Optional["JobControl"]] = contextvars.ContextVar(
+    "current_job", default=None
+)
+
+
+def time_limit(*limits: Optional[float]) -> Optional[float]:
+    """The smallest of limits that are set, or None."""
+
+    return min((limit for limit in limits if limit is not None), default=None)
+
+
+class JobControl:
+    """Whether a job has to stop, because it was cancelled or ran out of execution time.
+
+    While the job executes (see running), every module call of its thread checks its
+    control first, so a stopped job raises at the next module boundary.
+
+    Attributes:
+        id (str): Id of the job's request.
+        max_seconds (Optional[float]): Longest it may execute for. None is unlimited.
+        cancelled (bool): Set by a CancellationWatcher.
+        deadline (Optional[float]): time.monotonic() it has to finish by, once running.
+    """
+
+    def __init__(self, id: str, max_seconds: Optional[float] = None) -> None:
+
+        self.id = id
+        self.max_seconds = max_seconds
+
+        self.cancelled = False
+        self.deadline: Optional[float] = None
+
+    def exception(self) -> Optional[JobStopped]:
+        """What the job has to stop with, or None."""
+
+        if self.cancelled:
+            return JobCancelled()
+
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return JobTimedOut(self.max_seconds)
+
+        return None
+
+    def check(self) -> None:
+
+        exception = self.exception()
+
+        if exception is not None:
+            raise exception
+
+    @contextmanager
+    def running(self) -> Iterator["JobControl"]:
+        """Executes the job in the current context, starting its time limit."""
+
+        if self.max_seconds is not None:
+            self.deadline = time.monotonic() + self.max_seconds
+
+        _install_hook()
+
+        token = CURRENT_JOB.set(self)
+
+        try:
+            yield self
+        finally:
+            CURRENT_JOB.reset(token)
+
+
+class DistributedJobControl(JobControl):
+    """Control of a job executed by every rank together, which all have to stop at the same
+    module call or the others wait on their collectives forever.
+
+    Only the head watches cancellations and the time limit. Every check_every module calls,
+    all ranks take the head's decision by broadcast, so they stop alike.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        max_seconds: Optional[float],
+        device: torch.device,
+        check_every: int = 64,
+    ) -> None:
+
+        super().__init__(id, max_seconds)
+
+        self.device = device
+        self.check_every = check_every
+
+        self.calls = 0
+
+    def check(self) -> None:
+
+        self.calls += 1
+
+        if self.calls % self.check_every:
+            return
+
+        exception = self.exception()
+
+        stop = torch.tensor(
+            [0 if exception is None else 1 if exception.reason == CANCELLED else 2],
+            device=self.device,
+        )
+
+        torch.distributed.broadcast(stop, src=0)
+
+        if stop.item() == 1:
+            raise JobCancelled()
+
+        if stop.item() == 2:
+            raise JobTimedOut(self.max_seconds)
+
+
+def start_job(
+    request: RequestModel,
+    cancelled: bool,
+    client: MongoClient,
+    api_url: str,
+    logger: logging.Logger,
+) -> bool:
+    """Marks a job RUNNING before a replica runs it, or ERROR with reason CANCELLED if it was
+    cancelled while queued. Either only if the job is still queued, as the API marks jobs it
+    cancels before they start the same way, so only one of them reports how the job ends.
+
+    Returns:
+        bool: Whether to run the job.
+    """
+
+    if cancelled:
+        response = ResponseModel(
+            id=request.id,
+            session_id=request.session_id,
+            received=request.received,
+            model_key=request.model_key,
+            status=ResponseModel.JobStatus.ERROR,
+            reason=CANCELLED,
+            description="Your job was cancelled.",
+        )
+    else:
+        response = ResponseModel(
+            id=request.id,
+            session_id=request.session_id,
+            received=request.received,
+            model_key=request.model_key,
+            status=ResponseModel.JobStatus.RUNNING,
+            description="Your job has started running.",
+        )
+
+    # Otherwise the API cancelled it first, and has reported it.
+    if not response.save_if(client, QUEUED_STATUSES):
+        return False
+
+    response.log(logger).blocking_response(api_url)
+
+    return not cancelled
+
+
+class CancellationWatcher:
+    """Flags the controls of a replica's running jobs once they are cancelled, looking up
+    their cancellations every interval seconds from a background thread.
+
+    Attributes:
+        client (MongoClient): Connection to the database.
+        interval (float): Seconds between lookups.
+        controls (Dict[str, JobControl]): Control of each job watched, by id.
+    """
+
+    def __init__(self, client: MongoClient, interval: float = CANCEL_POLL_SECONDS):
+
+        self.client = client
+        self.interval = interval
+
+        self.controls: Dict[str, JobControl] = {}
+
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+        self.logger = logging.getLogger(__name__)
+
+    def cancelled(self, id: str) -> bool:
+        """Whether the job was cancelled, so a queued job can be skipped."""
+
+        return id in ResponseModel.cancelled(self.client, [id])
+
+    @contextmanager
+    def watch(self, control: JobControl) -> Iterator[JobControl]:
+
+        with self.lock:
+
+            self.controls[control.id] = control
+
+            if self.thread is None:
+
+                self.thread = threading.Thread(
+                    target=self.run, name="cancellation-watcher", daemon=True
+                )
+                self.thread.start()
+
+        try:
+            yield control
+        finally:
+
+            with self.lock:
+                self.controls.pop(control.id, None)
+
+    def run(self) -> None:
+
+        while True:
+
+            time.sleep(self.interval)
+
+            with self.lock:
+                ids = list(self.controls)
+
+            if not ids:
+                continue
+
+            try:
+                cancelled = ResponseModel.cancelled(self.client, ids)
+            except Exception as exception:
+
+                self.logger.warning(f"Failed to look up cancellations: {exception}")
+
+                continue
+
+            with self.lock:
+
+                for id in cancelled:
+
+                    control = self.controls.get(id)
+
+                    if control is not None:
+                        control.cancelled = True
+
+
+_hook = None
+_hook_lock = threading.Lock()
+
+
+def _check_current_job(module: torch.nn.Module, input) -> None:
+
+    control = CURRENT_JOB.get()
+
+    if control is not None:
+        control.check()
+
+
+def _install_hook() -> None:
+
+    global _hook
+
+    with _hook_lock:
+
+        if _hook is None:
+            _hook = torch.nn.modules.module.register_module_forward_pre_hook(
+                _check_current_job
+            )
@@ -0,0 +1,335 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Callable, Dict, Iterator, List, Optional
+
+import torch
+from pydantic import BaseModel
+
+try:
+    from slugify import slugify
+except:
+    pass
+
+from nnsight.models.mixins import RemoteableMixin
+
+
+class Tier(str, Enum):
+    """Where a cached model's weights are."""
+
+    DEVICE = "device"
+    HOST = "host"
+    DISK = "disk"
+
+
+class Offload(BaseModel):
+    """A model demoted to make room for another.
+
+    Attributes:
+        model_key (str): Model demoted.
+        tier (Optional[Tier]): Tier the model was demoted to. None if it was dropped.
+        seconds (float): Time the demotion took.
+    """
+
+    model_key: str
+    tier: Optional[Tier]
+    seconds: float
+
+
+class CacheEvent(BaseModel):
+    """What it took to make a model usable.
+
+    Attributes:
+        model_key (str): Model used.
+        tier (Optional[Tier]): Tier the model was promoted from. None if it was loaded from scratch.
+        load_seconds (float): Time to bring the model onto the device, including offloads.
+        offloads (List[Offload]): Models demoted to make room.
+    """
+
+    model_key: str
+    tier: Optional[Tier] = None
+    load_seconds: float = 0
+    offloads: List[Offload] = []
+
+    def __str__(self) -> str:
+
+        source = "from scratch" if self.tier is None else f"from {self.tier.value}"
+
+        description = f"Loaded model {source} in {self.load_seconds:.2f}s"
+
+        if self.offloads:
+
+            description += ", offloading " + ", ".join(
+                f"{offload.model_key} to {offload.tier.value if offload.tier else 'nowhere'} "
+                f"in {offload.seconds:.2f}s"
+                for offload in self.offloads
+            )
+
+        return description + "."
+
+
+class CachedModel:
+
+    def __init__(self, model_key: str, model: RemoteableMixin) -> None:
+
+        self.model_key = model_key
+        self.model = model
+
+        self.tier = Tier.HOST
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+        self.nbytes = sum(tensor.nbytes for tensor in self.tensors().values())
+
+    def tensors(self) -> Dict[str, torch.Tensor]:
+        """Parameters and buffers by name. Tied weights appear once."""
+
+        module: torch.nn.Module = self.model._model
+
+        return {**dict(module.named_parameters()), **dict(module.named_buffers())}
+
+
+class ModelCache:
+    """Keeps an LRU of models on one device within a memory budget.
+
+    Models not used recently are demoted to pinned host memory, from which they are copied
+    back at full PCIe bandwidth, and beyond host_budget_bytes to a snapshot on disk that is
+    memory-mapped back in. Budgets are accounted from the models' parameter and buffer sizes
+    rather than measured, so a small budget on the CPU exercises the same evictions.
+
+    Attributes:
+        load (Callable[[str], RemoteableMixin]): Loads a model key onto the CPU.
+        device (torch.device): Device models run on.
+        device_budget_bytes (int): Bytes of weights allowed on the device.
+        host_budget_bytes (Optional[int]): Bytes of weights allowed in host memory. Unbounded if None.
+        snapshot_dir (Optional[str]): Directory for snapshots of models demoted past host memory.
+            Without one, such models are dropped and reloaded from scratch.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], RemoteableMixin],
+        device: torch.device,
+        device_budget_bytes: int,
+        host_budget_bytes: Optional[int] = None,
+        snapshot_dir: Optional[str] = None,
+    ) -> None:
+
+        self.load = load
+        self.device = torch.device(device)
+        self.device_budget_bytes = device_budget_bytes
+        self.host_budget_bytes = host_budget_bytes
+        self.snapshot_dir = snapshot_dir
+
+        # Pinned memory needs a CUDA driver.
+        self.pin = torch.cuda.is_available()
+
+        self.models: Dict[str, CachedModel] = {}
+
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+
+    def resident_bytes(self, tier: Tier) -> int:
+
+        return sum(
+            cached.nbytes for cached in self.models.values() if cached.tier == tier
+        )
+
+    def snapshot_path(self, model_key: str) -> str:
+
+        return os.path.join(self.snapshot_dir, f"{slugify(model_key)}.pt")
+
+    def _synchronize(self) -> None:
+
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _to_device(self, cached: CachedModel) -> None:
+
+        tensors = cached.tensors()
+
+        if cached.tier == Tier.DISK:
+
+            snapshot = torch.load(
+                self.snapshot_path(cached.model_key), mmap=True, weights_only=True
+            )
+
+            for name, tensor in tensors.items():
+                tensor.data = snapshot[name].to(self.device)
+
+        else:
+
+            for tensor in tensors.values():
+                tensor.data = tensor.data.to(self.device, non_blocking=self.pin)
+
+        self._synchronize()
+
+        cached.tier = Tier.DEVICE
+
+    def _to_host(self, cached: CachedModel) -> None:
+
+        for tensor in cached.tensors().values():
+
+            host = torch.empty_like(tensor.data, device="cpu", pin_memory=self.pin)
+            host.copy_(tensor.data, non_blocking=self.pin)
+
+            tensor.data = host
+
+        self._synchronize()
+
+        cached.tier = Tier.HOST
+
+    def _to_disk(self, cached: CachedModel) -> None:
+
+        path = self.snapshot_path(cached.model_key)
+
+        tensors = cached.tensors()
+
+        # Weights don't change between uses, so a snapshot is written once per model.
+        if not os.path.exists(path):
+
+            torch.save({name: tensor.data for name, tensor in tensors.items()}, path)
+
+        # Releases the host memory. Meta tensors can't be assigned to data of CPU tensors.
+        for tensor in tensors.values():
+            tensor.data = torch.empty(0, dtype=tensor.dtype)
+
+        cached.tier = Tier.DISK
+
+    def _evict(
+        self, tier: Tier, budget_bytes: Optional[int], nbytes: int
+    ) -> List[Offload]:
+        """Demotes least recently used models out of tier until nbytes more fit in it."""
+
+        offloads = []
+
+        if budget_bytes is None:
+            return offloads
+
+        candidates = sorted(
+            (
+                cached
+                for cached in self.models.values()
+                if cached.tier == tier and cached.in_use == 0
+            ),
+            key=lambda cached: cached.last_used,
+        )
+
+        for cached in candidates:
+
+            if self.resident_bytes(tier) + nbytes <= budget_bytes:
+                break
+
+            start = time.perf_counter()
+
+            if tier == Tier.DEVICE:
+
+                offloads.extend(
+                    self._evict(Tier.HOST, self.host_budget_bytes, cached.nbytes)
+                )
+
+                self._to_host(cached)
+
+            elif self.snapshot_dir is not None:
+
+                self._to_disk(cached)
+
+            else:
+
+                del self.models[cached.model_key]
+
+            offloads.append(
+                Offload(
+                    model_key=cached.model_key,
+                    tier=cached.tier if cached.model_key in self.models else None,
+                    seconds=time.perf_counter() - start,
+                )
+            )
+
+        if self.resident_bytes(tier) + nbytes > budget_bytes:
+
+            raise MemoryError(
+                f"Not enough {tier.value} memory for the model: models in use hold "
+                f"{self.resident_bytes(tier)} of {budget_bytes} bytes."
+            )
+
+        return offloads
+
+    @contextmanager
+    def use(self, model_key: str) -> Iterator[CacheEvent]:
+        """Brings model_key onto the device and keeps it there until the context exits.
+
+        Yields:
+            CacheEvent: What it took, with the model in the cache's models.
+        """
+
+        with self._lock:
+
+            start = time.perf_counter()
+
+            event = CacheEvent(model_key=model_key)
+
+            cached = self.models.get(model_key)
+
+            if cached is None:
+
+                cached = CachedModel(model_key, self.load(model_key))
+
+                event.offloads.extend(
+                    self._evict(Tier.HOST, self.host_budget_bytes, cached.nbytes)
+                )
+
+                self.models[model_key] = cached
+
+            else:
+
+                event.tier = cached.tier
+
+            if cached.tier != Tier.DEVICE:
+
+                cached.in_use += 1
+
+                try:
+                    event.offloads.extend(
+                        self._evict(
+                            Tier.DEVICE, self.device_budget_bytes, cached.nbytes
+                        )
+                    )
+                    self._to_device(cached)
+                finally:
+                    cached.in_use -= 1
+
+                event.load_seconds = time.perf_counter() - start
+
+            cached.in_use += 1
+            cached.last_used = time.monotonic()
+
+        try:
+
+            yield event
+
+        finally:
+
+            with self._lock:
+
+                cached.in_use -= 1
+                cached.last_used = time.monotonic()
+
+    def get(self, model_key: str) -> RemoteableMixin:
+
+        return self.models[model_key].model
+
+    def status(self) -> Dict[str, Dict]:
+
+        return {
+            model_key: {
+                "tier": cached.tier.value,
+                "bytes": cached.nbytes,
+                "in_use": cached.in_use,
+            }
+            for model_key, cached in self.models.items()
+        }
@@ -0,0 +1,179 @@
+from typing import List, Literal, Tuple
+
+import torch
+from pydantic import BaseModel
+from torch.nn.utils import parametrize
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except:
+    pass
+
+
+class QuantizationArgs(BaseModel):
+
+    # Integer type the weights of linear layers are stored in.
+    dtype: Literal["int8", "int4"] = "int8"
+    # Input features sharing an int4 scale. int8 weights have a scale per output feature.
+    group_size: int = 128
+    # Linear layers kept in the compute dtype, by name or name suffix.
+    skip_modules: List[str] = ["lm_head"]
+
+
+class Int8Weight(torch.nn.Module):
+    """Parametrization of a weight stored as int8 with a scale per output feature.
+
+    Attributes:
+        dtype (torch.dtype): Compute dtype the weight is dequantized to.
+        transposed (bool): Whether the weight is (in, out), as Conv1D's, not (out, in).
+    """
+
+    def __init__(self, dtype: torch.dtype, transposed: bool = False) -> None:
+
+        super().__init__()
+
+        self.dtype = dtype
+        self.transposed = transposed
+
+    def right_inverse(self, weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+
+        if self.transposed:
+            weight = weight.t()
+
+        weight = weight.float()
+
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+
+        quantized = (weight / scale).round().clamp(-127, 127).to(torch.int8)
+
+        return quantized, scale.to(self.dtype)
+
+    def forward(self, quantized: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+
+        weight = quantized.to(self.dtype) * scale
+
+        return weight.t() if self.transposed else weight
+
+
+class Int4Weight(torch.nn.Module):
+    """Parametrization of a weight stored as int4, two to a byte, with a scale per
+    group_size input features of each output feature.
+
+    Attributes:
+        dtype (torch.dtype): Compute dtype the weight is dequantized to.
+        group_size (int): Input features sharing a scale.
+        transposed (bool): Whether the weight is (in, out), as Conv1D's, not (out, in).
+    """
+
+    def __init__(
+        self, dtype: torch.dtype, group_size: int, transposed: bool = False
+    ) -> None:
+
+        super().__init__()
+
+        self.dtype = dtype
+        self.group_size = group_size
+        self.transposed = transposed
+
+    def right_inverse(self, weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+
+        if self.transposed:
+            weight = weight.t()
+
+        out_features, in_features = weight.shape
+
+        weight = weight.float().reshape(out_features, -1, self.group_size)
+
+        scale = weight.abs().amax(dim=2, keepdim=True).clamp(min=1e-8) / 7
+
+        # Offset from [-8, 7] to [0, 15].
+        quantized = ((weight / scale).round().clamp(-8, 7) + 8).to(torch.uint8)
+        quantized = quantized.reshape(out_features, in_features)
+
+        packed = quantized[:, 0::2] | (quantized[:, 1::2] << 4)
+
+        return packed, scale.to(self.dtype)
+
+    def forward(self, packed: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+
+        out_features = packed.shape[0]
+
+        quantized = torch.stack([packed & 0xF, packed >> 4], dim=2)
+        quantized = quantized.reshape(out_features, -1, self.group_size)
+
+        weight = (quantized.to(self.dtype) - 8) * scale
+        weight = weight.reshape(out_features, -1)
+
+        return weight.t() if self.transposed else weight
+
+
+def quantize(model: torch.nn.Module, args: QuantizationArgs) -> List[str]:
+    """Stores the weights of model's linear layers (and transformers' Conv1D, as GPT-2's)
+    as args.dtype, in place.
+
+    The layers keep their modules, and their weight is dequantized to its dtype as it is
+    used, so module outputs, and what interventions see, stay in the compute dtype. Weights
+    shared with another module (tied embeddings) are left as they are, as are layers int4
+    groups don't divide.
+
+    Returns:
+        List[str]: Names of the layers quantized.
+    """
+
+    shared = set()
+    seen = set()
+
+    for _, parameter in model.named_parameters(remove_duplicate=False):
+
+        if id(parameter) in seen:
+            shared.add(id(parameter))
+
+        seen.add(id(parameter))
+
+    linear = (torch.nn.Linear,)
+
+    try:
+        linear = (torch.nn.Linear, Conv1D)
+    except NameError:
+        pass
+
+    quantized = []
+
+    for name, module in model.named_modules():
+
+        if not isinstance(module, linear):
+            continue
+
+        if any(name == skip or name.endswith(f".{skip}") for skip in args.skip_modules):
+            continue
+
+        if id(module.weight) in shared:
+            continue
+
+        transposed = not isinstance(module, torch.nn.Linear)
+
+        in_features = module.weight.shape[0 if transposed else 1]
+
+        if args.dtype == "int4":
+
+            if in_features % args.group_size or args.group_size % 2:
+                continue
+
+            parametrization = Int4Weight(
+                module.weight.dtype, args.group_size, transposed
+            )
+
+        else:
+
+            parametrization = Int8Weight(module.weight.dtype, transposed)
+
+        # Integer parameters can't require grad.
+        module.weight.requires_grad_(False)
+
+        parametrize.register_parametrization(
+            module, "weight", parametrization, unsafe=True
+        )
+
+        quantized.append(name)
+
+    return quantized
@@ -1,12 +1,20 @@
+import hashlib
+import json
+import logging
+import math
+import time
 import urllib.parse
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 try:
     from slugify import slugify
 except:
     pass
+import ray
 import yaml
 from pydantic import BaseModel
+from pymongo import MongoClient
+from ray import serve
 from ray.dashboard.modules.serve.sdk import ServeSubmissionClient
 from ray.serve.schema import (
     DeploymentSchema,
@@ -15,8 +23,27 @@ from ray.serve.schema import (
     ServeDeploySchema,
 )
 
+from . import autoscale
+from .continuous_batching import ContinuousBatchingArgs
 from .deployments.model import ModelDeploymentArgs
+from .deployments.multiplexed_model import MultiplexedModelDeploymentArgs
 from .deployments.request import RequestDeploymentArgs
+from .deployments.storage import StorageDeploymentArgs
+from .quantization import QuantizationArgs
+from .topology import island_resource
+
+# Deployment options Serve updates in place. Changing any other option, or an app's import
+# path or args, restarts the app's replicas.
+IN_PLACE_OPTIONS = (
+    "num_replicas",
+    "max_ongoing_requests",
+    "user_config",
+    "autoscaling_config",
+    "graceful_shutdown_wait_loop_s",
+    "graceful_shutdown_timeout_s",
+    "health_check_period_s",
+    "health_check_timeout_s",
+)
 
 
 class ServiceConfigurationSchema(BaseModel):
@@ -30,14 +57,63 @@ class ServiceConfigurationSchema(BaseModel):
         model_key: str
         num_replicas: int
 
+        # Replicas are scaled between these on queue demand when max_replicas is set,
+        # otherwise the model keeps num_replicas.
+        min_replicas: Optional[int] = None
+        max_replicas: Optional[int] = None
+
+        # Weight-only quantization of the model's linear layers. None serves it in the
+        # dtype of its model key. Distributed models can't be quantized.
+        quantization: Optional[QuantizationArgs] = None
+
+    class MultiplexedConfigurationSchema(BaseModel):
+
+        # App name suffix, Model:{name}.
+        name: str
+        model_keys: List[str]
+
+        model_import_path: str = "src.ray.deployments.multiplexed_model:app"
+
+        ray_actor_options: Dict[str, Any] = {"num_gpus": 1}
+        # Overrides of MultiplexedModelDeploymentArgs (memory budgets, snapshot_dir).
+        args: Dict[str, Any] = {}
+
+        num_replicas: int = 1
+
     default_model_import_path: str
     request_import_path: str
     request_num_replicas: int
+    # Overrides of RequestDeploymentArgs (cost estimate limits).
+    request_args: Dict[str, Any] = {}
+
+    storage_import_path: str = "src.ray.deployments.storage:app"
+    # Overrides of StorageDeploymentArgs (TTLs, quotas, sweep interval).
+    storage_args: Dict[str, Any] = {}
 
     models: List[ModelConfigurationSchema]
+    # Groups of models sharing a device, loaded on demand.
+    multiplexed_models: List[MultiplexedConfigurationSchema] = []
+
+    # Seconds between autoscaling decisions. None disables autoscaling and measuring.
+    autoscale_interval_seconds: Optional[float] = 30
+    # Queue a model's replicas should be able to drain within, in seconds of work.
+    target_queue_seconds: float = 60
+    # Approved jobs not updated for this long are not counted as queued.
+    queue_window_seconds: float = 3600
+    # Measured model sizes are multiplied by this for activations and the CUDA context.
+    memory_headroom: float = 1.25
+    # Seconds demand must stay low before a model is scaled down.
+    scale_down_delay_seconds: float = 300
 
 
 class RayState:
+    """Desired Serve config, built from the Ray and service config files and adjusted by
+    autoscaling, and its application to the cluster.
+
+    apply diffs the desired applications against the live ones and only submits a change
+    when one exists, resubmitting unchanged applications exactly as they are deployed so
+    Serve leaves their replicas alone.
+    """
 
     def __init__(
         self,
@@ -48,27 +124,281 @@ class RayState:
         api_url: str,
     ) -> None:
 
+        self.ray_config_path = ray_config_path
+        self.service_config_path = service_config_path
         self.ray_dashboard_url = ray_dashboard_url
         self.database_url = database_url
         self.api_url = api_url
 
-        with open(ray_config_path, "r") as file:
-            self.ray_config = ServeDeploySchema(**yaml.safe_load(file))
+        self.logger = logging.getLogger(__name__)
+
+        self.model_configs: Dict[
+            str, ServiceConfigurationSchema.ModelConfigurationSchema
+        ] = {}
+        self.model_deployments: Dict[str, DeploymentSchema] = {}
+
+        # Measured cuda_memory_MB per model key.
+        self.memory_MB: Dict[str, float] = {}
+        # When each model's desired replicas first fell below its current replicas.
+        self.scale_down_since: Dict[str, float] = {}
+
+        self.db_connection: Optional[MongoClient] = None
+
+        # Digest of the config files the desired state was built from.
+        self.config_digest: Optional[str] = None
+
+        # Whether replica counts of the live apps have been adopted (see adopt).
+        self.adopted = False
+
+        self.load()
+
+    def read_configs(self) -> Tuple[bytes, bytes]:
+
+        with open(self.ray_config_path, "rb") as file:
+            ray_config = file.read()
+
+        with open(self.service_config_path, "rb") as file:
+            service_config = file.read()
+
+        return ray_config, service_config
+
+    def config_changed(self) -> bool:
+        """Whether the config files changed since they were last loaded."""
+
+        return self.digest(*self.read_configs()) != self.config_digest
+
+    @staticmethod
+    def digest(*contents: bytes) -> str:
 
-        with open(service_config_path, "r") as file:
-            self.service_config = ServiceConfigurationSchema(**yaml.safe_load(file))
+        return hashlib.sha256(b"\0".join(contents)).hexdigest()
 
-        self.add_request_app()
+    def load(self) -> None:
+        """(Re)builds the desired state from the config files.
 
-        for model_config in self.service_config.models:
-            self.add_model_app(model_config)
+        Replica counts chosen by the autoscaler and the sizes models are deployed at carry
+        over, so a reload doesn't undo them.
+        """
 
-    def apply(self) -> None:
+        ray_config, service_config = self.read_configs()
 
-        ServeSubmissionClient(self.ray_dashboard_url).deploy_applications(
-            self.ray_config.dict(exclude_unset=True),
+        replicas = {
+            model_key: deployment.num_replicas
+            for model_key, deployment in self.model_deployments.items()
+        }
+        sizes = {
+            model_key: self.deployed_MB(model_key)
+            for model_key in self.model_deployments
+        }
+
+        previous = self.__dict__.copy()
+
+        try:
+
+            self.ray_config = ServeDeploySchema(**yaml.safe_load(ray_config))
+            self.service_config = ServiceConfigurationSchema(
+                **yaml.safe_load(service_config)
+            )
+
+            self.model_configs = {}
+            self.model_deployments = {}
+
+            # App name of each model key served by a multiplexed app.
+            self.model_apps: Dict[str, str] = {}
+
+            for model_config in self.service_config.models:
+                self.add_model_app(model_config)
+
+            for multiplexed_config in self.service_config.multiplexed_models:
+                self.add_multiplexed_app(multiplexed_config)
+
+            self.add_request_app()
+            self.add_storage_app()
+
+        # Keep serving the last valid config.
+        except Exception:
+
+            self.__dict__.update(previous)
+
+            raise
+
+        for model_key, deployment in self.model_deployments.items():
+
+            model_config = self.model_configs[model_key]
+
+            if model_config.max_replicas is not None and model_key in replicas:
+
+                deployment.num_replicas = max(
+                    self.min_replicas(model_config),
+                    min(model_config.max_replicas, replicas[model_key]),
+                )
+
+            if sizes.get(model_key) is not None:
+                self.set_memory_MB(model_key, sizes[model_key])
+
+        self.config_digest = self.digest(ray_config, service_config)
+
+    @staticmethod
+    def normalize(application: Dict[str, Any]) -> str:
+        """Canonical form of an application config, for comparison."""
+
+        return json.dumps(
+            ServeApplicationSchema(**application).dict(exclude_unset=True),
+            sort_keys=True,
+            default=str,
         )
 
+    def live_applications(
+        self, client: ServeSubmissionClient
+    ) -> Dict[str, Dict[str, Any]]:
+        """Configs of the applications Serve has deployed from a config, by name."""
+
+        details = client.get_serve_details()
+
+        return {
+            name: application["deployed_app_config"]
+            for name, application in details.get("applications", {}).items()
+            if application.get("deployed_app_config") is not None
+        }
+
+    def adopt(self, live: Dict[str, Dict[str, Any]]) -> None:
+        """Takes over the sizes models are deployed at and the replica counts of autoscaled
+        models from the live apps, so a restarted controller doesn't redeploy them at their
+        configured cuda_memory_MB and num_replicas.
+        """
+
+        for model_key, deployment in self.model_deployments.items():
+
+            model_config = self.model_configs[model_key]
+
+            application = live.get(f"Model:{slugify(model_key)}", {})
+
+            for live_deployment in application.get("deployments", []):
+
+                if live_deployment.get("name") != deployment.name:
+                    continue
+
+                ray_actor_options = live_deployment.get("ray_actor_options") or {}
+                memory_MB = (ray_actor_options.get("resources") or {}).get(
+                    "cuda_memory_MB"
+                )
+
+                if memory_MB is not None:
+                    self.set_memory_MB(model_key, memory_MB)
+
+                if (
+                    model_config.max_replicas is not None
+                    and live_deployment.get("num_replicas") is not None
+                ):
+
+                    deployment.num_replicas = max(
+                        self.min_replicas(model_config),
+                        min(model_config.max_replicas, live_deployment["num_replicas"]),
+                    )
+
+    def diff(self, live: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+        """Names of desired applications that are new or changed and of live applications
+        no longer desired."""
+
+        desired = {
+            application.name: application.dict(exclude_unset=True)
+            for application in self.ray_config.applications
+        }
+
+        return {
+            "added": [name for name in desired if name not in live],
+            "changed": [
+                name
+                for name in desired
+                if name in live
+                and self.normalize(desired[name]) != self.normalize(live[name])
+            ],
+            "removed": [name for name in live if name not in desired],
+        }
+
+    @classmethod
+    def restart_config(cls, application: Dict[str, Any]) -> str:
+        """Canonical form of the parts of an application config whose change restarts its
+        replicas."""
+
+        return cls.normalize(
+            {
+                **application,
+                "deployments": [
+                    {
+                        option: value
+                        for option, value in deployment.items()
+                        if option not in IN_PLACE_OPTIONS
+                    }
+                    for deployment in application.get("deployments", [])
+                ],
+            }
+        )
+
+    def apply(self) -> bool:
+        """Deploys the desired state if it differs from the live one.
+
+        Returns:
+            bool: Whether anything was deployed.
+        """
+
+        client = ServeSubmissionClient(self.ray_dashboard_url)
+
+        live = self.live_applications(client)
+
+        if not self.adopted:
+
+            try:
+                self.load_sizes()
+            except Exception as exception:
+                self.logger.warning(f"Cannot load measured model sizes: {exception}")
+
+            self.adopt(live)
+
+            self.adopted = True
+
+        desired = {
+            application.name: application.dict(exclude_unset=True)
+            for application in self.ray_config.applications
+        }
+
+        # Changing ray_actor_options restarts every replica, so measured sizes are only
+        # applied to model apps that are new or restarting anyway.
+        for model_key in self.model_deployments:
+
+            name = f"Model:{slugify(model_key)}"
+
+            if name not in live or self.restart_config(
+                desired[name]
+            ) != self.restart_config(live[name]):
+                self.resize(model_key)
+
+        diff = self.diff(live)
+
+        if not any(diff.values()):
+            return False
+
+        self.logger.info(
+            f"Applying Ray Serve config: added {diff['added']}, changed {diff['changed']}, "
+            f"removed {diff['removed']}."
+        )
+
+        unchanged = set(live) - set(diff["changed"]) - set(diff["removed"])
+
+        config = self.ray_config.dict(exclude_unset=True)
+
+        config["applications"] = [
+            (
+                live[application["name"]]
+                if application["name"] in unchanged
+                else application
+            )
+            for application in config["applications"]
+        ]
+
+        client.deploy_applications(config)
+
+        return True
+
     def add_request_app(self) -> None:
         application = ServeApplicationSchema(
             name="Request",
@@ -85,6 +415,27 @@ class RayState:
                 ray_dashboard_url=self.ray_dashboard_url,
                 api_url=self.api_url,
                 database_url=self.database_url,
+                model_apps=self.model_apps,
+                **self.service_config.request_args,
+            ).model_dump(),
+        )
+
+        self.ray_config.applications.append(application)
+
+    def add_storage_app(self) -> None:
+        application = ServeApplicationSchema(
+            name="Storage",
+            import_path=self.service_config.storage_import_path,
+            route_prefix="/storage",
+            deployments=[
+                DeploymentSchema(
+                    name="StorageDeployment",
+                    num_replicas=1,
+                    ray_actor_options=RayActorOptionsSchema(num_cpus=1),
+                )
+            ],
+            args=StorageDeploymentArgs(
+                database_url=self.database_url, **self.service_config.storage_args
             ).model_dump(),
         )
 
@@ -100,19 +451,310 @@ class RayState:
         model_config.args["api_url"] = self.api_url
         model_config.args["database_url"] = self.database_url
 
+        world_size = model_config.args.get("torch_distributed_world_size", 1)
+
+        # The tensor parallel plans shard the weights in bfloat16.
+        if world_size > 1 and (
+            model_config.quantization is not None
+            or model_config.args.get("quantization") is not None
+        ):
+            raise ValueError(
+                f"Cannot quantize {model_config.model_key}: distributed models "
+                "(torch_distributed_world_size > 1) don't support quantization."
+            )
+
+        if model_config.quantization is not None:
+            model_config.args["quantization"] = model_config.quantization.model_dump()
+
+        deployment = DeploymentSchema(
+            name="ModelDeployment",
+            num_replicas=model_config.num_replicas,
+            ray_actor_options=model_config.ray_actor_options,
+        )
+
+        continuous_batching = model_config.args.get("continuous_batching")
+
+        # Requests of a continuously batched model wait on its batch, so a replica takes as
+        # many as there can be sequences in it.
+        if continuous_batching is not None:
+            deployment.max_ongoing_requests = ContinuousBatchingArgs(
+                **continuous_batching
+            ).max_batch_size
+
+        if world_size > 1:
+            self.gang_schedule(deployment, model_config, world_size)
+
         application = ServeApplicationSchema(
             name=f"Model:{model_key}",
             import_path=model_config.model_import_path
             or self.service_config.default_model_import_path,
             route_prefix=f"/Model:{model_key}",
+            deployments=[deployment],
+            args=model_config.args,
+        )
+
+        self.model_configs[model_config.model_key] = model_config
+        self.model_deployments[model_config.model_key] = application.deployments[0]
+
+        self.ray_config.applications.append(application)
+
+    def gang_schedule(
+        self,
+        deployment: DeploymentSchema,
+        model_config: ServiceConfigurationSchema.ModelConfigurationSchema,
+        world_size: int,
+    ) -> None:
+        """Reserves a bundle per rank of a distributed model in one placement group per
+        replica, all on one node and, unless the model's require_island arg is false, on a
+        node with an NVLink island that fits them (see topology.resources)."""
+
+        ray_actor_options = {
+            "num_cpus": 1,
+            "num_gpus": 1,
+            **model_config.ray_actor_options,
+        }
+
+        bundles = [
+            {
+                "CPU": ray_actor_options["num_cpus"],
+                "GPU": ray_actor_options["num_gpus"],
+                **ray_actor_options.get("resources", {}),
+            }
+            for _ in range(world_size)
+        ]
+
+        if model_config.args.get("require_island", True):
+            bundles[0][island_resource(world_size)] = 1
+
+        deployment.ray_actor_options = RayActorOptionsSchema(**ray_actor_options)
+        deployment.placement_group_bundles = bundles
+        deployment.placement_group_strategy = "STRICT_PACK"
+
+    def add_multiplexed_app(
+        self,
+        multiplexed_config: ServiceConfigurationSchema.MultiplexedConfigurationSchema,
+    ) -> None:
+
+        name = f"Model:{slugify(multiplexed_config.name)}"
+
+        application = ServeApplicationSchema(
+            name=name,
+            import_path=multiplexed_config.model_import_path,
+            route_prefix=f"/{name}",
             deployments=[
                 DeploymentSchema(
-                    name="ModelDeployment",
-                    num_replicas=model_config.num_replicas,
-                    ray_actor_options=model_config.ray_actor_options,
+                    name="MultiplexedModelDeployment",
+                    num_replicas=multiplexed_config.num_replicas,
+                    ray_actor_options=multiplexed_config.ray_actor_options,
                 )
             ],
-            args=model_config.args,
+            args=MultiplexedModelDeploymentArgs(
+                model_keys=multiplexed_config.model_keys,
+                api_url=self.api_url,
+                database_url=self.database_url,
+                **multiplexed_config.args,
+            ).model_dump(),
         )
 
+        for model_key in multiplexed_config.model_keys:
+            self.model_apps[model_key] = name
+
         self.ray_config.applications.append(application)
+
+    def node_capacities_MB(self) -> List[float]:
+        """cuda_memory_MB of every alive node (see resources.py)."""
+
+        return [
+            node["Resources"].get("cuda_memory_MB", 0)
+            for node in ray.nodes()
+            if node["Alive"]
+        ]
+
+    def connect(self) -> MongoClient:
+
+        if self.db_connection is None:
+
+            self.db_connection = MongoClient(self.database_url)
+
+            autoscale.ensure_indexes(self.db_connection)
+
+        return self.db_connection
+
+    def memory_MB_of(self, size_GB: float) -> float:
+        """cuda_memory_MB a model of size_GB is deployed with."""
+
+        return math.ceil(size_GB * 1e3 * self.service_config.memory_headroom)
+
+    def load_sizes(self) -> None:
+        """Takes the model sizes measured by earlier controllers from model_stats."""
+
+        for model_key, size_GB in autoscale.load_sizes(self.connect()).items():
+
+            if model_key in self.model_configs:
+                self.memory_MB.setdefault(model_key, self.memory_MB_of(size_GB))
+
+    def measure_models(self) -> None:
+        """Asks the replicas of models not measured yet for their size.
+
+        Models whose app is not running yet, or whose deployment cannot report its size,
+        are skipped and keep their configured cuda_memory_MB.
+        """
+
+        for model_key in self.model_configs:
+
+            if model_key in self.memory_MB:
+                continue
+
+            try:
+
+                size_GB = (
+                    serve.get_app_handle(f"Model:{slugify(model_key)}")
+                    .model_size.remote()
+                    .result(timeout_s=10)
+                )
+
+            except Exception:
+                continue
+
+            self.memory_MB[model_key] = self.memory_MB_of(size_GB)
+
+            autoscale.record_size(self.connect(), model_key, size_GB)
+
+            self.logger.info(
+                f"Measured {model_key} at {self.memory_MB[model_key]:.0f} cuda_memory_MB."
+            )
+
+    def autoscale(self) -> bool:
+        """Measures model apps and scales them on queue demand, bin-packing replicas onto
+        the cluster's GPU memory. Measured sizes are deployed by apply.
+
+        Returns:
+            bool: Whether the config changed and needs to be applied.
+        """
+
+        self.connect()
+
+        self.measure_models()
+
+        demand = autoscale.load_demand(
+            self.db_connection, self.service_config.queue_window_seconds
+        )
+
+        minimum = {}
+        desired = {}
+
+        for model_key, model_config in self.model_configs.items():
+
+            if model_config.max_replicas is None:
+
+                minimum[model_key] = desired[model_key] = model_config.num_replicas
+
+                continue
+
+            minimum[model_key] = self.min_replicas(model_config)
+
+            desired[model_key] = autoscale.desired_replicas(
+                demand.get(model_key, autoscale.ModelDemand()),
+                self.service_config.target_queue_seconds,
+                minimum[model_key],
+                model_config.max_replicas,
+            )
+
+        replicas = autoscale.plan(
+            self.node_capacities_MB(), self.memory_MB, demand, minimum, desired
+        )
+
+        changed = False
+
+        now = time.monotonic()
+
+        for model_key, deployment in self.model_deployments.items():
+
+            target = replicas[model_key]
+
+            if target < deployment.num_replicas:
+
+                # Hold replicas through short lulls, reloading a model takes minutes.
+                since = self.scale_down_since.setdefault(model_key, now)
+
+                if now - since < self.service_config.scale_down_delay_seconds:
+                    target = deployment.num_replicas
+
+            else:
+
+                self.scale_down_since.pop(model_key, None)
+
+            if target != deployment.num_replicas:
+
+                self.logger.info(
+                    f"Scaling {model_key} from {deployment.num_replicas} to {target} replicas."
+                )
+
+                deployment.num_replicas = target
+
+                self.scale_down_since.pop(model_key, None)
+
+                changed = True
+
+        autoscale.record_replicas(
+            self.db_connection,
+            {
+                model_key: deployment.num_replicas
+                for model_key, deployment in self.model_deployments.items()
+            },
+        )
+
+        return changed
+
+    @staticmethod
+    def min_replicas(
+        model_config: ServiceConfigurationSchema.ModelConfigurationSchema,
+    ) -> int:
+
+        if model_config.min_replicas is not None:
+            return model_config.min_replicas
+
+        return model_config.num_replicas
+
+    def resize(self, model_key: str) -> bool:
+        """Sets the cuda_memory_MB of a model app to its measured size, once known.
+
+        Returns:
+            bool: Whether it changed.
+        """
+
+        memory_MB = self.memory_MB.get(model_key)
+
+        if memory_MB is None:
+            return False
+
+        return self.set_memory_MB(model_key, memory_MB)
+
+    def deployed_MB(self, model_key: str) -> Optional[float]:
+        """cuda_memory_MB a model app is deployed with, if set."""
+
+        ray_actor_options = self.model_deployments[model_key].ray_actor_options
+
+        return (ray_actor_options.resources or {}).get("cuda_memory_MB")
+
+    def set_memory_MB(self, model_key: str, memory_MB: float) -> bool:
+        """Sets the cuda_memory_MB of a model app.
+
+        Returns:
+            bool: Whether it changed.
+        """
+
+        deployment = self.model_deployments[model_key]
+
+        ray_actor_options = deployment.ray_actor_options.dict(exclude_unset=True)
+        resources = dict(ray_actor_options.get("resources", {}))
+
+        if resources.get("cuda_memory_MB") == memory_MB:
+            return False
+
+        resources["cuda_memory_MB"] = memory_MB
+        ray_actor_options["resources"] = resources
+
+        deployment.ray_actor_options = RayActorOptionsSchema(**ray_actor_options)
+
+        return True
@@ -1,18 +1,19 @@
 import json
 
-from .util import get_total_cudamemory_MBs
+from .topology import discover, resources
+
 
 def main(head: bool):
 
-    resources = {}
+    topology = discover()
+
+    node_resources = resources(topology)
 
     if head:
 
-        resources["head"] = 1
+        node_resources["head"] = 1
 
-    resources["cuda_memory_MB"] = get_total_cudamemory_MBs()
-        
-    print(json.dumps(resources))
+    print(json.dumps(node_resources))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+import asyncio
+import io
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy
+import ray
+from pydantic import BaseModel
+from pymongo import MongoClient
+
+from ..schema.Response import (
+    RESULT_HANDOFF_NAME,
+    RESULT_HANDOFF_NAMESPACE,
+    ResultModel,
+)
+from ..telemetry import metrics
+
+
+@ray.remote(num_cpus=0, max_restarts=-1)
+class ResultHandoff:
+    """Keeps serialized results in the Ray object store for the API to stream, so results
+    downloaded soon after they complete never go through Mongo.
+
+    The store owns the results' objects, so they outlive the replicas that put them. The API
+    reads results in chunks, each of which extends the result's expiry, so a result being
+    downloaded isn't expired under it. Results not read within ttl_seconds are written to
+    GridFS, where /result falls back to. Results in the store are lost if it dies before that.
+
+    Attributes:
+        database_url (str): Database results expire to.
+        ttl_seconds (float): How long results stay in the object store.
+        capacity_bytes (int): Most bytes of results held at once. Offers beyond it are rejected.
+    """
+
+    def __init__(self, database_url: str, ttl_seconds: float, capacity_bytes: int):
+
+        self.database_url = database_url
+        self.ttl_seconds = ttl_seconds
+        self.capacity_bytes = capacity_bytes
+
+        self.db_connection = MongoClient(self.database_url)
+
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.nbytes = 0
+
+        self.logger = logging.getLogger(__name__)
+
+        self._expiry = None
+
+    def reserve(self, id: str, nbytes: int) -> bool:
+        """Reserves room for a result of nbytes, before it is put into the object store."""
+
+        if self._expiry is None:
+            self._expiry = asyncio.get_event_loop().create_task(self.expire())
+
+        if self.nbytes + nbytes > self.capacity_bytes:
+            return False
+
+        self.nbytes += nbytes
+
+        self.results[id] = {
+            "nbytes": nbytes,
+            "refs": None,
+            "expires": time.monotonic() + self.ttl_seconds,
+        }
+
+        return True
+
+    def put(self, id: str, refs: List[ray.ObjectRef], metadata: Dict[str, Any]) -> None:
+        """Takes a result reserved with reserve. refs holds its one object, in a list so it
+        is passed by reference."""
+
+        self.results[id].update(
+            refs=refs, metadata=metadata, expires=time.monotonic() + self.ttl_seconds
+        )
+
+        metrics.RESULT_HANDOFF.inc("stored")
+
+    def release(self, id: str) -> None:
+        """Frees a reservation whose result was not put."""
+
+        result = self.results.pop(id, None)
+
+        if result is not None:
+            self.nbytes -= result["nbytes"]
+
+    def get(self, id: str) -> Optional[Dict[str, Any]]:
+        """The result's size and metadata, or None if the store doesn't hold it."""
+
+        result = self.results.get(id)
+
+        if result is None or result["refs"] is None:
+            return None
+
+        result["expires"] = time.monotonic() + self.ttl_seconds
+
+        return {"nbytes": result["nbytes"], "metadata": result["metadata"]}
+
+    async def read(self, id: str, start: int, stop: int) -> Optional[bytes]:
+        """Bytes start to stop of the result, or None if the store no longer holds it."""
+
+        result = self.results.get(id)
+
+        if result is None or result["refs"] is None:
+            return None
+
+        result["expires"] = time.monotonic() + self.ttl_seconds
+
+        # Mapped out of the object store once, and kept until the result is released.
+        if result.get("data") is None:
+            result["data"] = await result["refs"][0]
+
+        return result["data"][start:stop].tobytes()
+
+    def delete(self, id: str) -> None:
+        """Drops a result once downloaded."""
+
+        self.release(id)
+
+        metrics.RESULT_HANDOFF.inc("served")
+
+    async def expire(self) -> None:
+
+        while True:
+
+            await asyncio.sleep(max(1, self.ttl_seconds / 10))
+
+            now = time.monotonic()
+
+            expired = [
+                id for id, result in self.results.items() if result["expires"] <= now
+            ]
+
+            for id in expired:
+
+                result = self.results.get(id)
+
+                # Downloaded, or read again, while earlier results were written.
+                if result is None or result["expires"] > time.monotonic():
+                    continue
+
+                # Reserved by a replica that never put the result.
+                if result["refs"] is None:
+
+                    self.release(id)
+
+                    continue
+
+                try:
+
+                    # Written already, while a download that then stalled had started.
+                    if not result.get("persisted"):
+
+                        data = await result["refs"][0]
+
+                        await asyncio.to_thread(
+                            ResultModel.write,
+                            self.db_connection,
+                            id,
+                            data.tobytes(),
+                            result["metadata"],
+                        )
+
+                        result["persisted"] = True
+
+                        metrics.RESULT_HANDOFF.inc("persisted")
+
+                except Exception as exception:
+
+                    self.logger.exception(
+                        f"Failed to persist result `{id}`: {exception}"
+                    )
+
+                if self.results.get(id) is not result:
+
+                    # Downloaded while it was written, perhaps before the API deleted the
+                    # GridFS copy, which would then never be.
+                    await asyncio.to_thread(
+                        ResultModel.delete, self.db_connection, id, logger=self.logger
+                    )
+
+                elif result["expires"] <= time.monotonic():
+
+                    self.release(id)
+
+                # Otherwise the API started downloading it while it was written, and deletes
+                # the GridFS copy once done.
+
+    def status(self) -> Dict[str, int]:
+
+        return {"results": len(self.results), "bytes": self.nbytes}
+
+
+class ResultHandoffArgs(BaseModel):
+
+    ttl_seconds: float = 60
+    capacity_bytes: int = 8_000_000_000
+    min_bytes: int = 1_000_000
+
+
+class ResultHandoffClient:
+    """Offers results of a replica to the handoff store, creating it on first use.
+
+    Called as the handoff of ResponseModel.save.
+
+    Attributes:
+        min_bytes (int): Smaller results are written to GridFS directly, as round trips to
+            the store would cost more than they save.
+    """
+
+    def __init__(
+        self,
+        database_url: str,
+        ttl_seconds: float,
+        capacity_bytes: int,
+        min_bytes: int,
+    ) -> None:
+
+        self.database_url = database_url
+        self.ttl_seconds = ttl_seconds
+        self.capacity_bytes = capacity_bytes
+        self.min_bytes = min_bytes
+
+        self.logger = logging.getLogger(__name__)
+
+        self._store = None
+
+    @property
+    def store(self) -> ray.actor.ActorHandle:
+
+        if self._store is None:
+
+            self._store = ResultHandoff.options(
+                name=RESULT_HANDOFF_NAME,
+                namespace=RESULT_HANDOFF_NAMESPACE,
+                lifetime="detached",
+                get_if_exists=True,
+            ).remote(self.database_url, self.ttl_seconds, self.capacity_bytes)
+
+        return self._store
+
+    def __call__(self, id: str, buffer: io.BytesIO, metadata: Dict[str, Any]) -> bool:
+
+        nbytes = buffer.getbuffer().nbytes
+
+        if nbytes < self.min_bytes:
+            return False
+
+        try:
+
+            if not ray.get(self.store.reserve.remote(id, nbytes)):
+
+                metrics.RESULT_HANDOFF.inc("rejected")
+
+                return False
+
+            try:
+
+                # A numpy array is read back zero-copy out of the object store.
+                ref = ray.put(
+                    numpy.frombuffer(buffer.getbuffer(), dtype=numpy.uint8),
+                    _owner=self.store,
+                )
+
+                ray.get(self.store.put.remote(id, [ref], metadata))
+
+            except Exception:
+
+                self.store.release.remote(id)
+
+                raise
+
+        except Exception as exception:
+
+            self.logger.error(f"Failed to hand off result `{id}`: {exception}")
+
+            self._store = None
+
+            return False
+
+        return True
@@ -0,0 +1,91 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from pydantic import BaseModel
+
+from ..telemetry import metrics
+
+
+class ResultWriterArgs(BaseModel):
+
+    # Threads saving responses and notifying the API.
+    workers: int = 2
+    # Most responses waiting for or being written. Replicas wait for room beyond it.
+    max_pending: int = 8
+
+
+class ResultWriter:
+    """Saves the final responses of a replica's jobs and notifies the API of them from
+    background threads, so the replica starts its next job while results upload.
+
+    Writes are tracked by request id until done. When max_pending are in flight, submit
+    blocks until one finishes, which holds the replica back rather than letting results
+    pile up in host memory.
+
+    Attributes:
+        max_pending (int): Most writes waiting for or running on a worker.
+        pending (Dict[str, Future]): Write of each request id not done yet.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+
+        self.max_pending = max_pending
+
+        self.pending: Dict[str, Future] = {}
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="result-writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, id: str, write: Callable[[], None]) -> Future:
+        """Runs write in the background, waiting for room first."""
+
+        with metrics.RESULT_WRITER_WAIT.time():
+            self.slots.acquire()
+
+        with self.lock:
+
+            # In the submitter's context, so the write's spans are children of the job's.
+            future = self.executor.submit(
+                contextvars.copy_context().run, self.run, id, write
+            )
+
+            self.pending[id] = future
+
+        return future
+
+    def run(self, id: str, write: Callable[[], None]) -> None:
+
+        try:
+            write()
+        except Exception as exception:
+            self.logger.exception(f"Failed to write response of `{id}`: {exception}")
+        finally:
+
+            with self.lock:
+                self.pending.pop(id, None)
+
+            self.slots.release()
+
+    def wait(self, id: str, timeout: Optional[float] = None) -> bool:
+        """Waits for the write of a request. Returns whether it is done."""
+
+        with self.lock:
+            future = self.pending.get(id)
+
+        if future is None:
+            return True
+
+        wait([future], timeout)
+
+        return future.done()
+
+    def shutdown(self) -> None:
+        """Finishes the writes already submitted."""
+
+        self.executor.shutdown(wait=True)
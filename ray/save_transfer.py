@@ -0,0 +1,227 @@
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from pydantic import BaseModel
+
+from nnsight import util
+from nnsight.contexts.Tracer import Tracer
+from nnsight.tracing import protocols
+from nnsight.tracing.Node import Node
+
+from ..telemetry import metrics
+
+
+class SaveTransferArgs(BaseModel):
+
+    # Most bytes of pinned host memory saved values are copied into at once.
+    pinned_bytes: int = 4_000_000_000
+    # Directory values are spilled to when the pinned memory is taken. None uses the
+    # system's temporary directory.
+    spill_dir: Optional[str] = None
+    # Smaller values are left for postprocessing to copy.
+    min_bytes: int = 1_000_000
+
+
+class SaveTransferPool:
+    """Host memory saved values are copied into while requests execute, shared by the
+    requests of a replica.
+
+    Pinned tensors come from PyTorch's caching host allocator, which reuses freed blocks, so
+    the pool only accounts for them. Values that don't fit within pinned_bytes are spilled to
+    memory-mapped files in spill_dir instead, which are removed once the request's result is
+    saved.
+
+    Attributes:
+        pinned_bytes (int): Most bytes of pinned memory in use at once.
+        spill_dir (str): Directory of spilled values.
+        min_bytes (int): Smaller values are not transferred.
+    """
+
+    def __init__(
+        self,
+        pinned_bytes: int,
+        spill_dir: Optional[str] = None,
+        min_bytes: int = 1_000_000,
+    ) -> None:
+
+        self.pinned_bytes = pinned_bytes
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.min_bytes = min_bytes
+
+        self.used_bytes = 0
+
+        self.lock = threading.Lock()
+
+        # One copy stream per device, so copies run alongside the forward pass.
+        self.streams: Dict[torch.device, torch.cuda.Stream] = {}
+
+    def stream(self, device: torch.device) -> torch.cuda.Stream:
+
+        with self.lock:
+
+            if device not in self.streams:
+                self.streams[device] = torch.cuda.Stream(device)
+
+            return self.streams[device]
+
+    def reserve(self, nbytes: int) -> bool:
+
+        with self.lock:
+
+            if self.used_bytes + nbytes > self.pinned_bytes:
+                return False
+
+            self.used_bytes += nbytes
+
+            return True
+
+    def release(self, nbytes: int) -> None:
+
+        with self.lock:
+            self.used_bytes -= nbytes
+
+    def transfer(self, obj: Any) -> "SaveTransfer":
+
+        return SaveTransfer(self, obj)
+
+
+class SaveTransfer:
+    """Copies the saved values of one request to the host as they are produced.
+
+    Used as a context manager around execution. A saved value is copied at the first module
+    call after nothing else in the graph uses it, on a side stream, so the copy overlaps the
+    layers after it and the value no longer holds device memory until the end. Leaving the
+    context copies the rest and waits for all copies. release returns the memory to the pool
+    once the result has been saved.
+
+    Only tracers are transferred. Sessions are left for postprocessing to copy.
+    """
+
+    def __init__(self, pool: SaveTransferPool, obj: Any) -> None:
+
+        self.pool = pool
+
+        # Saved nodes, and how many locks save each.
+        self.saved: List[Tuple[Node, int]] = []
+
+        if isinstance(obj, Tracer):
+
+            for node in obj.graph.nodes.values():
+
+                locks = sum(
+                    listener.target is protocols.LockProtocol
+                    for listener in node.listeners
+                )
+
+                if locks:
+                    self.saved.append((node, locks))
+
+        self.reserved_bytes = 0
+        self.spilled: List[str] = []
+        self.streams: Dict[torch.device, torch.cuda.Stream] = {}
+
+        self._hook = None
+
+    def __enter__(self) -> "SaveTransfer":
+
+        if self.saved and torch.cuda.is_available():
+            self._hook = torch.nn.modules.module.register_module_forward_hook(
+                lambda module, input, output: self.poll()
+            )
+
+        return self
+
+    def __exit__(self, *exception) -> None:
+
+        if self._hook is not None:
+            self._hook.remove()
+
+        if exception[0] is None:
+            self.poll(finished=True)
+
+        for stream in self.streams.values():
+            stream.synchronize()
+
+    def poll(self, finished: bool = False) -> None:
+        """Starts copies of saved values that are ready."""
+
+        pending = []
+
+        for node, locks in self.saved:
+
+            # Values are final once only the locks saving them still listen.
+            if node.done() and (finished or node.remaining_listeners <= locks):
+                node._value = util.apply(node._value, self.copy, torch.Tensor)
+            else:
+                pending.append((node, locks))
+
+        self.saved = pending
+
+    def copy(self, tensor: torch.Tensor) -> torch.Tensor:
+
+        if tensor.device.type != "cuda" or tensor.nbytes < self.pool.min_bytes:
+            return tensor
+
+        tensor = tensor.detach()
+
+        if self.pool.reserve(tensor.nbytes):
+
+            self.reserved_bytes += tensor.nbytes
+
+            host = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+            )
+
+            stream = self.streams.get(tensor.device)
+
+            if stream is None:
+                stream = self.streams[tensor.device] = self.pool.stream(tensor.device)
+
+            stream.wait_stream(torch.cuda.current_stream(tensor.device))
+
+            with torch.cuda.stream(stream):
+                host.copy_(tensor, non_blocking=True)
+
+            # Keeps the device memory from being reused before the copy is done.
+            tensor.record_stream(stream)
+
+            metrics.SAVE_TRANSFER.inc("pinned", tensor.nbytes)
+
+            return host
+
+        path = os.path.join(self.pool.spill_dir, f"ndif-save-{uuid.uuid4().hex}")
+
+        self.spilled.append(path)
+
+        host = torch.from_file(
+            path, shared=True, size=tensor.numel(), dtype=tensor.dtype
+        ).view(tensor.shape)
+
+        host.copy_(tensor)
+
+        metrics.SAVE_TRANSFER.inc("spilled", tensor.nbytes)
+
+        return host
+
+    def release(self) -> None:
+        """Returns the request's pinned memory to the pool and removes its spill files."""
+
+        self.pool.release(self.reserved_bytes)
+
+        self.reserved_bytes = 0
+
+        for path in self.spilled:
+
+            try:
+                os.remove(path)
+            except OSError as exception:
+                logging.getLogger(__name__).warning(
+                    f"Failed to remove spilled value `{path}`: {exception}"
+                )
+
+        self.spilled = []
@@ -0,0 +1,236 @@
+import json
+import os
+import socket
+from typing import Dict, List, Optional
+
+import torch
+from pydantic import BaseModel
+
+try:
+    import pynvml
+except:
+    pass
+
+# JSON list of Device fields to report instead of the node's real GPUs, for testing placement
+# without GPUs. For example: [{"memory_MB": 81920, "peers": [1]}, {"memory_MB": 81920, "peers": [0]}]
+MOCK_DEVICES_ENV = "NDIF_MOCK_DEVICES"
+
+
+class Device(BaseModel):
+    """One GPU of the node.
+
+    Attributes:
+        index (int): CUDA index, in PCI bus order (CUDA_DEVICE_ORDER=PCI_BUS_ID).
+        memory_MB (int): Total memory.
+        peers (List[int]): Indices of devices reachable over a fast interconnect (NVLink).
+    """
+
+    index: int
+    memory_MB: int
+    peers: List[int] = []
+
+
+class Topology(BaseModel):
+    """GPUs of a node and the islands they form.
+
+    Attributes:
+        node_name (str): Hostname of the node.
+        devices (List[Device]): Every GPU.
+        islands (List[List[int]]): Device indices of each group connected by a fast
+            interconnect, largest first. GPUs without peers are islands of one.
+    """
+
+    node_name: str
+    devices: List[Device]
+    islands: List[List[int]]
+
+
+def _nvlink_peers(count: int) -> Optional[List[List[int]]]:
+
+    try:
+
+        pynvml.nvmlInit()
+
+        handles = [pynvml.nvmlDeviceGetHandleByIndex(index) for index in range(count)]
+
+        return [
+            [
+                peer
+                for peer in range(count)
+                if peer != index
+                and pynvml.nvmlDeviceGetP2PStatus(
+                    handles[index], handles[peer], pynvml.NVML_P2P_CAPS_INDEX_NVLINK
+                )
+                == pynvml.NVML_P2P_STATUS_OK
+            ]
+            for index in range(count)
+        ]
+
+    except Exception:
+        return None
+
+
+def enumerate_devices() -> List[Device]:
+    """GPUs of this node, or those in NDIF_MOCK_DEVICES when it is set.
+
+    NVLink peers come from NVML. Without it, peer-to-peer capable devices (which may be
+    connected through PCIe only) are treated as peers.
+    """
+
+    if MOCK_DEVICES_ENV in os.environ:
+
+        return [
+            Device(index=index, **device)
+            for index, device in enumerate(json.loads(os.environ[MOCK_DEVICES_ENV]))
+        ]
+
+    devices = []
+
+    count = torch.cuda.device_count()
+
+    peers = _nvlink_peers(count)
+
+    for index in range(count):
+
+        try:
+            memory_MB = int(torch.cuda.mem_get_info(index)[1] * 1e-6)
+        except:
+            continue
+
+        devices.append(
+            Device(
+                index=index,
+                memory_MB=memory_MB,
+                peers=(
+                    peers[index]
+                    if peers is not None
+                    else [
+                        peer
+                        for peer in range(count)
+                        if peer != index
+                        and torch.cuda.can_device_access_peer(index, peer)
+                    ]
+                ),
+            )
+        )
+
+    return devices
+
+
+def find_islands(devices: List[Device]) -> List[List[int]]:
+    """Connected components of the peer graph, largest first."""
+
+    indices = {device.index for device in devices}
+    peers = {device.index: set(device.peers) & indices for device in devices}
+
+    islands = []
+    seen = set()
+
+    for device in devices:
+
+        if device.index in seen:
+            continue
+
+        island = []
+        stack = [device.index]
+
+        seen.add(device.index)
+
+        while stack:
+
+            index = stack.pop()
+
+            island.append(index)
+
+            for peer in peers[index]:
+
+                if peer not in seen:
+
+                    seen.add(peer)
+                    stack.append(peer)
+
+        islands.append(sorted(island))
+
+    return sorted(islands, key=lambda island: (-len(island), island[0]))
+
+
+def discover(devices: Optional[List[Device]] = None) -> Topology:
+
+    if devices is None:
+        devices = enumerate_devices()
+
+    return Topology(
+        node_name=socket.gethostname(),
+        devices=devices,
+        islands=find_islands(devices),
+    )
+
+
+def island_resource(size: int) -> str:
+    """Resource counting the groups of size GPUs a node can place within single islands."""
+
+    return f"cuda_island_{size}"
+
+
+def resources(topology: Topology) -> Dict[str, float]:
+    """Ray resources describing the topology.
+
+    cuda_memory_MB is the memory of all GPUs. cuda_device_memory_MB is the memory of the
+    smallest GPU, so it is the per-device memory any GPU of the node provides. For every
+    group size up to the largest island, cuda_island_{size} is how many disjoint groups of
+    that size fit inside islands, so a tensor-parallel group requesting one lands on a node
+    where it can run over NVLink. ndif_node:{name} identifies the node.
+    """
+
+    resources = {
+        f"ndif_node:{topology.node_name}": 1,
+        "cuda_memory_MB": sum(device.memory_MB for device in topology.devices),
+        "cuda_devices": len(topology.devices),
+    }
+
+    if topology.devices:
+
+        resources["cuda_device_memory_MB"] = min(
+            device.memory_MB for device in topology.devices
+        )
+
+    for size in range(1, max(map(len, topology.islands), default=0) + 1):
+
+        resources[island_resource(size)] = sum(
+            len(island) // size for island in topology.islands
+        )
+
+    return resources
+
+
+def within_island(indices: List[int]) -> Optional[bool]:
+    """Whether the devices of this node at indices are within one island, or None if NVML
+    isn't available.
+
+    Peers are read from NVML (or NDIF_MOCK_DEVICES), which sees every device of the node
+    even in processes whose CUDA_VISIBLE_DEVICES hides the others.
+    """
+
+    if MOCK_DEVICES_ENV in os.environ:
+
+        devices = enumerate_devices()
+
+    else:
+
+        try:
+            pynvml.nvmlInit()
+            count = pynvml.nvmlDeviceGetCount()
+        except Exception:
+            return None
+
+        peers = _nvlink_peers(count)
+
+        if peers is None:
+            return None
+
+        devices = [
+            Device(index=index, memory_MB=0, peers=peers[index])
+            for index in range(count)
+        ]
+
+    return any(set(indices) <= set(island) for island in find_islands(devices))
@@ -1,5 +1,12 @@
 import torch
 import os
+from typing import Optional
+
+try:
+    from accelerate import dispatch_model, infer_auto_device_map
+    from accelerate.utils import get_balanced_memory
+except:
+    pass
 
 
 def get_total_cudamemory_MBs(return_ids=False) -> int:
@@ -23,12 +30,47 @@ def get_total_cudamemory_MBs(return_ids=False) -> int:
     return int(cudamemory)
 
 
+def get_free_cudamemory_bytes() -> Optional[int]:
+    """Memory of the visible GPUs not reserved by this process, or None without GPUs."""
+
+    if not torch.cuda.is_available():
+        return None
+
+    return sum(
+        torch.cuda.mem_get_info(device)[1] - torch.cuda.memory_reserved(device)
+        for device in range(torch.cuda.device_count())
+    )
+
+
 def set_cuda_env_var(ids = None):
     
-    del os.environ["CUDA_VISIBLE_DEVICES"]
+    os.environ.pop("CUDA_VISIBLE_DEVICES", None)
     
     if ids == None:
         
         _, ids = get_total_cudamemory_MBs(return_ids=True)
 
     os.environ["CUDA_VISIBLE_DEVICES"] = ",".join([str(x) for x in ids])
+
+
+def dispatch_across_gpus(module: torch.nn.Module) -> torch.nn.Module:
+    """Dispatches a model loaded on the CPU across the visible GPUs, balanced as
+    from_pretrained's device_map="auto". Without GPUs it stays on the CPU."""
+
+    if not torch.cuda.is_available():
+        return module
+
+    no_split_module_classes = getattr(module, "_no_split_modules", None)
+
+    max_memory = get_balanced_memory(
+        module, no_split_module_classes=no_split_module_classes
+    )
+
+    return dispatch_model(
+        module,
+        infer_auto_device_map(
+            module,
+            max_memory=max_memory,
+            no_split_module_classes=no_split_module_classes,
+        ),
+    )
@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import Dict, List
+
+import torch
+from nnsight.models.mixins import GenerationMixin, RemoteableMixin
+from pydantic import BaseModel
+
+from ..telemetry import metrics
+
+
+class WarmupArgs(BaseModel):
+
+    # Sequences per synthetic request.
+    batch_sizes: List[int] = [1, 8]
+    # Prompt lengths, in tokens, of the synthetic requests.
+    prompt_tokens: List[int] = [32, 512]
+    # Tokens the synthetic generate requests decode. 0 only traces.
+    max_new_tokens: int = 8
+    # Times each shape is run. The first pays for the cold start.
+    iterations: int = 2
+
+
+def warm_up(
+    model: RemoteableMixin, model_key: str, args: WarmupArgs
+) -> Dict[str, float]:
+    """Runs synthetic trace and generate requests of each shape in args through a replica's
+    model before it takes real ones, so they don't pay for creating the CUDA context,
+    growing the allocator, autotuning kernels or nnsight's first calls.
+
+    Prompts are drawn from a fixed seed, so the ranks of a distributed model run the same
+    requests and meet at the same collectives. Latencies of the last iteration are
+    observed by ndif_warmup_seconds.
+
+    Returns:
+        Dict[str, float]: Latency of the first and last iteration of each request, in
+            seconds, keyed like "trace 8x512 warm".
+    """
+
+    logger = logging.getLogger(__name__)
+
+    vocab_size = getattr(getattr(model._model, "config", None), "vocab_size", None)
+
+    # Prompts are token ids, so only language models are warmed up.
+    if vocab_size is None:
+
+        logger.info(f"Not warming up `{model_key}`, it has no vocabulary.")
+
+        return {}
+
+    generator = torch.Generator().manual_seed(0)
+
+    latencies = {}
+
+    for batch_size in args.batch_sizes:
+        for prompt_tokens in args.prompt_tokens:
+
+            shape = f"{batch_size}x{prompt_tokens}"
+
+            try:
+
+                # On the CPU like the generator, whatever the default device is. Distributed
+                # models set theirs to the rank's GPU.
+                input_ids = torch.randint(
+                    vocab_size,
+                    (batch_size, prompt_tokens),
+                    generator=generator,
+                    device="cpu",
+                )
+
+                inputs = {
+                    "input_ids": input_ids,
+                    "attention_mask": torch.ones_like(input_ids),
+                }
+
+                requests = {"trace": lambda: model.trace(inputs)}
+
+                if args.max_new_tokens > 0 and isinstance(model, GenerationMixin):
+                    requests["generate"] = lambda: model.generate(
+                        inputs, max_new_tokens=args.max_new_tokens
+                    )
+
+                for name, request in requests.items():
+
+                    name = f"{name} {shape}"
+
+                    for iteration in range(args.iterations):
+
+                        start = time.perf_counter()
+
+                        # Nothing is saved, so the logits of large prompts aren't kept.
+                        with request():
+                            pass
+
+                        if torch.cuda.is_available():
+                            torch.cuda.synchronize()
+
+                        seconds = time.perf_counter() - start
+
+                        if iteration == 0:
+                            latencies[f"{name} cold"] = seconds
+
+                    latencies[f"{name} warm"] = seconds
+
+                    metrics.WARMUP.observe(seconds, model_key=model_key)
+
+            except Exception as exception:
+
+                logger.warning(f"Warmup {shape} of `{model_key}` failed: {exception}")
+
+    logger.info(f"Warmed up `{model_key}`: {latencies}")
+
+    return latencies
@@ -0,0 +1,285 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+from glob import glob
+from typing import Dict, List, Optional
+
+import torch
+from pydantic import BaseModel
+
+try:
+    from slugify import slugify
+except:
+    pass
+
+try:
+    from accelerate.utils import set_module_tensor_to_device
+except:
+    pass
+
+from nnsight.models.mixins import RemoteableMixin
+
+from .util import dispatch_across_gpus
+
+# Options of a model key that change its weights. Model keys differing only in others share a
+# snapshot.
+WEIGHT_OPTIONS = ("revision", "torch_dtype")
+
+
+class WeightCacheArgs(BaseModel):
+
+    # Directory the replicas of a node share snapshots in. On a tmpfs (/dev/shm) snapshots
+    # are in shared memory, on a local disk in its page cache. Either way, replicas map the
+    # same pages.
+    directory: str = "/dev/shm/ndif-weights"
+    # Most bytes of snapshots kept in directory. None is bounded by its free space only.
+    max_bytes: Optional[int] = None
+
+
+class WeightCache:
+    """Snapshots of model weights shared by the replicas of a node.
+
+    The first replica to load a checkpoint saves its weights to a snapshot in directory.
+    Every replica then builds its model on the meta device and points its parameters and
+    buffers at the memory-mapped snapshot, so the weights are in host memory once per node
+    however many replicas hold them, and a replica starting next to another loads at the
+    speed of mapping pages rather than of reading the checkpoint.
+
+    Replicas hold a shared lock on the snapshots they use for as long as they live.
+    Snapshots are written under an exclusive lock, so replicas starting together write each
+    once, and to make room for a new one, the least recently used snapshots no replica
+    holds are removed.
+
+    Attributes:
+        directory (str): Directory of the snapshots.
+        max_bytes (Optional[int]): Most bytes of snapshots kept.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None) -> None:
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Open lock files of the snapshots this process uses. Closing them releases the locks.
+        self.locks: List[int] = []
+
+        self.logger = logging.getLogger(__name__)
+
+    def snapshot_path(self, model_key: str, model: RemoteableMixin) -> str:
+        """Path of the snapshot of a model key's weights: those of its checkpoint, in the
+        dtype and at the revision it is loaded with."""
+
+        options = model_key.split(":", 1)[-1]
+
+        try:
+            options = json.loads(options)
+        except ValueError:
+            options = {}
+
+        if not isinstance(options, dict):
+            options = {}
+
+        config = getattr(model._model, "config", None)
+
+        checkpoint = getattr(config, "_name_or_path", None) or options.get(
+            "repo_id", model_key
+        )
+
+        name = slugify(
+            " ".join(
+                [checkpoint] + [str(options.get(option)) for option in WEIGHT_OPTIONS]
+            )
+        )
+
+        return os.path.join(self.directory, f"{name}.pt")
+
+    def load(self, model_key: str, device_map: Optional[str] = None) -> RemoteableMixin:
+        """Builds the model of model_key from its snapshot, saving it first if no replica of
+        the node has.
+
+        Args:
+            device_map (Optional[str]): "auto" dispatches the model across the visible GPUs,
+                as from_pretrained does. None leaves its weights in the snapshot.
+        """
+
+        # Only the model's structure, on the meta device.
+        model = RemoteableMixin.from_model_key(model_key)
+
+        path = self.snapshot_path(model_key, model)
+
+        # Held shared for as long as this replica lives, which keeps the snapshot from being
+        # removed.
+        lock = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT)
+
+        try:
+
+            fcntl.flock(lock, fcntl.LOCK_SH)
+
+            if not os.path.exists(path) and not self.write(model, path):
+
+                os.close(lock)
+
+                return self.dispatch(model, device_map)
+
+        except BaseException:
+
+            os.close(lock)
+
+            raise
+
+        self.locks.append(lock)
+
+        # Recently used snapshots are removed last.
+        os.utime(path)
+
+        snapshot: Dict[str, torch.Tensor] = torch.load(
+            path, mmap=True, weights_only=True
+        )
+
+        module: torch.nn.Module = model._model
+
+        for name, tensor in snapshot.items():
+            set_module_tensor_to_device(
+                module, name, "cpu", value=tensor, dtype=tensor.dtype
+            )
+
+        # Tied weights were assigned separately. Tying them again lets dispatch place them once.
+        if hasattr(module, "tie_weights"):
+            module.tie_weights()
+
+        # Built from its config, the model is still in training mode, unlike from_pretrained's.
+        module.eval()
+
+        model._dispatched = True
+
+        return self.dispatch(model, device_map)
+
+    def write(self, model: RemoteableMixin, path: str) -> bool:
+        """Saves the snapshot at path unless another replica did first. Replicas starting
+        together take turns, so the first saves it and the others find it.
+
+        Returns:
+            bool: Whether the snapshot exists.
+        """
+
+        # Apart from the lock replicas hold the snapshot with, which would keep out every
+        # replica after the first.
+        lock = os.open(f"{path}.write.lock", os.O_RDWR | os.O_CREAT)
+
+        try:
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            return os.path.exists(path) or self.save(model, path)
+
+        finally:
+            os.close(lock)
+
+    def save(self, model: RemoteableMixin, path: str) -> bool:
+        """Loads the model's weights and saves them to path.
+
+        Returns:
+            bool: Whether it was saved. If not, the model keeps its own copy of the weights.
+        """
+
+        model.dispatch_model()
+
+        module: torch.nn.Module = model._model
+
+        tensors = {
+            **dict(module.named_parameters(remove_duplicate=False)),
+            **dict(module.named_buffers(remove_duplicate=False)),
+        }
+
+        # Tied weights share storage, which is saved once.
+        nbytes = sum(
+            {
+                tensor.untyped_storage().data_ptr(): tensor.untyped_storage().nbytes()
+                for tensor in tensors.values()
+            }.values()
+        )
+
+        if not self.make_room(nbytes):
+
+            self.logger.warning(
+                f"No room for a {nbytes} byte snapshot in `{self.directory}`, loading "
+                "without it."
+            )
+
+            return False
+
+        # Written aside and renamed, so no replica maps a partial snapshot.
+        partial = f"{path}.{os.getpid()}.partial"
+
+        try:
+            torch.save({name: tensor.data for name, tensor in tensors.items()}, partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        return True
+
+    def make_room(self, nbytes: int) -> bool:
+        """Removes the least recently used snapshots no replica holds until nbytes more fit.
+
+        Returns:
+            bool: Whether they fit.
+        """
+
+        snapshots = sorted(
+            glob(os.path.join(self.directory, "*.pt")), key=os.path.getmtime
+        )
+
+        for path in snapshots:
+
+            if self.fits(nbytes):
+                return True
+
+            lock = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT)
+
+            try:
+
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                os.remove(path)
+
+                self.logger.info(f"Removed snapshot `{path}`.")
+
+            except BlockingIOError:
+                pass
+
+            finally:
+                os.close(lock)
+
+        return self.fits(nbytes)
+
+    def fits(self, nbytes: int) -> bool:
+
+        if shutil.disk_usage(self.directory).free < nbytes:
+            return False
+
+        if self.max_bytes is None:
+            return True
+
+        used = sum(
+            os.path.getsize(path) for path in glob(os.path.join(self.directory, "*.pt"))
+        )
+
+        return used + nbytes <= self.max_bytes
+
+    def dispatch(
+        self, model: RemoteableMixin, device_map: Optional[str]
+    ) -> RemoteableMixin:
+
+        if not model._dispatched:
+            model.dispatch_model()
+
+        if device_map == "auto":
+            model._model = dispatch_across_gpus(model._model)
+
+        return model
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import gzip
+import io
+from typing import Any, Dict, Optional, Union
+
+import gridfs
+import torch
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+from nnsight.schema.format.types import (
+    SessionModel,
+    SessionType,
+    TensorModel,
+    TracerModel,
+    TracerType,
+)
+from nnsight.schema.Request import RequestModel as _RequestModel
+
+try:
+    import msgpack
+except:
+    pass
+
+try:
+    import zstandard
+except:
+    pass
+
+# msgpack extension type of tensors in binary requests.
+TENSOR_EXT_TYPE = 1
+
+# Content-Encodings binary requests may be submitted with.
+ENCODINGS = ("identity", "gzip", "zstd")
+
+# Most bytes a compressed binary request may decompress to.
+MAX_DECOMPRESSED_BYTES = 4 * 1024**3
+# Bytes decompressed at a time.
+DECOMPRESS_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def _pack_tensor(tensor: Dict[str, Any]) -> msgpack.ExtType:
+
+    value = torch.tensor(tensor["values"], dtype=getattr(torch, tensor["dtype"]))
+
+    data = value.reshape(-1).view(torch.uint8).numpy().tobytes()
+
+    return msgpack.ExtType(
+        TENSOR_EXT_TYPE, msgpack.packb([tensor["dtype"], list(value.shape), data])
+    )
+
+
+def _unpack_tensor(code: int, data: bytes) -> Any:
+
+    if code != TENSOR_EXT_TYPE:
+        return msgpack.ExtType(code, data)
+
+    dtype, shape, data = msgpack.unpackb(data)
+
+    if data:
+        value = torch.frombuffer(bytearray(data), dtype=getattr(torch, dtype))
+    else:
+        value = torch.empty(0, dtype=getattr(torch, dtype))
+
+    # Validation passes model instances through as is, so the tensor is never turned into lists.
+    return TensorModel.model_construct(values=value.reshape(shape), dtype=dtype)
+
+
+def _to_binary(value: Any) -> Any:
+
+    if isinstance(value, dict):
+
+        if value.get("type_name") == "TENSOR":
+            return _pack_tensor(value)
+
+        return {key: _to_binary(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [_to_binary(item) for item in value]
+
+    return value
+
+
+class RequestModel(_RequestModel):
+
+    # None while the object is staged (see stage).
+    object: Optional[Union[SessionType, TracerType, SessionModel, TracerModel]] = None
+
+    # W3C trace context of the stage that last handled this request.
+    trace_context: Optional[Dict[str, str]] = None
+
+    # Hash of the API key the request was submitted with, to record its usage against.
+    key_id: Optional[str] = None
+
+    # Longest the key's requests may execute for, in seconds. Set by the server only.
+    max_execution_seconds: Optional[float] = None
+
+    # Whether the object was submitted in binary form and waits in the staging store.
+    staged: bool = False
+
+    # FLOPs the object is estimated to take (see ray/cost.py), to calibrate estimates with.
+    estimated_flops: Optional[float] = None
+
+    def pack(self, encoding: str = "identity") -> bytes:
+        """Encodes the object in the binary request format: msgpack with tensors as raw
+        bytes, compressed according to encoding (a Content-Encoding)."""
+
+        data = msgpack.packb(_to_binary(self.model_dump(include=["object"])["object"]))
+
+        if encoding == "gzip":
+            return gzip.compress(data)
+
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+
+        return data
+
+    @classmethod
+    def unpack(
+        cls,
+        data: bytes,
+        encoding: str = "identity",
+        max_bytes: int = MAX_DECOMPRESSED_BYTES,
+    ) -> Dict[str, Any]:
+        """Decodes an object encoded by pack.
+
+        Raises:
+            ValueError: If the object decompresses to more than max_bytes.
+        """
+
+        if encoding == "gzip":
+            data = cls.decompress(gzip.GzipFile(fileobj=io.BytesIO(data)), max_bytes)
+
+        elif encoding == "zstd":
+            data = cls.decompress(
+                zstandard.ZstdDecompressor().stream_reader(
+                    data, read_across_frames=True
+                ),
+                max_bytes,
+            )
+
+        return msgpack.unpackb(data, ext_hook=_unpack_tensor)
+
+    @staticmethod
+    def decompress(reader: io.RawIOBase, max_bytes: int) -> bytearray:
+        """Reads a decompressing stream to its end, a chunk at a time, so an object that
+        decompresses to more than max_bytes is rejected without being decompressed whole.
+        """
+
+        data = bytearray()
+
+        with reader:
+
+            while True:
+
+                chunk = reader.read(
+                    min(DECOMPRESS_CHUNK_BYTES, max_bytes - len(data) + 1)
+                )
+
+                if not chunk:
+                    break
+
+                data += chunk
+
+                if len(data) > max_bytes:
+                    raise ValueError(
+                        f"Request object decompresses to more than {max_bytes} bytes."
+                    )
+
+        return data
+
+    @staticmethod
+    def _staging(client: MongoClient) -> gridfs.GridFS:
+
+        return gridfs.GridFS(client["ndif_database"], collection="requests")
+
+    def stage(self, client: MongoClient, encoding: str = "identity") -> gridfs.GridIn:
+        """Opens the staging file of this request's binary object for writing.
+
+        Returns:
+            gridfs.GridIn: File to write the encoded object to and close.
+        """
+
+        self.staged = True
+
+        return self._staging(client).new_file(
+            _id=ObjectId(self.id), metadata={"encoding": encoding}
+        )
+
+    def unstage(self, client: MongoClient) -> RequestModel:
+        """Loads, decodes and deletes the staged object.
+
+        Returns:
+            RequestModel: Copy of this request carrying the object.
+        """
+
+        staging = self._staging(client)
+
+        id = ObjectId(self.id)
+
+        try:
+
+            gridout = staging.get(id)
+
+            object = self.unpack(gridout.read(), gridout.metadata["encoding"])
+
+        finally:
+
+            staging.delete(id)
+
+        return RequestModel(
+            **self.model_dump(exclude=["object", "staged"], exclude_none=True),
+            object=object,
+        )
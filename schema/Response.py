@@ -2,20 +2,37 @@ from __future__ import annotations
 
 import io
 import logging
-from typing import Any, Dict, List, Union
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Union
 
 import gridfs
 import requests
 import torch
 from bson.objectid import ObjectId
-from pydantic import field_serializer
+from pydantic import Field, field_serializer
 from pymongo import MongoClient
 
 from nnsight.schema.Response import ResponseModel as _ResponseModel
 from nnsight.schema.Response import ResultModel as _ResultModel
 
+from ..telemetry import metrics, tracing
 
-class ResultModel(_ResultModel):    
+# Named actor holding results handed off through the Ray object store (ray/result_handoff.py).
+RESULT_HANDOFF_NAME = "ResultHandoff"
+RESULT_HANDOFF_NAMESPACE = "ndif"
+
+# Reasons of jobs stopped before they finished (see ray/job_control.py).
+CANCELLED = "CANCELLED"
+TIMEOUT = "TIMEOUT"
+
+# Statuses of jobs no replica has started yet.
+QUEUED_STATUSES = [
+    _ResponseModel.JobStatus.RECEIVED,
+    _ResponseModel.JobStatus.APPROVED,
+]
+
+
+class ResultModel(_ResultModel):
 
     @classmethod
     def load(cls, client: MongoClient, id: str, stream: bool = False) -> ResultModel:
@@ -32,7 +49,6 @@ class ResultModel(_ResultModel):
 
         return result
 
-
     @classmethod
     def delete(
         cls, client: MongoClient, id: str, logger: logging.Logger = None
@@ -50,26 +66,79 @@ class ResultModel(_ResultModel):
 
             logger.info(f"DELETED Result: {id}")
 
-    def save(self, client: MongoClient) -> ResultModel:
+    def serialize(self, model_key: str = None) -> io.BytesIO:
+
+        with metrics.RESULT_SERIALIZE.time(model_key), tracing.span("result.serialize"):
+            buffer = io.BytesIO()
+            torch.save(self.model_dump(), buffer)
+            buffer.seek(0)
+
+        metrics.RESULT_BYTES.observe(buffer.getbuffer().nbytes, model_key)
+
+        return buffer
+
+    @classmethod
+    def write(
+        cls,
+        client: MongoClient,
+        id: str,
+        data: Union[io.BytesIO, bytes],
+        metadata: Dict[str, Any] = None,
+    ) -> None:
+        """Writes a serialized result to GridFS."""
+
         results_collection = gridfs.GridFS(
             client["ndif_database"], collection="results"
         )
 
-        id = ObjectId(self.id)
+        metadata = metadata or {}
+
+        id = ObjectId(id)
 
         results_collection.delete(id)
 
-        buffer = io.BytesIO()
-        torch.save(self.model_dump(), buffer)
-        buffer.seek(0)
+        nbytes = data.getbuffer().nbytes if isinstance(data, io.BytesIO) else len(data)
+
+        with metrics.RESULT_WRITE.time(metadata.get("model_key")), tracing.span(
+            "result.write", bytes=nbytes
+        ):
+            results_collection.put(data, _id=id, metadata=metadata)
+
+    def save(
+        self,
+        client: MongoClient,
+        metadata: Dict[str, Any] = None,
+        handoff: Callable[[str, io.BytesIO, Dict[str, Any]], bool] = None,
+    ) -> ResultModel:
+        """Serializes and stores the result.
+
+        Args:
+            handoff (Callable[[str, io.BytesIO, Dict[str, Any]], bool], optional): Offered the
+                serialized result first; when it accepts, the result is not written to GridFS.
+        """
+
+        metadata = metadata or {}
 
-        results_collection.put(buffer, _id=id)
+        buffer = self.serialize(metadata.get("model_key"))
+
+        if handoff is None or not handoff(self.id, buffer, metadata):
+            self.write(client, self.id, buffer, metadata)
 
         return self
 
 
 class ResponseModel(_ResponseModel):
 
+    model_key: Optional[str] = None
+
+    # Hash of the submitting API key. Stored with the response, to check who may cancel the
+    # job, and with the result, to apply storage quotas. Never sent to clients.
+    key_id: Optional[str] = Field(default=None, exclude=True)
+
+    # Why an ERROR job was stopped: CANCELLED or TIMEOUT. nnsight clients only know its
+    # statuses, so a stopped job's status stays ERROR.
+    reason: Optional[str] = None
+
     @classmethod
     def load(
         cls,
@@ -101,21 +170,105 @@ class ResponseModel(_ResponseModel):
 
             logger.info(f"DELETED Response: {id}")
 
-    def save(self, client: MongoClient) -> ResponseModel:
+    @classmethod
+    def cancel(cls, client: MongoClient, id: str) -> None:
+        """Asks for the job to be stopped by the replica running it, or skipped by the one
+        it is queued for."""
+
+        client["ndif_database"]["cancellations"].update_one(
+            {"_id": ObjectId(id)},
+            {"$setOnInsert": {"created": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    @classmethod
+    def cancelled(cls, client: MongoClient, ids: List[str]) -> Set[str]:
+        """Ids of the jobs asked to be cancelled among ids."""
+
+        return {
+            str(doc["_id"])
+            for doc in client["ndif_database"]["cancellations"].find(
+                {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"_id": True}
+            )
+        }
+
+    def save(
+        self,
+        client: MongoClient,
+        handoff: Callable[[str, io.BytesIO, Dict[str, Any]], bool] = None,
+    ) -> ResponseModel:
         responses_collection = client["ndif_database"]["responses"]
 
         if self.result is not None:
-            self.result.save(client)
+            self.result.save(
+                client,
+                metadata={"model_key": self.model_key, "key_id": self.key_id},
+                handoff=handoff,
+            )
+
+        with metrics.RESPONSE_SAVE.time(self.model_key), tracing.span(
+            "response.save", status=self.status.name
+        ):
+            responses_collection.update_one(
+                {"_id": ObjectId(self.id)}, self._replacement(), upsert=True
+            )
+
+        return self
 
-        responses_collection.replace_one(
-            {"_id": ObjectId(self.id)},
-            self.model_dump(
+    def save_if(
+        self, client: MongoClient, statuses: List[ResponseModel.JobStatus]
+    ) -> bool:
+        """Saves the response only if the job's stored status is one of statuses, in one
+        atomic update, so the API and the replicas can't both decide how a job ends. For
+        responses without a result.
+
+        Returns:
+            bool: Whether it was saved.
+        """
+
+        responses_collection = client["ndif_database"]["responses"]
+
+        with metrics.RESPONSE_SAVE.time(self.model_key), tracing.span(
+            "response.save", status=self.status.name
+        ):
+            saved = responses_collection.update_one(
+                {
+                    "_id": ObjectId(self.id),
+                    "status": {"$in": [status.value for status in statuses]},
+                },
+                self._replacement(),
+            )
+
+        return saved.matched_count > 0
+
+    def _replacement(self) -> List[Dict[str, Any]]:
+        """Update replacing the stored document with this response, keeping the key id the
+        API stored with it on receipt."""
+
+        document = {
+            **self.model_dump(
                 exclude_defaults=True, exclude_none=True, exclude=["result"]
             ),
-            upsert=True,
-        )
-
-        return self
+            # Responses expire some time after their last update (see StorageDeployment).
+            "updated": datetime.utcnow(),
+        }
+
+        # Stored so only the submitting key can cancel the job, but never sent to clients.
+        if self.key_id is not None:
+            document["key_id"] = self.key_id
+
+        return [
+            {
+                "$replaceRoot": {
+                    "newRoot": {
+                        "$mergeObjects": [
+                            {"key_id": "$key_id"},
+                            {"$literal": document},
+                        ]
+                    }
+                }
+            }
+        ]
 
     def __str__(self) -> str:
         return f"{self.id} - {self.status.name}: {self.description}"
@@ -133,7 +286,8 @@ class ResponseModel(_ResponseModel):
 
     def blocking_response(self, api_url: str) -> ResponseModel:
         if self.blocking():
-            requests.get(f"{api_url}/blocking_response/{self.id}")
+            with metrics.NOTIFY.time(self.model_key), tracing.span("response.notify"):
+                requests.get(f"{api_url}/blocking_response/{self.id}")
 
         return self
 
@@ -143,4 +297,4 @@ class ResponseModel(_ResponseModel):
 
     @field_serializer("received")
     def sreceived(self, value, _info):
-        return str(value)
\ No newline at end of file
+        return str(value)
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import hashlib
+from datetime import datetime
+
+from pydantic import BaseModel
+from pymongo import MongoClient
+
+
+class UsageModel(BaseModel):
+    """GPU-seconds consumed by one API key in one period (UTC day)."""
+
+    key_id: str
+    period: str
+
+    gpu_seconds: float = 0
+
+    @staticmethod
+    def key_id_from_api_key(api_key: str) -> str:
+        """Usage is stored under a hash of the API key, never the key itself."""
+
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    @staticmethod
+    def current_period() -> str:
+
+        return datetime.utcnow().strftime("%Y-%m-%d")
+
+    @classmethod
+    def load(cls, client: MongoClient, key_id: str, period: str = None) -> UsageModel:
+
+        period = period or cls.current_period()
+
+        usage_collection = client["ndif_database"]["usage"]
+
+        doc = usage_collection.find_one({"_id": f"{key_id}:{period}"}, {"_id": False})
+
+        if doc is None:
+            return UsageModel(key_id=key_id, period=period)
+
+        return UsageModel(**doc)
+
+    @classmethod
+    def record(cls, client: MongoClient, key_id: str, gpu_seconds: float) -> None:
+
+        if key_id is None:
+            return
+
+        period = cls.current_period()
+
+        usage_collection = client["ndif_database"]["usage"]
+
+        usage_collection.update_one(
+            {"_id": f"{key_id}:{period}"},
+            {
+                "$inc": {"gpu_seconds": gpu_seconds},
+                "$setOnInsert": {"key_id": key_id, "period": period},
+            },
+            upsert=True,
+        )
@@ -1 +1,3 @@
-from .Response import ResponseModel, ResultModel
\ No newline at end of file
+from .Request import RequestModel
+from .Response import ResponseModel, ResultModel
+from .Usage import UsageModel
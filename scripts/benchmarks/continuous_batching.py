@@ -0,0 +1,363 @@
+"""Benchmark of continuous batching: mixed-length generate jobs decoded one after another with
+model.generate, as replicas run them without it, and together by the ContinuousBatcher.
+
+Jobs arrive as a Poisson stream of --rate per second with max_new_tokens drawn from a
+long-tailed mix, against a tiny GPT-2 built from its config, so nothing is downloaded.
+Greedy outputs of both runs are checked to be the same.
+
+The same jobs are then sent as nnsight generate traces through ModelDeployment.execute, as
+replicas run deserialized requests, without a batcher and with one. Every other trace also
+edits the first layer and saves the last layer's output at every step, so the batch runs jobs
+intervening on modules alongside jobs that don't. Values saved by both runs are checked to be
+the same.
+
+    python scripts/benchmarks/continuous_batching.py --jobs 64 --rate 20 --device cpu
+"""
+
+import random
+import statistics
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from src.ray.continuous_batching import ContinuousBatcher, GenerationOptions
+from src.ray.deployments.model import ModelDeployment
+
+# max_new_tokens of jobs and how often each is drawn.
+NEW_TOKENS = [(4, 0.4), (16, 0.3), (64, 0.2), (256, 0.1)]
+
+PAD_TOKEN_ID = 0
+
+
+def make_jobs(jobs: int, rate: float, vocab_size: int) -> List[Dict]:
+
+    random.seed(0)
+
+    arrival = 0.0
+
+    result = []
+
+    for _ in range(jobs):
+
+        arrival += random.expovariate(rate)
+
+        prompts = random.randint(1, 2)
+        lengths = [random.randint(4, 32) for _ in range(prompts)]
+
+        # Left-padded, as nnsight's LanguageModel tokenizes batches.
+        input_ids = torch.full((prompts, max(lengths)), PAD_TOKEN_ID)
+        attention_mask = torch.zeros_like(input_ids)
+
+        for index, length in enumerate(lengths):
+
+            input_ids[index, -length:] = torch.randint(1, vocab_size, (length,))
+            attention_mask[index, -length:] = 1
+
+        result.append(
+            {
+                "arrival": arrival,
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "max_new_tokens": random.choices(
+                    [tokens for tokens, _ in NEW_TOKENS],
+                    weights=[weight for _, weight in NEW_TOKENS],
+                )[0],
+            }
+        )
+
+    return result
+
+
+def drive(
+    jobs: List[Dict], generate: Callable[[Dict], torch.Tensor], concurrent: bool
+) -> Tuple[List[float], List[torch.Tensor], float]:
+    """Submits jobs at their arrival times. Returns latencies, outputs and wall time."""
+
+    latencies = [None] * len(jobs)
+    outputs = [None] * len(jobs)
+
+    start = time.perf_counter()
+
+    def run(index: int):
+
+        job = jobs[index]
+
+        delay = start + job["arrival"] - time.perf_counter()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        outputs[index] = generate(job)
+
+        latencies[index] = time.perf_counter() - start - job["arrival"]
+
+    if concurrent:
+
+        threads = [
+            threading.Thread(target=run, args=(index,)) for index in range(len(jobs))
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    else:
+
+        for index in range(len(jobs)):
+            run(index)
+
+    return latencies, outputs, time.perf_counter() - start
+
+
+def summarize(
+    latencies: List[float],
+    outputs: List[torch.Tensor],
+    jobs: List[Dict],
+    seconds: float,
+) -> Dict:
+
+    tokens = sum(
+        (output.shape[1] - job["input_ids"].shape[1]) * output.shape[0]
+        for output, job in zip(outputs, jobs)
+    )
+
+    latencies = sorted(latencies)
+
+    return {
+        "seconds": seconds,
+        "tokens_per_second": tokens / seconds,
+        "p50_latency": statistics.median(latencies),
+        "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def language_model(model: GPT2LMHeadModel) -> Any:
+    """Wraps model in an nnsight LanguageModel, with a tokenizer padding like the jobs."""
+
+    from nnsight import LanguageModel
+
+    tokenizer = Tokenizer(
+        models.WordLevel(
+            {f"t{index}": index for index in range(model.config.vocab_size)},
+            unk_token=f"t{PAD_TOKEN_ID}",
+        )
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+
+    return LanguageModel(
+        model,
+        tokenizer=PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer,
+            pad_token=f"t{PAD_TOKEN_ID}",
+            padding_side="left",
+        ),
+    )
+
+
+def trace(model: Any, job: Dict, index: int) -> Tuple[Any, List[Any]]:
+    """Builds the generate trace of a job, as a replica deserializes it. Odd jobs also edit
+    and save module outputs.
+
+    Returns:
+        Tuple[Any, List[Any]]: The trace, and proxies of the values it saves.
+    """
+
+    saves = []
+
+    with model.generate(
+        {"input_ids": job["input_ids"], "attention_mask": job["attention_mask"]},
+        max_new_tokens=job["max_new_tokens"],
+        validate=False,
+        scan=False,
+    ) as tracer:
+
+        # Executed by ModelDeployment.execute instead.
+        tracer.backend = lambda tracer: None
+
+        if index % 2 == 1:
+
+            model.transformer.h[0].output[0][:, -1] = 0
+
+            layer = model.transformer.h[-1]
+
+            for _ in range(job["max_new_tokens"]):
+
+                saves.append(layer.output[0][:, -1].save())
+
+                layer = layer.next()
+
+        saves.append(model.generator.output.save())
+
+    return tracer, saves
+
+
+def execute_traces(
+    model: Any, jobs: List[Dict], batcher: ContinuousBatcher
+) -> Tuple[List[float], List[List[torch.Tensor]], float]:
+    """Sends the traces of jobs through ModelDeployment.execute at their arrival times,
+    concurrently if there's a batcher. Returns latencies, saved values and wall time."""
+
+    # Only execute is called, which needs nothing from the replica but its batcher.
+    deployment = object.__new__(ModelDeployment.func_or_class)
+    deployment.batcher = batcher
+
+    # Built up front, as tracing isn't thread safe.
+    traces = {id(job): trace(model, job, index) for index, job in enumerate(jobs)}
+
+    def execute(job: Dict) -> List[torch.Tensor]:
+
+        tracer, saves = traces[id(job)]
+
+        with torch.no_grad():
+            deployment.execute(tracer)
+
+        return [save.value.cpu() for save in saves]
+
+    return drive(jobs, execute, concurrent=batcher is not None)
+
+
+def main(jobs: int, rate: float, max_batch_size: int, device: str, output: str):
+
+    device = torch.device(device)
+
+    torch.manual_seed(0)
+
+    # No EOS within the vocabulary, so every job generates its max_new_tokens.
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=4,
+            n_embd=256,
+            n_head=4,
+            vocab_size=1000,
+            n_positions=512,
+            eos_token_id=None,
+            bos_token_id=None,
+        )
+    ).to(device)
+
+    model.eval()
+
+    jobs = make_jobs(jobs, rate, model.config.vocab_size)
+
+    def sequential(job: Dict) -> torch.Tensor:
+
+        with torch.no_grad():
+
+            return model.generate(
+                input_ids=job["input_ids"].to(device),
+                attention_mask=job["attention_mask"].to(device),
+                max_new_tokens=job["max_new_tokens"],
+                do_sample=False,
+                pad_token_id=PAD_TOKEN_ID,
+            ).cpu()
+
+    batcher = ContinuousBatcher(
+        model, "tiny", max_batch_size=max_batch_size, pad_token_id=PAD_TOKEN_ID
+    )
+
+    def continuous(job: Dict) -> torch.Tensor:
+
+        return batcher.generate(
+            job["input_ids"],
+            job["attention_mask"],
+            GenerationOptions(max_new_tokens=job["max_new_tokens"]),
+        )
+
+    # Warm up kernels and allocators.
+    sequential(jobs[0])
+    continuous(jobs[0])
+
+    sequential_latencies, sequential_outputs, sequential_seconds = drive(
+        jobs, sequential, concurrent=False
+    )
+    continuous_latencies, continuous_outputs, continuous_seconds = drive(
+        jobs, continuous, concurrent=True
+    )
+
+    matching = sum(
+        torch.equal(a, b) for a, b in zip(sequential_outputs, continuous_outputs)
+    )
+
+    report = {
+        "jobs": len(jobs),
+        "matching_outputs": matching,
+        "sequential": summarize(
+            sequential_latencies, sequential_outputs, jobs, sequential_seconds
+        ),
+        "continuous": summarize(
+            continuous_latencies, continuous_outputs, jobs, continuous_seconds
+        ),
+    }
+
+    report["speedup"] = (
+        report["continuous"]["tokens_per_second"]
+        / report["sequential"]["tokens_per_second"]
+    )
+
+    nnsight_model = language_model(model)
+
+    sequential_latencies, sequential_saves, sequential_seconds = execute_traces(
+        nnsight_model, jobs, None
+    )
+    continuous_latencies, continuous_saves, continuous_seconds = execute_traces(
+        nnsight_model, jobs, batcher
+    )
+
+    matching = [
+        len(a) == len(b)
+        and all(
+            x.shape == y.shape and torch.allclose(x, y, atol=1e-4) for x, y in zip(a, b)
+        )
+        for a, b in zip(sequential_saves, continuous_saves)
+    ]
+
+    report["traces"] = {
+        "matching_saves": sum(matching[0::2]),
+        "matching_module_saves": sum(matching[1::2]),
+        "sequential": summarize(
+            sequential_latencies,
+            [saves[-1] for saves in sequential_saves],
+            jobs,
+            sequential_seconds,
+        ),
+        "continuous": summarize(
+            continuous_latencies,
+            [saves[-1] for saves in continuous_saves],
+            jobs,
+            continuous_seconds,
+        ),
+    }
+
+    report["traces"]["speedup"] = (
+        report["traces"]["continuous"]["tokens_per_second"]
+        / report["traces"]["sequential"]["tokens_per_second"]
+    )
+
+    util.report(report, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--jobs", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=20)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument(
+        "--device", default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
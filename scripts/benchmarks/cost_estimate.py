@@ -0,0 +1,217 @@
+"""Checks the request cost estimator against measured executions of tiny GPT-2 models.
+
+Models are built from configs, so nothing is downloaded. For every model, batch size,
+prompt length and set of saves, the request is estimated the way the Request app does it
+(from the validated request object) and then executed. The throughput the estimator is
+calibrated with is fit on every other run, as replicas report it, and predicted times are
+checked against the rest. Predicted result sizes are checked against the saved values, and
+on a GPU, predicted memory against peak allocations.
+
+    python scripts/benchmarks/cost_estimate.py --device cpu
+"""
+
+import itertools
+import math
+import statistics
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from nnsight import NNsight
+from nnsight.schema.Request import RequestModel
+
+from src.ray.cost import ModelProfile, estimate
+
+# Layers and hidden size of each model.
+MODELS = [(2, 64), (4, 128), (6, 256)]
+
+
+def run(
+    model: NNsight, profile: ModelProfile, batch_size: int, tokens: int, saves: str
+) -> Dict:
+
+    device = next(model._model.parameters()).device
+
+    input_ids = torch.randint(
+        profile.vocab_size, (batch_size, tokens), dtype=torch.long, device=device
+    )
+
+    tracer = model.trace(input_ids, validate=False, scan=False)
+
+    tracer.__enter__()
+
+    saved = []
+
+    if saves in ("hidden", "all"):
+        saved.extend(layer.mlp.output.save() for layer in model.transformer.h)
+
+    if saves in ("logits", "all"):
+        saved.append(model.lm_head.output.save())
+
+    request = RequestModel(
+        object=tracer, model_key="tiny", id="0", received=datetime.now()
+    )
+
+    predicted = estimate(request.object, profile)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+
+    start = time.perf_counter()
+
+    with torch.no_grad():
+        tracer.__exit__(None, None, None)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+    seconds = time.perf_counter() - start
+
+    return {
+        "batch_size": batch_size,
+        "tokens": tokens,
+        "saves": saves,
+        "flops": predicted.flops,
+        "seconds": seconds,
+        "result_bytes": predicted.result_bytes,
+        "measured_result_bytes": sum(proxy.value.nbytes for proxy in saved),
+        "activation_bytes": predicted.activation_bytes,
+        "measured_activation_bytes": (
+            torch.cuda.max_memory_allocated(device) - baseline
+            if device.type == "cuda"
+            else None
+        ),
+    }
+
+
+def ratios(values: List[float]) -> Dict[str, float]:
+    """Spread of predicted / measured ratios."""
+
+    errors = sorted(abs(math.log(value)) for value in values)
+
+    return {
+        "median": statistics.median(values),
+        "p95_factor": math.exp(errors[min(len(errors) - 1, int(len(errors) * 0.95))]),
+    }
+
+
+def main(device: str, repeats: int, output: str):
+
+    device = torch.device(device)
+
+    runs = []
+
+    for layers, hidden in MODELS:
+
+        torch.manual_seed(0)
+
+        module = GPT2LMHeadModel(
+            GPT2Config(
+                n_layer=layers,
+                n_embd=hidden,
+                n_head=max(1, hidden // 64),
+                vocab_size=1000,
+                n_positions=512,
+            )
+        ).to(device)
+
+        module.eval()
+
+        model = NNsight(module)
+
+        profile = ModelProfile.from_model(module)
+
+        # Warm up kernels and allocators.
+        run(model, profile, 1, 8, "none")
+
+        for batch_size, tokens, saves, _ in itertools.product(
+            [1, 4, 16],
+            [16, 64, 256],
+            ["none", "hidden", "logits", "all"],
+            range(repeats),
+        ):
+
+            result = run(model, profile, batch_size, tokens, saves)
+
+            result["model"] = f"{layers}x{hidden}"
+
+            runs.append(result)
+
+    # Calibrate on every other run, as replicas fold in the throughput of each job.
+    calibration = runs[::2]
+    held_out = runs[1::2]
+
+    flops_per_second = statistics.median(
+        run["flops"] / run["seconds"] for run in calibration
+    )
+
+    time_ratios = ratios(
+        [run["flops"] / flops_per_second / run["seconds"] for run in held_out]
+    )
+    result_ratios = ratios(
+        [
+            run["result_bytes"] / run["measured_result_bytes"]
+            for run in runs
+            if run["measured_result_bytes"]
+        ]
+    )
+
+    print(f"{len(runs)} runs, calibrated at {flops_per_second / 1e9:.2f} GFLOP/s.")
+    print(
+        f"seconds        predicted/measured median {time_ratios['median']:.2f}, "
+        f"95% within {time_ratios['p95_factor']:.2f}x"
+    )
+    print(
+        f"result bytes   predicted/measured median {result_ratios['median']:.2f}, "
+        f"95% within {result_ratios['p95_factor']:.2f}x"
+    )
+
+    report = {
+        "runs": runs,
+        "flops_per_second": flops_per_second,
+        "seconds": time_ratios,
+        "result_bytes": result_ratios,
+    }
+
+    if device.type == "cuda":
+
+        memory_ratios = ratios(
+            [
+                run["activation_bytes"] / run["measured_activation_bytes"]
+                for run in runs
+                if run["measured_activation_bytes"]
+            ]
+        )
+
+        print(
+            f"memory         predicted/measured median {memory_ratios['median']:.2f}, "
+            f"95% within {memory_ratios['p95_factor']:.2f}x"
+        )
+
+        report["activation_bytes"] = memory_ratios
+
+    util.report(report, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--device", default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
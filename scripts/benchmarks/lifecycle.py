@@ -0,0 +1,446 @@
+"""Load-generation benchmark of the full request lifecycle.
+
+Spins up a local stack with a tiny CPU model:
+
+    mongod (or --database-url)  <-  API (uvicorn, single worker, in-process Socket.IO manager)
+                                         |
+                                    local Ray cluster: Request app -> Model app
+
+then drives concurrent clients through submit, wait (status polling, long-polling or
+Socket.IO) and result download, and reports throughput and p50/p95/p99 per stage.
+
+    python scripts/benchmarks/lifecycle.py --clients 8 --requests 25 --wait ws
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict
+
+import requests
+import socketio
+
+import util
+
+TINY_REPO_ID = "hf-internal-testing/tiny-random-gpt2"
+
+
+@contextmanager
+def api(database_url: str, ray_address: str):
+    """Runs the API app in a subprocess, as its container would but with one worker and no RabbitMQ."""
+
+    port = util.free_port()
+
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "RAY_ADDRESS": ray_address,
+    }
+
+    env.pop("RMQ_URL", None)
+    env.pop("FIREBASE_CREDS_PATH", None)
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "src.app:app",
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=util.API_SERVICE_PATH,
+        env=env,
+    )
+
+    address = f"127.0.0.1:{port}"
+
+    try:
+
+        deadline = time.time() + 120
+
+        while True:
+
+            try:
+                if requests.get(f"http://{address}/ping").status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+
+            if process.poll() is not None or time.time() > deadline:
+                raise RuntimeError("API failed to start.")
+
+            time.sleep(0.5)
+
+        yield address
+
+    finally:
+
+        process.terminate()
+        process.wait()
+
+
+@contextmanager
+def ray_cluster():
+    """Starts a local Ray cluster whose workers can import the ray service's `src` package."""
+
+    import ray
+
+    util.add_service_path(util.RAY_SERVICE_PATH)
+
+    ray.init(
+        runtime_env={"env_vars": {"PYTHONPATH": str(util.RAY_SERVICE_PATH)}},
+        include_dashboard=False,
+    )
+
+    try:
+
+        yield ray.get_runtime_context().gcs_address
+
+    finally:
+
+        from ray import serve
+
+        serve.shutdown()
+        ray.shutdown()
+
+
+def deploy(model_key: str, database_url: str, api_url: str, num_replicas: int) -> None:
+    """Deploys the Request and Model apps the way RayState names them."""
+
+    from ray import serve
+    from slugify import slugify
+
+    from src.ray.deployments.model import ModelDeployment, ModelDeploymentArgs
+    from src.ray.deployments.request import RequestDeployment, RequestDeploymentArgs
+
+    serve.start(http_options={"location": "NoServer"})
+
+    serve.run(
+        RequestDeployment.bind(
+            **RequestDeploymentArgs(
+                ray_dashboard_url="", api_url=api_url, database_url=database_url
+            ).model_dump()
+        ),
+        name="Request",
+        route_prefix=None,
+    )
+
+    serve.run(
+        ModelDeployment.options(num_replicas=num_replicas).bind(
+            **ModelDeploymentArgs(
+                model_key=model_key, api_url=api_url, database_url=database_url
+            ).model_dump()
+        ),
+        name=f"Model:{slugify(model_key)}",
+        route_prefix=None,
+    )
+
+
+def build_payload(
+    repo_id: str, prompt: str, max_new_tokens: int, save_layers: bool, input_MB: float
+):
+    """Builds the JSON body of a request with nnsight, exactly as RemoteBackend would send it.
+
+    With input_MB, the request also carries an fp32 input tensor of that size, as requests
+    patching in embeddings do.
+
+    Returns:
+        Tuple[str, Dict]: Model key and request body.
+    """
+
+    import torch
+    from nnsight import LanguageModel
+    from nnsight.contexts.backends.RemoteBackend import RemoteBackend
+
+    class CaptureBackend(RemoteBackend):
+
+        def __call__(self, obj):
+
+            self.payload = self.request(obj).model_dump(exclude=["id", "received"])
+
+            obj.remote_backend_cleanup()
+
+    model = LanguageModel(repo_id)
+    backend = CaptureBackend()
+
+    if max_new_tokens > 1:
+        context = model.generate(prompt, backend=backend, max_new_tokens=max_new_tokens)
+    else:
+        context = model.trace(prompt, backend=backend)
+
+    with context:
+
+        if save_layers:
+            for layer in model.transformer.h:
+                layer.output[0].save()
+
+        model.lm_head.output.save()
+
+        if input_MB > 0:
+
+            patch = torch.randn(int(input_MB * 1e6 / 4))
+
+            (model.lm_head.output.flatten()[0] + patch).sum().save()
+
+    return model.to_model_key(), backend.payload
+
+
+class Client:
+    """One simulated user. Records the duration of each stage of each of its jobs."""
+
+    def __init__(
+        self,
+        address: str,
+        payload: Dict[str, Any],
+        wait: str,
+        poll_interval: float,
+        body: bytes = None,
+        encoding: str = "identity",
+    ):
+
+        self.address = address
+        self.payload = payload
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.body = body
+        self.encoding = encoding
+
+        self.session = requests.Session()
+
+    def submit(self, session_id: str = None) -> str:
+
+        if self.body is None:
+
+            response = self.session.post(
+                f"http://{self.address}/request",
+                json={**self.payload, "session_id": session_id},
+            )
+
+        else:
+
+            headers = {
+                "ndif-model-key": self.payload["model_key"],
+                "Content-Encoding": self.encoding,
+            }
+
+            if session_id is not None:
+                headers["ndif-session-id"] = session_id
+
+            response = self.session.post(
+                f"http://{self.address}/request/binary",
+                data=self.body,
+                headers=headers,
+            )
+
+        response.raise_for_status()
+
+        return response.json()["id"]
+
+    def poll(self, id: str) -> str:
+
+        # Long-polls park on the server until the status changes, no need to sleep between them.
+        params = {"wait": 30} if self.wait == "long-poll" else None
+
+        while True:
+
+            status = self.session.get(
+                f"http://{self.address}/response/{id}", params=params
+            ).json()["status"]
+
+            if status in ("COMPLETED", "ERROR"):
+                return status
+
+            if params is None:
+                time.sleep(self.poll_interval)
+
+    def download(self, id: str) -> int:
+
+        nbytes = 0
+
+        with self.session.get(
+            f"http://{self.address}/result/{id}", stream=True
+        ) as stream:
+
+            for data in stream.iter_content(chunk_size=None):
+                nbytes += len(data)
+
+        return nbytes
+
+    def run(self) -> Dict[str, float]:
+
+        timings = {}
+
+        start = time.perf_counter()
+
+        if self.wait == "ws":
+
+            with socketio.SimpleClient() as sio:
+
+                sio.connect(
+                    f"ws://{self.address}",
+                    socketio_path="/ws/socket.io",
+                    transports=["websocket"],
+                )
+
+                id = self.submit(session_id=sio.sid)
+
+                timings["submit"] = time.perf_counter() - start
+
+                while True:
+
+                    status = sio.receive(timeout=600)[1]["status"]
+
+                    if status in ("COMPLETED", "ERROR"):
+                        break
+
+        else:
+
+            id = self.submit()
+
+            timings["submit"] = time.perf_counter() - start
+
+            status = self.poll(id)
+
+        timings["wait"] = time.perf_counter() - start - timings["submit"]
+
+        if status == "ERROR":
+            raise RuntimeError(f"Job `{id}` errored.")
+
+        download_start = time.perf_counter()
+
+        timings["result_bytes"] = self.download(id)
+        timings["download"] = time.perf_counter() - download_start
+        timings["total"] = time.perf_counter() - start
+
+        return timings
+
+
+def main(
+    clients: int,
+    requests_per_client: int,
+    wait: str,
+    poll_interval: float,
+    repo_id: str,
+    prompt: str,
+    max_new_tokens: int,
+    save_layers: bool,
+    input_MB: float,
+    format: str,
+    encoding: str,
+    num_replicas: int,
+    database_url: str,
+    warmup: int,
+    output: str,
+):
+
+    model_key, payload = build_payload(
+        repo_id, prompt, max_new_tokens, save_layers, input_MB
+    )
+
+    body = None
+
+    if format == "binary":
+
+        util.add_service_path(util.RAY_SERVICE_PATH)
+
+        from src.schema import RequestModel
+
+        body = RequestModel(**payload).pack(encoding)
+
+    with util.mongo(database_url) as database_url, ray_cluster() as ray_address, api(
+        database_url, ray_address
+    ) as address:
+
+        deploy(model_key, database_url, f"http://{address}", num_replicas)
+
+        for _ in range(warmup):
+            Client(address, payload, wait, poll_interval, body, encoding).run()
+
+        timings = []
+        errors = []
+        lock = threading.Lock()
+
+        def work():
+
+            client = Client(address, payload, wait, poll_interval, body, encoding)
+
+            for _ in range(requests_per_client):
+
+                try:
+                    result = client.run()
+                except Exception as exception:
+                    with lock:
+                        errors.append(str(exception))
+                else:
+                    with lock:
+                        timings.append(result)
+
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            for _ in range(clients):
+                executor.submit(work)
+
+        elapsed = time.perf_counter() - start
+
+    util.report(
+        {
+            "config": {
+                "clients": clients,
+                "requests_per_client": requests_per_client,
+                "wait": wait,
+                "repo_id": repo_id,
+                "max_new_tokens": max_new_tokens,
+                "save_layers": save_layers,
+                "input_MB": input_MB,
+                "format": format,
+                "encoding": encoding,
+                "num_replicas": num_replicas,
+            },
+            "elapsed_seconds": elapsed,
+            "completed": len(timings),
+            "errors": len(errors),
+            "throughput_rps": len(timings) / elapsed,
+            "stages": {
+                stage: util.summarize([timing[stage] for timing in timings])
+                for stage in ("submit", "wait", "download", "total", "result_bytes")
+            },
+        },
+        output=output,
+    )
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", dest="requests_per_client", type=int, default=10)
+    parser.add_argument("--wait", choices=["ws", "poll", "long-poll"], default="ws")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--repo-id", default=TINY_REPO_ID)
+    parser.add_argument("--prompt", default="The Eiffel Tower is in the city of")
+    parser.add_argument("--max-new-tokens", type=int, default=1)
+    parser.add_argument("--save-layers", action="store_true")
+    parser.add_argument("--input-MB", dest="input_MB", type=float, default=0)
+    parser.add_argument("--format", choices=["json", "binary"], default="json")
+    parser.add_argument(
+        "--encoding", choices=["identity", "gzip", "zstd"], default="identity"
+    )
+    parser.add_argument("--num-replicas", type=int, default=1)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,204 @@
+"""Benchmark of the multiplexed model cache: models demoted to host memory or disk and
+promoted back as a skewed stream of jobs hits them, against a simulated device budget.
+
+Runs on the CPU (where the device tier is simulated by the budget alone) or on a GPU.
+Every use runs a forward pass and checks its output against the model's first one, so
+weights are verified to survive round trips through every tier.
+
+Sources:
+    synthetic  Stacks of Linear layers of --model-MB each.
+    tiny       nnsight LanguageModels of a tiny GPT-2, loaded from the Hugging Face cache.
+
+    python scripts/benchmarks/model_cache.py --models 8 --device-models 2 --host-models 3
+"""
+
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+import torch
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from src.ray.model_cache import ModelCache, Tier
+
+TINY_REPO_ID = "hf-internal-testing/tiny-random-gpt2"
+
+
+def synthetic_loader(model_MB: float):
+
+    hidden = 256
+
+    layers = max(1, int(model_MB * 1e6 / (hidden * hidden * 4)))
+
+    def load(model_key: str):
+
+        torch.manual_seed(hash(model_key) % 2**31)
+
+        return SimpleNamespace(
+            _model=torch.nn.Sequential(
+                *[torch.nn.Linear(hidden, hidden, bias=False) for _ in range(layers)]
+            )
+        )
+
+    def forward(model, device: torch.device) -> torch.Tensor:
+
+        return model._model(torch.ones(1, hidden, device=device))
+
+    return load, forward
+
+
+def tiny_loader():
+
+    from nnsight import LanguageModel
+
+    def load(model_key: str):
+
+        return LanguageModel(TINY_REPO_ID, dispatch=True)
+
+    def forward(model, device: torch.device) -> torch.Tensor:
+
+        return model._model(torch.ones(1, 8, dtype=torch.long, device=device)).logits
+
+    return load, forward
+
+
+def main(
+    source: str,
+    models: int,
+    model_MB: float,
+    device_models: int,
+    host_models: int,
+    jobs: int,
+    skew: float,
+    snapshots: bool,
+    device: str,
+    seed: int,
+    output: str,
+):
+
+    if source == "synthetic":
+        load, forward = synthetic_loader(model_MB)
+    else:
+        load, forward = tiny_loader()
+
+    device = torch.device(device)
+
+    model_keys = [f"model-{index}" for index in range(models)]
+
+    module = load(model_keys[0])._model
+
+    nbytes = sum(tensor.nbytes for tensor in [*module.parameters(), *module.buffers()])
+
+    del module
+
+    # Zipf-like popularity, as a few models get most of the traffic.
+    weights = [1 / (rank + 1) ** skew for rank in range(models)]
+
+    rng = random.Random(seed)
+
+    timings: Dict[str, List[float]] = {}
+    references: Dict[str, torch.Tensor] = {}
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+
+        cache = ModelCache(
+            load,
+            device,
+            device_budget_bytes=nbytes * device_models,
+            host_budget_bytes=nbytes * host_models,
+            snapshot_dir=snapshot_dir if snapshots else None,
+        )
+
+        start = time.perf_counter()
+
+        for _ in range(jobs):
+
+            model_key = rng.choices(model_keys, weights)[0]
+
+            with cache.use(model_key) as event:
+
+                promoted_from = event.tier.value if event.tier else "scratch"
+
+                timings.setdefault(promoted_from, []).append(event.load_seconds)
+
+                for offload in event.offloads:
+                    timings.setdefault(
+                        f"offload_{offload.tier.value if offload.tier else 'drop'}", []
+                    ).append(offload.seconds)
+
+                with torch.no_grad():
+                    output_value = forward(cache.get(model_key), device).cpu()
+
+                reference = references.setdefault(model_key, output_value)
+
+                if not torch.equal(reference, output_value):
+                    raise RuntimeError(f"{model_key} changed after {event}")
+
+        elapsed = time.perf_counter() - start
+
+    stages = {stage: util.summarize(values) for stage, values in timings.items()}
+
+    for stage, summary in sorted(stages.items()):
+
+        print(
+            f"{stage:<14} {summary['count']:>6} "
+            f"p50 {summary['p50'] * 1e3:>9.2f}ms p95 {summary['p95'] * 1e3:>9.2f}ms"
+        )
+
+    print(
+        f"{jobs} jobs over {models} models of {nbytes / 1e6:.1f}MB in {elapsed:.2f}s, "
+        f"{len(timings.get(Tier.DEVICE.value, [])) / jobs:.1%} device hits."
+    )
+
+    util.report(
+        {
+            "model_bytes": nbytes,
+            "jobs": jobs,
+            "seconds": elapsed,
+            "stages": stages,
+        },
+        output=output,
+    )
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--source", choices=["synthetic", "tiny"], default="synthetic")
+    parser.add_argument("--models", type=int, default=8)
+    parser.add_argument("--model-MB", dest="model_MB", type=float, default=64)
+    parser.add_argument(
+        "--device-models",
+        type=int,
+        default=2,
+        help="Device budget, in models.",
+    )
+    parser.add_argument(
+        "--host-models",
+        type=int,
+        default=3,
+        help="Host budget, in models.",
+    )
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument(
+        "--no-snapshots",
+        dest="snapshots",
+        action="store_false",
+        help="Drop models pushed out of host memory instead of snapshotting them.",
+    )
+    parser.add_argument(
+        "--device", default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
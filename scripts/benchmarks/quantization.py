@@ -0,0 +1,153 @@
+"""Benchmark of weight-only quantization: a model served in its compute dtype, and with the
+weights of its linear layers stored as int8 and int4.
+
+Runs a small Llama built from its config, so nothing is downloaded, on --device. Reports
+the bytes of each model's weights, its forward latency, how far its logits are from the
+unquantized model's, and whether a module output saved through nnsight keeps the compute
+dtype.
+
+    python scripts/benchmarks/quantization.py --layers 4 --hidden 1024 --device cpu
+"""
+
+import time
+from typing import Dict
+
+import torch
+from nnsight import NNsight
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from src.ray.quantization import QuantizationArgs, quantize
+
+
+def build(layers: int, hidden: int, dtype: str, device: str) -> LlamaForCausalLM:
+
+    torch.manual_seed(0)
+
+    return (
+        LlamaForCausalLM(
+            LlamaConfig(
+                num_hidden_layers=layers,
+                hidden_size=hidden,
+                intermediate_size=hidden * 11 // 4,
+                num_attention_heads=max(1, hidden // 128),
+                num_key_value_heads=max(1, hidden // 128),
+                vocab_size=8000,
+            )
+        )
+        .to(device=device, dtype=getattr(torch, dtype))
+        .eval()
+    )
+
+
+def weight_bytes(model: torch.nn.Module) -> int:
+
+    return sum(
+        tensor.nelement() * tensor.element_size()
+        for tensor in [*model.parameters(), *model.buffers()]
+    )
+
+
+def measure(
+    model: torch.nn.Module,
+    baseline: torch.Tensor,
+    input_ids: torch.Tensor,
+    repeats: int,
+) -> Dict:
+
+    with torch.no_grad():
+
+        # Warm up.
+        logits = model(input_ids).logits
+
+        latencies = []
+
+        for _ in range(repeats):
+
+            start = time.perf_counter()
+
+            model(input_ids)
+
+            if input_ids.device.type == "cuda":
+                torch.cuda.synchronize()
+
+            latencies.append(time.perf_counter() - start)
+
+    envoy = NNsight(model)
+
+    with envoy.trace(input_ids):
+        saved = envoy.model.layers[0].mlp.output.save()
+
+    error = (logits.float() - baseline.float()).abs()
+
+    return {
+        "weights_MB": weight_bytes(model) * 1e-6,
+        "latency_ms": util.summarize([latency * 1e3 for latency in latencies]),
+        "max_logit_error": float(error.max()),
+        "mean_logit_error": float(error.mean()),
+        "top1_agreement": float(
+            (logits.argmax(-1) == baseline.argmax(-1)).float().mean()
+        ),
+        "saved_dtype": str(saved.value.dtype),
+    }
+
+
+def main(
+    layers: int,
+    hidden: int,
+    batch: int,
+    tokens: int,
+    repeats: int,
+    dtype: str,
+    device: str,
+    output: str,
+):
+
+    model = build(layers, hidden, dtype, device)
+
+    torch.manual_seed(1)
+
+    input_ids = torch.randint(0, 8000, (batch, tokens), device=device)
+
+    with torch.no_grad():
+        baseline = model(input_ids).logits
+
+    report = {
+        "layers": layers,
+        "hidden": hidden,
+        "batch": batch,
+        "tokens": tokens,
+        "device": device,
+        dtype: measure(model, baseline, input_ids, repeats),
+    }
+
+    for quantization in ("int8", "int4"):
+
+        quantized = build(layers, hidden, dtype, device)
+
+        quantize(quantized, QuantizationArgs(dtype=quantization))
+
+        report[quantization] = measure(quantized, baseline, input_ids, repeats)
+
+    util.report(report, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--tokens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--dtype", default="bfloat16")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
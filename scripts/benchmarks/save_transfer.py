@@ -0,0 +1,148 @@
+"""Benchmark of copying saved values to the host during execution: peak device memory and
+the time from the end of the forward pass to the result being on the host, with and
+without a SaveTransferPool, for traces saving the MLP output of every layer.
+
+Needs a GPU. The model is a GPT-2 built from its config, so nothing is downloaded. Pass a
+small --pinned-MB to measure spilling to disk.
+
+    python scripts/benchmarks/save_transfer.py --layers 24 --hidden 2048 --tokens 1024
+"""
+
+import statistics
+import time
+from typing import Dict, Optional
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from nnsight import NNsight
+from nnsight.schema.Response import ResultModel
+
+from src.ray.save_transfer import SaveTransferPool
+
+
+def run(
+    model: NNsight, pool: Optional[SaveTransferPool], batch_size: int, tokens: int
+) -> Dict:
+
+    device = next(model._model.parameters()).device
+
+    input_ids = torch.randint(1000, (batch_size, tokens), device=device)
+
+    tracer = model.trace(input_ids, validate=False, scan=False)
+
+    tracer.__enter__()
+
+    for layer in model.transformer.h:
+        layer.mlp.output.save()
+
+    transfer = pool.transfer(tracer) if pool is not None else None
+
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+
+    baseline = torch.cuda.memory_allocated(device)
+
+    start = time.perf_counter()
+
+    with torch.no_grad():
+
+        if transfer is None:
+
+            tracer.__exit__(None, None, None)
+
+        else:
+
+            with transfer:
+                tracer.__exit__(None, None, None)
+
+    torch.cuda.synchronize(device)
+
+    executed = time.perf_counter()
+
+    # What postprocessing does with the graph.
+    value = ResultModel.from_graph(tracer.graph)
+
+    done = time.perf_counter()
+
+    if transfer is not None:
+        transfer.release()
+
+    return {
+        "execute_seconds": executed - start,
+        "tail_seconds": done - executed,
+        "peak_bytes": torch.cuda.max_memory_allocated(device) - baseline,
+        "saved_bytes": sum(tensor.nbytes for tensor in value.values()),
+    }
+
+
+def main(
+    layers: int,
+    hidden: int,
+    batch_size: int,
+    tokens: int,
+    pinned_MB: float,
+    repeats: int,
+    output: str,
+):
+
+    if not torch.cuda.is_available():
+        raise SystemExit("This benchmark needs a GPU.")
+
+    torch.manual_seed(0)
+
+    module = GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=layers,
+            n_embd=hidden,
+            n_head=max(1, hidden // 64),
+            vocab_size=1000,
+            n_positions=max(1024, tokens),
+        )
+    ).to("cuda:0", torch.float16)
+
+    module.eval()
+
+    model = NNsight(module)
+
+    pool = SaveTransferPool(int(pinned_MB * 1e6), min_bytes=0)
+
+    report = {}
+
+    for name, transfer_pool in (("postprocess", None), ("transfer", pool)):
+
+        # Warm up kernels and allocators.
+        run(model, transfer_pool, batch_size, tokens)
+
+        runs = [run(model, transfer_pool, batch_size, tokens) for _ in range(repeats)]
+
+        report[name] = {
+            key: statistics.median(run[key] for run in runs) for key in runs[0]
+        }
+
+    report["peak_reduction"] = 1 - (
+        report["transfer"]["peak_bytes"] / report["postprocess"]["peak_bytes"]
+    )
+
+    util.report(report, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--layers", type=int, default=24)
+    parser.add_argument("--hidden", type=int, default=2048)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--pinned-MB", type=float, default=4000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,312 @@
+"""Micro-benchmark of result serialization: ResultModel.save/load round trips and
+ResponseModel/ResultModel.model_dump across result shapes, dtypes and stores.
+
+Shapes:
+    small   A few small saved tensors.
+    layers  Hidden states of every layer of a model.
+    large   A multi-GB payload (see --large-GB).
+
+Stores:
+    memory    torch.save/torch.load to an in-memory buffer, serialization cost only.
+    file      torch.save/torch.load to a temporary file.
+    mongomock ResultModel.save/load against an in-process GridFS stand-in.
+    gridfs    ResultModel.save/load against a real Mongo (--database-url or a throwaway mongod).
+
+    python scripts/benchmarks/serialization.py --shapes small layers --stores memory gridfs
+"""
+
+import io
+import os
+import tempfile
+import time
+from contextlib import nullcontext
+from typing import Any, Dict, List
+
+import torch
+from bson.objectid import ObjectId
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from src.schema import ResponseModel, ResultModel
+
+DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "fp32": torch.float32,
+}
+
+
+def make_value(
+    shape: str,
+    dtype: torch.dtype,
+    layers: int,
+    batch: int,
+    seq: int,
+    hidden: int,
+    large_GB: float,
+) -> Dict[str, Any]:
+    """Builds a result value shaped like Tracer.remote_backend_postprocess_result's output."""
+
+    if shape == "small":
+
+        return {
+            f"proxy_call_{i}": torch.randn((1, 16, 768), dtype=dtype) for i in range(4)
+        }
+
+    if shape == "layers":
+
+        return {
+            f"getitem_{i}": torch.randn((batch, seq, hidden), dtype=dtype)
+            for i in range(layers)
+        }
+
+    # 256MB tensors up to large_GB in total.
+    numel = int(256e6) // torch.tensor([], dtype=dtype).element_size()
+    n_tensors = max(1, int(large_GB * 1e9 / 256e6))
+
+    return {f"getitem_{i}": torch.empty(numel, dtype=dtype) for i in range(n_tensors)}
+
+
+class BufferStore:
+
+    def __init__(self) -> None:
+
+        self.buffers = {}
+
+    def save(self, result: ResultModel) -> None:
+
+        buffer = io.BytesIO()
+        torch.save(result.model_dump(), buffer)
+
+        self.buffers[result.id] = buffer
+
+    def load(self, id: str) -> ResultModel:
+
+        buffer = self.buffers[id]
+        buffer.seek(0)
+
+        return ResultModel(**torch.load(buffer, map_location="cpu"))
+
+    def nbytes(self, id: str) -> int:
+
+        return self.buffers[id].getbuffer().nbytes
+
+    def delete(self, id: str) -> None:
+
+        del self.buffers[id]
+
+
+class FileStore:
+
+    def __init__(self) -> None:
+
+        self.directory = tempfile.TemporaryDirectory()
+
+    def path(self, id: str) -> str:
+
+        return os.path.join(self.directory.name, id)
+
+    def save(self, result: ResultModel) -> None:
+
+        torch.save(result.model_dump(), self.path(result.id))
+
+    def load(self, id: str) -> ResultModel:
+
+        return ResultModel(**torch.load(self.path(id), map_location="cpu"))
+
+    def nbytes(self, id: str) -> int:
+
+        return os.path.getsize(self.path(id))
+
+    def delete(self, id: str) -> None:
+
+        os.remove(self.path(id))
+
+
+class GridFSStore:
+
+    def __init__(self, client) -> None:
+
+        self.client = client
+
+    def save(self, result: ResultModel) -> None:
+
+        result.save(self.client)
+
+    def load(self, id: str) -> ResultModel:
+
+        return ResultModel.load(self.client, id)
+
+    def nbytes(self, id: str) -> int:
+
+        gridout = ResultModel.load(self.client, id, stream=True)
+
+        with gridout:
+            return gridout.length
+
+    def delete(self, id: str) -> None:
+
+        ResultModel.delete(self.client, id)
+
+
+def run_case(store, value: Dict[str, Any], repeats: int) -> Dict[str, Any]:
+
+    timings = {"result_dump": [], "response_dump": [], "save": [], "load": []}
+    save_rss = []
+    load_rss = []
+
+    nbytes = None
+
+    for _ in range(repeats):
+
+        id = str(ObjectId())
+
+        result = ResultModel(id=id, value=value)
+
+        response = ResponseModel(
+            id=id,
+            status=ResponseModel.JobStatus.COMPLETED,
+            description="Your job has been completed.",
+            result=result,
+        )
+
+        start = time.perf_counter()
+        result.model_dump()
+        timings["result_dump"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        response.model_dump(
+            exclude_defaults=True, exclude_none=True, exclude=["result"]
+        )
+        timings["response_dump"].append(time.perf_counter() - start)
+
+        with util.PeakRSS() as rss:
+            start = time.perf_counter()
+            store.save(result)
+            timings["save"].append(time.perf_counter() - start)
+
+        save_rss.append(rss.delta_MB)
+
+        nbytes = store.nbytes(id)
+
+        with util.PeakRSS() as rss:
+            start = time.perf_counter()
+            loaded = store.load(id)
+            timings["load"].append(time.perf_counter() - start)
+
+        load_rss.append(rss.delta_MB)
+
+        del loaded
+
+        store.delete(id)
+
+    stages = {stage: util.summarize(values) for stage, values in timings.items()}
+
+    return {
+        "bytes": nbytes,
+        "save_MBps": nbytes / stages["save"]["p50"] / 1e6,
+        "load_MBps": nbytes / stages["load"]["p50"] / 1e6,
+        "save_peak_rss_delta_MB": max(save_rss),
+        "load_peak_rss_delta_MB": max(load_rss),
+        "stages": stages,
+    }
+
+
+def main(
+    shapes: List[str],
+    dtypes: List[str],
+    stores: List[str],
+    repeats: int,
+    layers: int,
+    batch: int,
+    seq: int,
+    hidden: int,
+    large_GB: float,
+    database_url: str,
+    output: str,
+):
+
+    results = []
+
+    with (
+        util.mongo(database_url) if "gridfs" in stores else nullcontext()
+    ) as database_url:
+
+        for store_name in stores:
+
+            if store_name == "memory":
+                store = BufferStore()
+            elif store_name == "file":
+                store = FileStore()
+            elif store_name == "mongomock":
+                import mongomock
+                import mongomock.gridfs
+
+                mongomock.gridfs.enable_gridfs_integration()
+
+                store = GridFSStore(mongomock.MongoClient())
+            else:
+                from pymongo import MongoClient
+
+                store = GridFSStore(MongoClient(database_url))
+
+            for shape in shapes:
+
+                for dtype in dtypes:
+
+                    value = make_value(
+                        shape, DTYPES[dtype], layers, batch, seq, hidden, large_GB
+                    )
+
+                    case = run_case(store, value, repeats)
+
+                    del value
+
+                    print(
+                        f"{store_name:<10} {shape:<7} {dtype:<5} "
+                        f"{case['bytes'] / 1e6:>10.1f}MB "
+                        f"save {case['save_MBps']:>9.1f}MB/s "
+                        f"load {case['load_MBps']:>9.1f}MB/s "
+                        f"peak rss +{max(case['save_peak_rss_delta_MB'], case['load_peak_rss_delta_MB']):.0f}MB"
+                    )
+
+                    results.append(
+                        {"store": store_name, "shape": shape, "dtype": dtype, **case}
+                    )
+
+    util.report({"results": results}, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=["small", "layers", "large"],
+        default=["small", "layers"],
+    )
+    parser.add_argument(
+        "--dtypes", nargs="+", choices=list(DTYPES), default=list(DTYPES)
+    )
+    parser.add_argument(
+        "--stores",
+        nargs="+",
+        choices=["memory", "file", "mongomock", "gridfs"],
+        default=["memory", "file"],
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--layers", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--seq", type=int, default=128)
+    parser.add_argument("--hidden", type=int, default=4096)
+    parser.add_argument("--large-GB", dest="large_GB", type=float, default=2.0)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
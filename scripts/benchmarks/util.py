@@ -0,0 +1,183 @@
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parents[2]
+
+API_SERVICE_PATH = ROOT / "services" / "api"
+RAY_SERVICE_PATH = ROOT / "services" / "ray_head"
+
+
+def add_service_path(path: Path) -> None:
+    """Makes a service's `src` package importable, as it is inside that service's container."""
+
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+
+def free_port() -> int:
+
+    with socket.socket() as sock:
+
+        sock.bind(("127.0.0.1", 0))
+
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def mongo(database_url: str = None):
+    """Yields database_url, or starts a throwaway mongod when none is given."""
+
+    if database_url is not None:
+
+        yield database_url
+
+        return
+
+    if shutil.which("mongod") is None:
+        raise RuntimeError("No --database-url given and `mongod` is not on PATH.")
+
+    port = free_port()
+
+    with tempfile.TemporaryDirectory() as dbpath:
+
+        process = subprocess.Popen(
+            [
+                "mongod",
+                "--dbpath",
+                dbpath,
+                "--port",
+                str(port),
+                "--bind_ip",
+                "127.0.0.1",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+
+        database_url = f"mongodb://127.0.0.1:{port}"
+
+        try:
+
+            from pymongo import MongoClient
+
+            MongoClient(database_url, serverSelectionTimeoutMS=30000).admin.command(
+                "ping"
+            )
+
+            yield database_url
+
+        finally:
+
+            process.terminate()
+            process.wait()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linearly interpolated percentile of values, q in [0, 100]."""
+
+    if not values:
+        return float("nan")
+
+    values = sorted(values)
+
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else float("nan"),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def rss_MB() -> float:
+    """Current resident set size of this process in MB."""
+
+    try:
+        with open("/proc/self/statm", "r") as file:
+            pages = int(file.read().split()[1])
+
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+    # Not Linux, fall back to the lifetime peak (KB on Linux, bytes on macOS).
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+class PeakRSS:
+    """Samples resident set size in a background thread while in context.
+
+    Attributes:
+        baseline_MB (float): RSS on entry.
+        peak_MB (float): Highest RSS sampled.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+
+        self.interval = interval
+
+        self.baseline_MB = None
+        self.peak_MB = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+
+        while not self._stop.is_set():
+
+            self.peak_MB = max(self.peak_MB, rss_MB())
+
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "PeakRSS":
+
+        self.baseline_MB = self.peak_MB = rss_MB()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+
+        self._stop.set()
+        self._thread.join()
+
+        self.peak_MB = max(self.peak_MB, rss_MB())
+
+    @property
+    def delta_MB(self) -> float:
+
+        return self.peak_MB - self.baseline_MB
+
+
+def report(results: Dict, output: str = None) -> None:
+
+    print(json.dumps(results, indent=2))
+
+    if output is not None:
+
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
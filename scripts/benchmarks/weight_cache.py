@@ -0,0 +1,186 @@
+"""Benchmark of the shared weight cache: replicas of one model started together on a node,
+each loading the model on its own, and through a WeightCache.
+
+Every replica is a process loading a GPT-2 checkpoint built from its config and saved to a
+temporary directory, so nothing is downloaded. Reports each way's load time and the host
+memory of the replicas: unique (USS, private to each), and proportional (PSS, shared pages
+split between the processes mapping them), summed over replicas.
+
+    python scripts/benchmarks/weight_cache.py --replicas 4 --layers 12 --hidden 1024 --dtype float16
+"""
+
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+import psutil
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+
+def save_checkpoint(path: str, layers: int, hidden: int) -> None:
+
+    torch.manual_seed(0)
+
+    GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=layers,
+            n_embd=hidden,
+            n_head=max(1, hidden // 64),
+            vocab_size=1000,
+            bos_token_id=0,
+            eos_token_id=0,
+        )
+    ).save_pretrained(path)
+
+    tokenizer = Tokenizer(
+        models.WordLevel({f"t{index}": index for index in range(1000)}, unk_token="t0")
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="t0", unk_token="t0"
+    ).save_pretrained(path)
+
+
+def replica(
+    model_key: str, directory: str, cached: bool, loaded, done, results
+) -> None:
+
+    from nnsight.models.mixins import RemoteableMixin
+
+    from src.ray.weight_cache import WeightCache
+
+    start = time.perf_counter()
+
+    if cached:
+        model = WeightCache(directory).load(model_key)
+    else:
+        model = RemoteableMixin.from_model_key(model_key, dispatch=True)
+
+    seconds = time.perf_counter() - start
+
+    with torch.no_grad():
+        logits = model._model(torch.tensor([[1, 2, 3]])).logits
+
+    loaded.wait()
+
+    memory = psutil.Process().memory_full_info()
+
+    results.put(
+        {
+            "seconds": seconds,
+            "uss": memory.uss,
+            "pss": memory.pss,
+            "checksum": float(logits.double().sum()),
+        }
+    )
+
+    # Alive until every replica is measured, so shared pages stay shared.
+    done.wait()
+
+
+def run(model_key: str, directory: str, cached: bool, replicas: int) -> List[Dict]:
+
+    context = multiprocessing.get_context("spawn")
+
+    loaded = context.Barrier(replicas + 1)
+    done = context.Event()
+    results = context.Queue()
+
+    processes = [
+        context.Process(
+            target=replica,
+            args=(model_key, directory, cached, loaded, done, results),
+        )
+        for _ in range(replicas)
+    ]
+
+    for process in processes:
+        process.start()
+
+    loaded.wait()
+
+    measurements = [results.get() for _ in range(replicas)]
+
+    done.set()
+
+    for process in processes:
+        process.join()
+
+    return measurements
+
+
+def summarize(measurements: List[Dict]) -> Dict:
+
+    return {
+        "p50_load_seconds": statistics.median(m["seconds"] for m in measurements),
+        "max_load_seconds": max(m["seconds"] for m in measurements),
+        "total_uss_MB": sum(m["uss"] for m in measurements) * 1e-6,
+        "total_pss_MB": sum(m["pss"] for m in measurements) * 1e-6,
+    }
+
+
+def main(replicas: int, layers: int, hidden: int, dtype: str, output: str):
+
+    with tempfile.TemporaryDirectory() as checkpoint, tempfile.TemporaryDirectory(
+        dir="/dev/shm" if os.path.isdir("/dev/shm") else None
+    ) as directory:
+
+        save_checkpoint(checkpoint, layers, hidden)
+
+        checkpoint_bytes = sum(
+            os.path.getsize(os.path.join(checkpoint, name))
+            for name in os.listdir(checkpoint)
+            if name.endswith(".safetensors")
+        )
+
+        options = {"repo_id": checkpoint}
+
+        # Converted while loading, the weights are no longer the checkpoint's mapped pages.
+        if dtype is not None:
+            options["torch_dtype"] = dtype
+
+        model_key = "nnsight.models.LanguageModel.LanguageModel:" + json.dumps(options)
+
+        own = run(model_key, directory, False, replicas)
+        # The first replica writes the snapshot, the others wait for it.
+        cold = run(model_key, directory, True, replicas)
+        # Scaling out next to replicas that already wrote it.
+        warm = run(model_key, directory, True, replicas)
+
+    report = {
+        "replicas": replicas,
+        "dtype": dtype,
+        "checkpoint_MB": checkpoint_bytes * 1e-6,
+        "matching_outputs": len({m["checksum"] for m in own + cold + warm}) == 1,
+        "own": summarize(own),
+        "cached_cold": summarize(cold),
+        "cached_warm": summarize(warm),
+    }
+
+    util.report(report, output=output)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--replicas", type=int, default=4)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--dtype", default=None)
+    parser.add_argument("--output", default=None)
+
+    main(**vars(parser.parse_args()))
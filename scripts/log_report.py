@@ -0,0 +1,576 @@
+"""Report of job latency, errors and throughput, and API traffic, from gunicorn and Ray logs.
+
+Reads the status lines responses are logged with (`id - STATUS: description`) and gunicorn
+access lines, one line at a time, from any number of log files. Rotated files of one log
+(`api.log.2.gz`, `api.log.1`, `api.log`) are read oldest first, and the logs are merged by
+timestamp, so status transitions of a job are joined across the API's and the replicas'
+logs. Compressed files (.gz, .bz2, .xz and, with zstandard installed, .zst) are read as
+they are. Memory stays constant in the length of the logs: percentiles come from sketches
+with 1% relative error, and only jobs still waiting for a later status are held.
+
+Per model it reports queue time (RECEIVED to the last of APPROVED and RUNNING, the time
+until the job was dispatched to a replica), run time (from there to COMPLETED or ERROR,
+which includes waiting for the replica, as replicas don't log when they start a job),
+total time, error rate, the most common errors, and jobs finished per minute. Jobs are
+attributed to the model of the `Model:<app>` name in the log lines or file names of their
+replica. Per route it reports requests and error rates, and per day the unique IPs
+downloading results.
+
+    python scripts/log_report.py logs/api/ logs/ray/serve/ --json report.json
+"""
+
+import bz2
+import gzip
+import heapq
+import io
+import json
+import lzma
+import math
+import os
+import re
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from glob import glob
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except:
+    pass
+
+STATUS_REGEX = re.compile(
+    r"\b([0-9a-f]{24}) - (RECEIVED|APPROVED|RUNNING|COMPLETED|LOG|ERROR): ?(.*)$"
+)
+# gunicorn's default access log format.
+ACCESS_REGEX = re.compile(r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\w+) (\S+)[^"]*" (\d{3})')
+# Python logging's asctime, as in gunicorn's and Ray's logs.
+TIMESTAMP_REGEX = re.compile(
+    r"(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[,.]\d+)?(?: ?(?:[+-]\d{2}:?\d{2}|Z))?)"
+)
+# App names of model replicas (Model:{slugified model key}).
+MODEL_REGEX = re.compile(r"Model:([A-Za-z0-9.\-]+)")
+# Suffixes of rotated and compressed log files.
+ROTATION_REGEX = re.compile(r"(?:[.-]\d+)*(?:\.(?:gz|bz2|xz|zst))?$")
+ID_REGEX = re.compile(r"[0-9a-f]{24}")
+NUMBER_REGEX = re.compile(r"\d+")
+
+TERMINAL = ("COMPLETED", "ERROR")
+
+# Most distinct routes and errors counted. Others are counted together.
+MAX_KEYS = 100
+
+
+class Quantiles:
+    """Percentiles of a stream of non-negative values within relative_error, in memory
+    logarithmic in the range of the values (a DDSketch)."""
+
+    def __init__(self, relative_error: float = 0.01) -> None:
+
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+
+        self.buckets: Dict[int, int] = defaultdict(int)
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float, count: int = 1) -> None:
+
+        self.count += count
+        self.total += value * count
+
+        if value <= 1e-9:
+            self.zeros += count
+        else:
+            self.buckets[math.ceil(math.log(value) / self.log_gamma)] += count
+
+    def quantile(self, q: float) -> Optional[float]:
+
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+
+        if rank < self.zeros:
+            return 0.0
+
+        seen = self.zeros
+
+        for index in sorted(self.buckets):
+
+            seen += self.buckets[index]
+
+            if seen > rank:
+                return 2 * self.gamma**index / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def summary(self) -> Dict:
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Counts:
+    """Counts of at most MAX_KEYS keys, with the rest counted as `other`."""
+
+    def __init__(self) -> None:
+
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def add(self, key: str) -> None:
+
+        if key not in self.counts and len(self.counts) >= MAX_KEYS:
+            key = "other"
+
+        self.counts[key] += 1
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:n]
+
+
+class PerMinute:
+    """Events per minute, including minutes without any between the first and the last."""
+
+    def __init__(self) -> None:
+
+        self.quantiles = Quantiles()
+
+        self.minute: Optional[int] = None
+        self.count = 0
+
+    def add(self, timestamp: float) -> None:
+
+        minute = int(timestamp // 60)
+
+        if self.minute is None:
+            self.minute = minute
+
+        if minute > self.minute:
+
+            self.quantiles.add(self.count)
+            self.quantiles.add(0, minute - self.minute - 1)
+
+            self.minute = minute
+            self.count = 0
+
+        self.count += 1
+
+    def summary(self) -> Dict:
+
+        # The last minute is most likely cut off by the end of the logs, so it isn't counted.
+        return self.quantiles.summary()
+
+
+class ModelStats:
+
+    def __init__(self) -> None:
+
+        self.queue = Quantiles()
+        self.run = Quantiles()
+        self.total = Quantiles()
+        self.per_minute = PerMinute()
+
+        self.completed = 0
+        self.errors = 0
+        self.error_descriptions = Counts()
+
+    def summary(self) -> Dict:
+
+        finished = self.completed + self.errors
+
+        return {
+            "completed": self.completed,
+            "errors": self.errors,
+            "error_rate": self.errors / finished if finished else None,
+            "queue_seconds": self.queue.summary(),
+            "run_seconds": self.run.summary(),
+            "total_seconds": self.total.summary(),
+            "finished_per_minute": self.per_minute.summary(),
+            "top_errors": self.error_descriptions.top(5),
+        }
+
+
+class Job:
+
+    __slots__ = ("received", "dispatched", "model_key")
+
+    def __init__(self) -> None:
+
+        self.received: Optional[float] = None
+        self.dispatched: Optional[float] = None
+        self.model_key: Optional[str] = None
+
+
+class Report:
+    """Joins status lines by job id and aggregates them and access lines.
+
+    Attributes:
+        max_open (int): Most jobs waiting for a later status. Older ones are counted as lost.
+    """
+
+    def __init__(self, max_open: int) -> None:
+
+        self.max_open = max_open
+
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # Jobs finished recently, as the API logs final responses again when it forwards
+        # them to blocking clients.
+        self.finished: "OrderedDict[str, None]" = OrderedDict()
+
+        self.models: Dict[str, ModelStats] = defaultdict(ModelStats)
+        self.lost = 0
+
+        self.routes: Dict[str, Counts] = defaultdict(Counts)
+        self.requests_per_minute = PerMinute()
+
+        self.day: Optional[str] = None
+        self.day_ips: set = set()
+        self.unique_result_ips: Dict[str, int] = {}
+
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+
+    def status(
+        self,
+        timestamp: float,
+        id: str,
+        status: str,
+        description: str,
+        model_key: Optional[str],
+    ) -> None:
+
+        if status == "LOG" or id in self.finished:
+            return
+
+        job = self.jobs.get(id)
+
+        if job is None:
+
+            job = self.jobs[id] = Job()
+
+            if len(self.jobs) > self.max_open:
+
+                self.jobs.popitem(last=False)
+                self.lost += 1
+
+        if model_key is not None:
+            job.model_key = model_key
+
+        if status == "RECEIVED":
+            job.received = timestamp
+
+        elif status in ("APPROVED", "RUNNING"):
+            job.dispatched = timestamp
+
+        if status not in TERMINAL:
+            return
+
+        del self.jobs[id]
+
+        self.finished[id] = None
+
+        if len(self.finished) > self.max_open:
+            self.finished.popitem(last=False)
+
+        stats = self.models[job.model_key or "unknown"]
+
+        stats.per_minute.add(timestamp)
+
+        if status == "COMPLETED":
+            stats.completed += 1
+        else:
+
+            stats.errors += 1
+
+            stats.error_descriptions.add(
+                NUMBER_REGEX.sub("N", ID_REGEX.sub("{id}", description))[:100]
+            )
+
+        if job.received is not None and job.dispatched is not None:
+            stats.queue.add(job.dispatched - job.received)
+
+        if job.dispatched is not None:
+            stats.run.add(timestamp - job.dispatched)
+
+        if job.received is not None:
+            stats.total.add(timestamp - job.received)
+
+    def access(
+        self, timestamp: float, ip: str, method: str, path: str, code: str
+    ) -> None:
+
+        route = f"{method} {ID_REGEX.sub('{id}', path.split('?')[0])}"
+
+        if route not in self.routes and len(self.routes) >= MAX_KEYS:
+            route = "other"
+
+        self.routes[route].add(f"{code[0]}xx")
+        self.requests_per_minute.add(timestamp)
+
+        if route != "GET /result/{id}":
+            return
+
+        day = datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+
+        if day != self.day:
+
+            self.day = day
+            self.day_ips = set()
+
+        self.day_ips.add(ip)
+        self.unique_result_ips[day] = len(self.day_ips)
+
+    def add(self, event: Tuple) -> None:
+
+        timestamp, kind, *fields = event
+
+        if self.first is None:
+            self.first = timestamp
+
+        self.last = timestamp
+
+        if kind == "status":
+            self.status(timestamp, *fields)
+        else:
+            self.access(timestamp, *fields)
+
+    def summary(self) -> Dict:
+
+        return {
+            "start": _isoformat(self.first),
+            "end": _isoformat(self.last),
+            "models": {
+                model_key: stats.summary()
+                for model_key, stats in sorted(self.models.items())
+            },
+            "unfinished_jobs": len(self.jobs),
+            "lost_jobs": self.lost,
+            "routes": {
+                route: dict(counts.counts)
+                for route, counts in sorted(
+                    self.routes.items(), key=lambda item: -sum(item[1].counts.values())
+                )
+            },
+            "requests_per_minute": self.requests_per_minute.summary(),
+            "unique_result_ips": self.unique_result_ips,
+        }
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+
+    if timestamp is None:
+        return None
+
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _timestamp(value: datetime) -> float:
+
+    # Logs without a UTC offset are taken to be in UTC.
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+
+    return value.timestamp()
+
+
+def open_log(path: str) -> io.TextIOBase:
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", errors="replace")
+
+    if path.endswith(".xz"):
+        return lzma.open(path, "rt", errors="replace")
+
+    if path.endswith(".zst"):
+        return io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(open(path, "rb")),
+            errors="replace",
+        )
+
+    return open(path, "r", errors="replace")
+
+
+def parse(line: str, model_key: Optional[str]) -> Optional[Tuple]:
+    """The event of a log line, or None if it is neither a status nor an access line."""
+
+    if " - " in line:
+
+        match = STATUS_REGEX.search(line)
+
+        if match is not None:
+
+            timestamp = TIMESTAMP_REGEX.search(line, 0, match.start())
+
+            if timestamp is None:
+                return None
+
+            model = MODEL_REGEX.search(line, 0, match.start())
+
+            return (
+                _timestamp(datetime.fromisoformat(timestamp[1].replace(",", "."))),
+                "status",
+                match[1],
+                match[2],
+                match[3],
+                model[1] if model is not None else model_key,
+            )
+
+    match = ACCESS_REGEX.match(line)
+
+    if match is not None:
+
+        try:
+            timestamp = datetime.strptime(match[2], "%d/%b/%Y:%H:%M:%S %z")
+        except ValueError:
+            return None
+
+        return (_timestamp(timestamp), "access", match[1], match[3], match[4], match[5])
+
+    return None
+
+
+def read(paths: List[str]) -> Iterator[Tuple]:
+    """Events of rotated log files, oldest first."""
+
+    for path in paths:
+
+        model = MODEL_REGEX.search(os.path.basename(path))
+        model_key = model[1] if model is not None else None
+
+        with open_log(path) as file:
+
+            for line in file:
+
+                event = parse(line.rstrip("\n"), model_key)
+
+                if event is not None:
+                    yield event
+
+
+def find_logs(paths: List[str]) -> Dict[str, List[str]]:
+    """Log files under paths (files, directories or globs), grouped by the log they were
+    rotated from, oldest first."""
+
+    files = []
+
+    for path in paths:
+
+        if os.path.isdir(path):
+
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+
+        else:
+            files.extend(glob(path))
+
+    logs = defaultdict(list)
+
+    for file in files:
+        logs[ROTATION_REGEX.sub("", file)].append(file)
+
+    for rotated in logs.values():
+        rotated.sort(key=os.path.getmtime)
+
+    return logs
+
+
+def show(summary: Dict) -> None:
+
+    def percentiles(quantiles: Dict) -> str:
+
+        if not quantiles["count"]:
+            return "-"
+
+        return f"{quantiles['p50']:.2f}/{quantiles['p90']:.2f}/{quantiles['p99']:.2f}"
+
+    print(f"Logs from {summary['start']} to {summary['end']}")
+    print()
+    print(
+        f"{'model':<40} {'done':>8} {'errors':>7} {'queue s p50/90/99':>20} "
+        f"{'run s p50/90/99':>20} {'jobs/min p50/90/99':>20}"
+    )
+
+    for model_key, stats in summary["models"].items():
+
+        per_minute = stats["finished_per_minute"]
+
+        print(
+            f"{model_key:<40} {stats['completed'] + stats['errors']:>8} "
+            f"{stats['error_rate'] or 0:>7.1%} {percentiles(stats['queue_seconds']):>20} "
+            f"{percentiles(stats['run_seconds']):>20} "
+            f"{percentiles(per_minute):>20}"
+        )
+
+        for description, count in stats["top_errors"]:
+            print(f"    {count:>8}  {description}")
+
+    print()
+    print(
+        f"Unfinished jobs: {summary['unfinished_jobs']}, lost: {summary['lost_jobs']}"
+    )
+
+    if summary["routes"]:
+
+        print()
+        print(f"{'route':<40} {'requests':>10} {'4xx':>7} {'5xx':>7}")
+
+        for route, codes in summary["routes"].items():
+
+            total = sum(codes.values())
+
+            print(
+                f"{route:<40} {total:>10} {codes.get('4xx', 0) / total:>7.1%} "
+                f"{codes.get('5xx', 0) / total:>7.1%}"
+            )
+
+    if summary["unique_result_ips"]:
+
+        print()
+        print("Unique IPs downloading results per day:")
+
+        for day, ips in summary["unique_result_ips"].items():
+            print(f"    {day}  {ips}")
+
+
+def main(paths: List[str], max_open: int, json_path: Optional[str]):
+
+    logs = find_logs(paths)
+
+    report = Report(max_open)
+
+    for event in heapq.merge(
+        *(read(rotated) for rotated in logs.values()), key=lambda event: event[0]
+    ):
+        report.add(event)
+
+    summary = report.summary()
+
+    show(summary)
+
+    if json_path is not None:
+
+        with open(json_path, "w") as file:
+            json.dump(summary, file, indent=4)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--max-open", type=int, default=100_000)
+    parser.add_argument("--json", dest="json_path", default=None)
+
+    main(**vars(parser.parse_args()))
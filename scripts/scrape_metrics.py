@@ -0,0 +1,255 @@
+"""Scrape test of the metrics surface, needing no Prometheus or other collector.
+
+Records every metric of src.telemetry.metrics in --workers processes sharing a
+PROMETHEUS_MULTIPROC_DIR, as the API's gunicorn workers do, and in a Ray actor, as model
+replicas do. Then scrapes the API's exposition, served over HTTP as /metrics serves it, and
+the metrics agent of a local Ray node, and checks each metric is there with the updates of
+every process. Exits non-zero if any is missing or wrong.
+
+    python scripts/scrape_metrics.py --workers 2
+"""
+
+import os
+import sys
+import tempfile
+
+# Read by prometheus_client when it is imported, here and in the workers, which inherit it
+# rather than making their own when they import this module.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="ndif-metrics-")
+)
+
+import multiprocessing
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List
+
+import ray
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "benchmarks"))
+
+import util
+
+util.add_service_path(util.RAY_SERVICE_PATH)
+
+from src.telemetry import metrics
+
+# Label value every update is made with, so other series are ignored.
+LABEL_VALUE = "scrape-test"
+
+# Ray's metrics agent prefixes custom metrics with `ray_`.
+NAME_REGEX = r"^(?:ray_)?(ndif_\w+)$"
+
+
+def instruments() -> Dict[str, object]:
+
+    return {
+        metric.name: metric
+        for metric in vars(metrics).values()
+        if isinstance(metric, (metrics.Histogram, metrics.LabeledMetric))
+    }
+
+
+def record() -> None:
+    """Updates every metric once."""
+
+    for metric in instruments().values():
+
+        if isinstance(metric, metrics.Histogram):
+            metric.observe(0.1, model_key=LABEL_VALUE)
+        elif isinstance(metric, metrics.Gauge):
+            metric.set(1, LABEL_VALUE)
+        else:
+            metric.inc(LABEL_VALUE)
+
+
+@ray.remote
+class Replica:
+
+    def record(self) -> None:
+
+        record()
+
+
+def serve(port: int) -> HTTPServer:
+    """Serves metrics.generate_latest at /metrics, as the API does."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            content = metrics.generate_latest()
+
+            self.send_response(200)
+            self.send_header("Content-Type", metrics.CONTENT_TYPE_LATEST)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", port), Handler)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def scrape(url: str) -> Dict[str, Dict[str, float]]:
+    """Values of the scrape-test series of each ndif metric at url, by sample suffix
+    (_count for histograms, _total for counters, "" for gauges)."""
+
+    values = defaultdict(dict)
+
+    for family in text_string_to_metric_families(requests.get(url).text):
+
+        match = re.match(NAME_REGEX, family.name)
+
+        if match is None:
+            continue
+
+        for sample in family.samples:
+
+            if LABEL_VALUE not in sample.labels.values():
+                continue
+
+            suffix = sample.name[len(family.name) :]
+
+            if suffix in ("_count", "_total", ""):
+                values[match.group(1)][suffix] = sample.value
+
+    return values
+
+
+def expected(metric: object, processes: int) -> float:
+    """Scraped value of a metric updated once by each of processes."""
+
+    # Gauges set to 1 are only summed across processes in the sum modes.
+    if isinstance(metric, metrics.Gauge) and metric.multiprocess_mode not in (
+        "sum",
+        "livesum",
+    ):
+        return 1
+
+    return processes
+
+
+def check(values: Dict[str, Dict[str, float]], processes: int) -> List[str]:
+    """Problems with the scraped values, given every metric was updated once by each of
+    processes."""
+
+    problems = []
+
+    for name, metric in instruments().items():
+
+        if isinstance(metric, metrics.Histogram):
+            suffix = "_count"
+        elif isinstance(metric, metrics.Gauge):
+            suffix = ""
+        else:
+            suffix = "_total"
+
+        value = values.get(name, {}).get(suffix)
+
+        if value is None:
+            problems.append(f"{name}{suffix} missing")
+        elif value != expected(metric, processes):
+            problems.append(
+                f"{name}{suffix} is {value}, expected {expected(metric, processes)}"
+            )
+
+    return problems
+
+
+def check_api(workers: int) -> List[str]:
+
+    processes = [
+        multiprocessing.get_context("spawn").Process(target=record)
+        for _ in range(workers)
+    ]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    port = util.free_port()
+
+    server = serve(port)
+
+    try:
+        return check(scrape(f"http://127.0.0.1:{port}/metrics"), workers)
+    finally:
+        server.shutdown()
+
+
+def check_ray(timeout_seconds: float) -> List[str]:
+
+    port = util.free_port()
+
+    ray.init(
+        _metrics_export_port=port,
+        runtime_env={"env_vars": {"PYTHONPATH": str(util.RAY_SERVICE_PATH)}},
+        include_dashboard=False,
+        logging_level="ERROR",
+    )
+
+    try:
+
+        replica = Replica.remote()
+
+        ray.get(replica.record.remote())
+
+        # The agent exports what replicas report every few seconds.
+        deadline = time.monotonic() + timeout_seconds
+
+        while True:
+
+            problems = check(scrape(f"http://127.0.0.1:{port}/metrics"), 1)
+
+            if not problems or time.monotonic() > deadline:
+                return problems
+
+            time.sleep(1)
+
+    finally:
+        ray.shutdown()
+
+
+def main(workers: int, timeout_seconds: float):
+
+    failed = False
+
+    for name, problems in (
+        ("API", check_api(workers)),
+        ("Ray", check_ray(timeout_seconds)),
+    ):
+
+        print(
+            f"=> {name}: {len(instruments()) - len(problems)}/{len(instruments())} ok"
+        )
+
+        for problem in problems:
+            print(f"   {problem}")
+
+        failed = failed or bool(problems)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--timeout-seconds", type=float, default=60)
+
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,90 @@
+import json
+from collections import defaultdict
+from datetime import datetime
+
+
+def load_spans(file_paths):
+
+    spans = []
+
+    for file_path in file_paths:
+
+        with open(file_path, "r") as file:
+
+            for line in file:
+
+                line = line.strip()
+
+                if line:
+                    spans.append(json.loads(line))
+
+    return spans
+
+
+def duration(span):
+
+    start = datetime.fromisoformat(span["start_time"].rstrip("Z"))
+    end = datetime.fromisoformat(span["end_time"].rstrip("Z"))
+
+    return (end - start).total_seconds()
+
+
+def main(file_paths, request_id):
+
+    spans = load_spans(file_paths)
+
+    trace_ids = {
+        span["context"]["trace_id"]
+        for span in spans
+        if span["attributes"].get("ndif.request_id") == request_id
+    }
+
+    spans = [span for span in spans if span["context"]["trace_id"] in trace_ids]
+
+    if not spans:
+
+        print(f"No spans found for request `{request_id}`")
+
+        return
+
+    span_ids = {span["context"]["span_id"] for span in spans}
+
+    children = defaultdict(list)
+
+    for span in spans:
+
+        parent_id = span["parent_id"] if span["parent_id"] in span_ids else None
+
+        children[parent_id].append(span)
+
+    def show(span, depth):
+
+        attributes = span["attributes"]
+        resource = span["resource"]["attributes"]
+
+        rank = attributes.get("rank", resource.get("rank"))
+
+        print(
+            f"{'  ' * depth}{span['name']:<32} {duration(span):>10.4f}s"
+            f"  [{resource.get('service.name')}{'' if rank is None else f' rank={rank}'}]"
+        )
+
+        for child in sorted(
+            children[span["context"]["span_id"]], key=lambda s: s["start_time"]
+        ):
+            show(child, depth + 1)
+
+    for root in sorted(children[None], key=lambda s: s["start_time"]):
+        show(root, 0)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("request_id")
+    parser.add_argument("file_paths", nargs="+")
+
+    main(**vars(parser.parse_args()))
@@ -1,14 +1,44 @@
+import abc
+import asyncio
+import hashlib
+import logging
 import os
+import threading
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
 
-import firebase_admin
-from cachetools import TTLCache, cached
+from cachetools import TTLCache
 from fastapi import HTTPException, Security
 from fastapi.security.api_key import APIKeyHeader
-from firebase_admin import credentials, firestore
+from pymongo import MongoClient, ReplaceOne
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_401_UNAUTHORIZED
 
+from .rate_limit import rate_limiter
+from .util import SingleFlight
 
-class ApiKeyStore:
+try:
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+except:
+    pass
+
+logger = logging.getLogger("gunicorn.error")
+
+
+class ApiKeyBackend(abc.ABC):
+    """Source of truth for which API keys exist. Methods are blocking and run in a threadpool."""
+
+    @abc.abstractmethod
+    def exists(self, api_key: str) -> bool:
+        """Whether the key exists."""
+
+    @abc.abstractmethod
+    def keys(self) -> Iterable[str]:
+        """All existing keys, used to warm the cache."""
+
+
+class FirestoreApiKeyBackend(ApiKeyBackend):
 
     def __init__(self, cred_path: str) -> None:
 
@@ -23,29 +53,278 @@ class ApiKeyStore:
 
         self.firestore_client = firestore.client()
 
-    @cached(cache=TTLCache(maxsize=1024, ttl=60))
-    def does_api_key_exist(self, api_key: str) -> bool:
+    def exists(self, api_key: str) -> bool:
 
         doc = self.firestore_client.collection("keys").document(api_key).get()
 
         return doc.exists
 
+    def keys(self) -> Iterable[str]:
+
+        # Only document ids are needed, not their fields.
+        for doc in self.firestore_client.collection("keys").select([]).stream():
+            yield doc.id
+
+
+class LocalApiKeyBackend(ApiKeyBackend):
+    """Stand-in backend reading keys from a file with one key per line."""
+
+    def __init__(self, keys_path: str) -> None:
+
+        with open(keys_path, "r") as file:
+            self._keys = {line.strip() for line in file if line.strip()}
+
+    def exists(self, api_key: str) -> bool:
+
+        return api_key in self._keys
+
+    def keys(self) -> Iterable[str]:
+
+        return iter(self._keys)
+
+
+class ApiKeyStore:
+    """Verifies API keys without blocking the event loop.
+
+    Lookups go through an in-process cache, then a cache shared by all API workers in Mongo, then
+    the backend. Concurrent lookups of the same key share one in-flight lookup (single flight).
+    Keys that do not exist are cached for longer than keys that do, so floods of invalid keys do
+    not reach the backend.
+
+    Once started, the caches are warmed with every key the backend lists, and re-warmed every
+    warm_interval seconds. Warming also drops keys the backend no longer lists, so a revoked
+    key stops working within warm_interval rather than ttl.
+
+    Attributes:
+        backend (ApiKeyBackend): Source of truth for keys.
+        client (MongoClient): Connection for the shared cache. No shared cache if None.
+        ttl (float): Seconds to cache existing keys.
+        negative_ttl (float): Seconds to cache keys that do not exist.
+        warm_interval (float): Seconds between warm-ups. Shorter than ttl, so warmed keys
+            don't expire between them. No warm-ups if None.
+    """
+
+    def __init__(
+        self,
+        backend: ApiKeyBackend,
+        client: Optional[MongoClient] = None,
+        ttl: float = 60,
+        negative_ttl: float = 600,
+        warm_interval: Optional[float] = 30,
+        maxsize: int = 65536,
+    ) -> None:
+
+        self.backend = backend
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.warm_interval = warm_interval
+
+        self._positive = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._negative = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self._lock = threading.Lock()
+
+        self._single_flight = SingleFlight()
+
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def collection(self):
+
+        return self.client["ndif_database"]["api_key_cache"]
+
+    @staticmethod
+    def _hash(api_key: str) -> str:
+
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def _get_local(self, api_key: str) -> Optional[bool]:
+
+        with self._lock:
+
+            if api_key in self._positive:
+                return True
+
+            if api_key in self._negative:
+                return False
+
+        return None
+
+    def _set_local(self, api_key: str, exists: bool) -> None:
+
+        with self._lock:
+
+            (self._positive if exists else self._negative)[api_key] = True
+
+    def _get_shared(self, api_key: str) -> Optional[bool]:
+
+        if self.client is None:
+            return None
+
+        doc = self.collection.find_one(
+            {"_id": self._hash(api_key), "expires": {"$gt": datetime.utcnow()}}
+        )
+
+        return None if doc is None else doc["exists"]
+
+    def _set_shared(self, api_key: str, exists: bool) -> None:
+
+        if self.client is None:
+            return
+
+        ttl = self.ttl if exists else self.negative_ttl
+
+        self.collection.replace_one(
+            {"_id": self._hash(api_key)},
+            {
+                "exists": exists,
+                "expires": datetime.utcnow() + timedelta(seconds=ttl),
+            },
+            upsert=True,
+        )
+
+    def _lookup(self, api_key: str) -> bool:
+
+        exists = self._get_shared(api_key)
+
+        if exists is None:
+
+            exists = self.backend.exists(api_key)
+
+            self._set_shared(api_key, exists)
+
+        return exists
+
+    async def verify(self, api_key: str) -> bool:
+
+        exists = self._get_local(api_key)
+
+        if exists is None:
+
+            exists = await self._single_flight.run(api_key, self._lookup, api_key)
+
+            self._set_local(api_key, exists)
+
+        return exists
+
+    def _warm(self) -> int:
+
+        if self.client is not None:
+
+            # Mongo removes expired entries in the background.
+            self.collection.create_index("expires", expireAfterSeconds=0)
+
+        api_keys = list(self.backend.keys())
+
+        listed = set(api_keys)
+
+        with self._lock:
+
+            for api_key in list(self._positive):
+                if api_key not in listed:
+                    del self._positive[api_key]
+
+            for api_key in api_keys:
+                self._positive[api_key] = True
+
+        if self.client is not None:
+
+            hashes = [self._hash(api_key) for api_key in api_keys]
+
+            self.collection.delete_many({"exists": True, "_id": {"$nin": hashes}})
+
+        if self.client is not None and api_keys:
+
+            expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+
+            self.collection.bulk_write(
+                [
+                    ReplaceOne(
+                        {"_id": self._hash(api_key)},
+                        {"exists": True, "expires": expires},
+                        upsert=True,
+                    )
+                    for api_key in api_keys
+                ],
+                ordered=False,
+            )
+
+        return len(api_keys)
+
+    async def warm(self) -> int:
+        """Caches every key the backend knows about, and drops cached keys it doesn't.
+
+        Returns:
+            int: Number of keys cached.
+        """
+
+        return await run_in_threadpool(self._warm)
+
+    async def _rewarm(self) -> None:
+
+        while True:
+
+            await asyncio.sleep(self.warm_interval)
+
+            try:
+                await self.warm()
+            except Exception as exception:
+                logger.warning(f"Failed to re-warm API key cache: {exception}")
+
+    async def start(self) -> None:
+
+        try:
+            logger.info(f"Warmed API key cache with {await self.warm()} keys")
+        except Exception as exception:
+            logger.warning(f"Failed to warm API key cache: {exception}")
+
+        if self.warm_interval is not None:
+            self._task = asyncio.create_task(self._rewarm())
+
+    async def stop(self) -> None:
+
+        if self._task is not None:
+            self._task.cancel()
+
 
 FIREBASE_CREDS_PATH = os.environ.get("FIREBASE_CREDS_PATH", None)
+API_KEYS_PATH = os.environ.get("API_KEYS_PATH", None)
+
+api_key_store: Optional[ApiKeyStore] = None
 
-if FIREBASE_CREDS_PATH is not None:
+if FIREBASE_CREDS_PATH is not None or API_KEYS_PATH is not None:
 
-    api_key_store = ApiKeyStore(FIREBASE_CREDS_PATH)
+    api_key_store = ApiKeyStore(
+        (
+            FirestoreApiKeyBackend(FIREBASE_CREDS_PATH)
+            if FIREBASE_CREDS_PATH is not None
+            else LocalApiKeyBackend(API_KEYS_PATH)
+        ),
+        client=(
+            MongoClient(os.environ["DATABASE_URL"])
+            if "DATABASE_URL" in os.environ
+            else None
+        ),
+        ttl=float(os.environ.get("API_KEY_CACHE_TTL", 60)),
+        negative_ttl=float(os.environ.get("API_KEY_NEGATIVE_CACHE_TTL", 600)),
+        warm_interval=float(os.environ.get("API_KEY_WARM_INTERVAL", 30)),
+    )
 
 api_key_header = APIKeyHeader(name="ndif-api-key", auto_error=False)
 
 
-async def api_key_auth(api_key: str = Security(api_key_header)):
+async def api_key_auth(api_key: str = Security(api_key_header)) -> Optional[str]:
 
-    if FIREBASE_CREDS_PATH is not None:
+    if api_key_store is not None:
 
-        if api_key_store.does_api_key_exist(api_key) is False:
+        if not api_key or not await api_key_store.verify(api_key):
 
             raise HTTPException(
                 status_code=HTTP_401_UNAUTHORIZED, detail="Missing or invalid API key"
             )
+
+        if rate_limiter is not None:
+
+            await rate_limiter.check(api_key)
+
+    return api_key
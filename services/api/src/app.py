@@ -2,26 +2,48 @@ import logging
 import os
 from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import Awaitable, Callable, Optional
 
 import gridfs
 import ray
 import socketio
 import uvicorn
 from bson.objectid import ObjectId
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
 from fastapi_cache.decorator import cache
 from fastapi_socketio import SocketManager
 from pymongo import MongoClient
 from ray import serve
+from starlette.concurrency import run_in_threadpool
+from starlette.status import (
+    HTTP_404_NOT_FOUND,
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+)
 
-from nnsight.schema.Request import RequestModel
+from .api_key import api_key_auth, api_key_store
+from .long_poll import StatusWatcher
+from .rate_limit import rate_limiter
+from .schema import RequestModel, ResponseModel, ResultModel, UsageModel
+from .schema.Request import ENCODINGS
+from .schema.Response import (
+    CANCELLED,
+    QUEUED_STATUSES,
+    RESULT_HANDOFF_NAME,
+    RESULT_HANDOFF_NAMESPACE,
+)
+from .session_affinity import AffinityAioPikaManager
+from .submission import Submitter
+from .telemetry import metrics, tracing
 
-from .api_key import api_key_auth
-from .schema import ResponseModel, ResultModel
+try:
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+except:
+    pass
 
 # Attach to gunicorn logger
 logger = logging.getLogger("gunicorn.error")
@@ -30,8 +52,21 @@ logger = logging.getLogger("gunicorn.error")
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     FastAPICache.init(InMemoryBackend())
+
+    if api_key_store is not None:
+        await api_key_store.start()
+
+    await status_watcher.start()
+    await submitter.start()
+
     yield
 
+    await submitter.stop()
+    await status_watcher.stop()
+
+    if api_key_store is not None:
+        await api_key_store.stop()
+
 
 # Init FastAPI app
 app = FastAPI(lifespan=lifespan)
@@ -44,10 +79,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Init async rabbitmq manager for communication between socketio servers
-socketio_manager = socketio.AsyncAioPikaManager(
-    url=os.environ["RMQ_URL"], logger=logger
-)
+# Init async rabbitmq manager for communication between socketio servers. Emits to a
+# session go to the queue of the worker holding it only.
+# Without RMQ_URL, fall back to an in-process manager which only works with a single worker.
+if "RMQ_URL" in os.environ:
+    socketio_manager = AffinityAioPikaManager(url=os.environ["RMQ_URL"], logger=logger)
+else:
+    socketio_manager = socketio.AsyncManager()
 # Init socketio manager app
 sm = SocketManager(
     app=app, mount_location="/ws", client_manager=socketio_manager, logger=logger
@@ -56,10 +94,53 @@ sm = SocketManager(
 # Init database connection
 db_connection = MongoClient(os.environ.get("DATABASE_URL"))
 
+# Wakes long-polls of /response/{id} on status changes.
+status_watcher = StatusWatcher(db_connection)
+# Longest a single long-poll may park for, in seconds.
+LONG_POLL_MAX_WAIT = float(os.environ.get("LONG_POLL_MAX_WAIT", 60))
+# Bytes of a binary request buffered before each write to the staging store.
+STAGE_CHUNK_BYTES = 4 * 1024 * 1024
+# Bytes of a handed off result sent per chunk.
+RESULT_CHUNK_BYTES = 4 * 1024 * 1024
+
 # Init Ray connection
 ray.init()
 
 
+async def submission_failed(request: RequestModel, exception: Exception) -> None:
+    """Reports a request the Request app failed to take as an ERROR, unless the Request app
+    got far enough to move it on from RECEIVED."""
+
+    response = ResponseModel.load(db_connection, request.id, result=False)
+
+    if response.status != ResponseModel.JobStatus.RECEIVED:
+        return
+
+    response = (
+        ResponseModel(
+            id=request.id,
+            received=request.received,
+            session_id=request.session_id,
+            status=ResponseModel.JobStatus.ERROR,
+            description=f"Failed to submit your job: {exception}",
+        )
+        .log(logger)
+        .save(db_connection)
+    )
+
+    if response.session_id is not None:
+        await _blocking_response(response)
+
+
+# Sends requests to the Request app in batches, with at most SUBMIT_MAX_IN_FLIGHT in flight.
+submitter = Submitter(
+    submission_failed,
+    max_in_flight=int(os.environ.get("SUBMIT_MAX_IN_FLIGHT", 1024)),
+    max_batch=int(os.environ.get("SUBMIT_MAX_BATCH", 32)),
+    batch_wait_seconds=float(os.environ.get("SUBMIT_BATCH_WAIT", 0.005)),
+)
+
+
 @app.post("/request")
 async def request(
     request: RequestModel, api_key=Depends(api_key_auth)
@@ -72,28 +153,147 @@ async def request(
     Returns:
         ResponseModel: _description_
     """
+
+    # Only binary requests are staged.
+    request.staged = False
+
+    if request.object is None:
+
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail="Missing object"
+        )
+
+    return await submit(request, api_key)
+
+
+@app.post("/request/binary")
+async def binary_request(
+    body: Request,
+    model_key: str = Header(alias="ndif-model-key"),
+    session_id: Optional[str] = Header(None, alias="ndif-session-id"),
+    content_encoding: str = Header("identity"),
+    api_key=Depends(api_key_auth),
+) -> ResponseModel:
+    """Endpoint to submit request with its object in binary form (see RequestModel.pack).
+
+    The body is streamed into the staging store without being parsed, and only a reference
+    to it is sent on to Ray.
+
+    Args:
+        body (Request): Encoded object, compressed according to the Content-Encoding header.
+        model_key (str): Model key, from the ndif-model-key header.
+        session_id (Optional[str]): Socket.IO session id, from the ndif-session-id header.
+
+    Returns:
+        ResponseModel: Response.
+    """
+
+    if content_encoding not in ENCODINGS:
+
+        raise HTTPException(
+            status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported Content-Encoding `{content_encoding}`",
+        )
+
+    request = RequestModel(model_key=model_key, session_id=session_id)
+
+    async def stage():
+
+        upload = request.stage(db_connection, content_encoding)
+
+        nbytes = 0
+        buffer = bytearray()
+
+        try:
+
+            async for chunk in body.stream():
+
+                buffer += chunk
+
+                # Write in large chunks to keep threadpool round trips few.
+                if len(buffer) >= STAGE_CHUNK_BYTES:
+
+                    nbytes += len(buffer)
+
+                    await run_in_threadpool(upload.write, bytes(buffer))
+
+                    buffer = bytearray()
+
+            nbytes += len(buffer)
+
+            await run_in_threadpool(upload.write, bytes(buffer))
+            await run_in_threadpool(upload.close)
+
+        except BaseException:
+
+            upload.abort()
+
+            raise
+
+        metrics.REQUEST_BYTES.observe(nbytes, model_key)
+
+    return await submit(request, api_key, stage=stage)
+
+
+async def submit(
+    request: RequestModel,
+    api_key: Optional[str],
+    stage: Optional[Callable[[], Awaitable[None]]] = None,
+) -> ResponseModel:
+    """Assigns the request its id, stages its object if stage is given and sends it to the
+    Request app.
+
+    Returns:
+        ResponseModel: RECEIVED response, or ERROR response if submission failed.
+    """
+
     try:
         # Set the id and time received of request.
         request.received = datetime.now()
         request.id = str(ObjectId())
-
-        # Send to request workers waiting to process requests on the "request" queue.
-        # Forget as we don't care about the response.
-        serve.get_app_handle("Request").remote(request)
-
-        # Create response object.
-        # Log and save to data backend.
-        response = (
-            ResponseModel(
-                id=request.id,
-                received=request.received,
-                session_id=request.session_id,
-                status=ResponseModel.JobStatus.RECEIVED,
-                description="Your job has been received and is waiting approval.",
-            )
-            .log(logger)
-            .save(db_connection)
+        # Set by the server only, so usage is recorded against the authenticated key.
+        request.key_id = (
+            UsageModel.key_id_from_api_key(api_key) if api_key is not None else None
+        )
+        request.max_execution_seconds = (
+            (await rate_limiter.limits(request.key_id)).max_execution_seconds
+            if rate_limiter is not None and request.key_id is not None
+            else None
         )
+        # Set by the Ray side only, so a client can't skip the cost check or skew the
+        # FLOPs per second models are calibrated with.
+        request.estimated_flops = None
+
+        # Start the request's trace. Each later stage continues it from request.trace_context.
+        with tracing.span("api.request", **{"ndif.request_id": request.id}):
+
+            if stage is not None:
+
+                with metrics.REQUEST_STAGE.time(request.model_key), tracing.span(
+                    "api.stage"
+                ):
+                    await stage()
+
+            tracing.inject(request)
+
+            # Create response object.
+            # Log and save to data backend, before the Request app can move it on.
+            response = (
+                ResponseModel(
+                    id=request.id,
+                    received=request.received,
+                    session_id=request.session_id,
+                    key_id=request.key_id,
+                    status=ResponseModel.JobStatus.RECEIVED,
+                    description="Your job has been received and is waiting approval.",
+                )
+                .log(logger)
+                .save(db_connection)
+            )
+
+            # Queue for the next batch to the Request app. Failures on the Ray side are
+            # reported through submission_failed.
+            await submitter.submit(request)
 
     except Exception as exception:
         # Create exception response object.
@@ -135,23 +335,151 @@ async def blocking_response(id: str):
 
     response = ResponseModel.load(db_connection, id, result=False)
 
+    # Wake long-polls on this worker without waiting for the change stream.
+    status_watcher.notify(id)
+
     await _blocking_response(response)
 
 
 @app.get("/response/{id}")
-async def response(id: str) -> ResponseModel:
+async def response(id: str, wait: float = 0) -> ResponseModel:
     """Endpoint to get latest response for id.
 
     Args:
         id (str): ID of request/response.
+        wait (float): Seconds to wait for the status to change if the job has not finished
+            (long-poll), capped at LONG_POLL_MAX_WAIT. Returns immediately if 0.
 
     Returns:
         ResponseModel: Response.
     """
 
-    # Load response from client given id.
-    # Don't load result.
-    return ResponseModel.load(db_connection, id, result=False)
+    waiter = status_watcher.register(id)
+
+    try:
+
+        # Load response from client given id.
+        # Don't load result.
+        response = ResponseModel.load(db_connection, id, result=False)
+
+        if wait > 0 and response.status not in (
+            ResponseModel.JobStatus.COMPLETED,
+            ResponseModel.JobStatus.ERROR,
+        ):
+
+            waiter.status = response.status
+
+            if await waiter.wait(min(wait, LONG_POLL_MAX_WAIT)):
+                response = ResponseModel.load(db_connection, id, result=False)
+
+    finally:
+
+        status_watcher.unregister(id, waiter)
+
+    return response
+
+
+@app.post("/cancel/{id}")
+async def cancel(id: str, api_key=Depends(api_key_auth)) -> ResponseModel:
+    """Endpoint to cancel a job. A queued job is not run, and a running job stops at its
+    next module call. A job that finishes before its replica notices completes as usual.
+
+    Only the API key that submitted a job can cancel it. Jobs of other keys are not found,
+    so their ids can't be probed.
+
+    Args:
+        id (str): ID of request/response.
+
+    Returns:
+        ResponseModel: Latest response. Jobs not started yet are ERROR with reason CANCELLED.
+    """
+
+    key_id = UsageModel.key_id_from_api_key(api_key) if api_key is not None else None
+
+    document = (
+        db_connection["ndif_database"]["responses"].find_one({"_id": ObjectId(id)})
+        if ObjectId.is_valid(id)
+        else None
+    )
+
+    if document is None or document.get("key_id") != key_id:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Job not found")
+
+    response = ResponseModel.load(db_connection, id, result=False)
+
+    if response.status in (
+        ResponseModel.JobStatus.COMPLETED,
+        ResponseModel.JobStatus.ERROR,
+    ):
+        return response
+
+    ResponseModel.cancel(db_connection, id)
+
+    # Replicas skip it when they reach it, the user need not wait for that.
+    if response.status in QUEUED_STATUSES:
+
+        cancelled = ResponseModel(
+            id=id,
+            received=response.received,
+            session_id=response.session_id,
+            model_key=response.model_key,
+            key_id=response.key_id,
+            status=ResponseModel.JobStatus.ERROR,
+            reason=CANCELLED,
+            description="Your job was cancelled.",
+        )
+
+        # Unless a replica started it since. The replica then stops it, and reports that.
+        if not cancelled.save_if(db_connection, QUEUED_STATUSES):
+            return ResponseModel.load(db_connection, id, result=False)
+
+        response = cancelled.log(logger)
+
+        status_watcher.notify(id)
+
+        if response.session_id is not None:
+            await _blocking_response(response)
+
+    return response
+
+
+# Handle of the result handoff store, looked up on first use.
+result_handoff: Optional[ray.actor.ActorHandle] = None
+
+
+async def handoff_result(id: str) -> Optional[tuple]:
+    """Handle of the result handoff store, size and metadata of a result it holds, or None
+    if it doesn't hold it (results not handed off, or expired to GridFS).
+
+    The handle is returned with the result, as a failed lookup of another request resets
+    result_handoff while this one is streamed."""
+
+    global result_handoff
+
+    store = result_handoff
+
+    try:
+
+        if store is None:
+            store = result_handoff = await run_in_threadpool(
+                ray.get_actor,
+                RESULT_HANDOFF_NAME,
+                namespace=RESULT_HANDOFF_NAMESPACE,
+            )
+
+        handoff = await run_in_threadpool(ray.get, store.get.remote(id))
+
+    except Exception:
+
+        # The store isn't running (yet), or died with the results it held.
+        result_handoff = None
+
+        return None
+
+    if handoff is None:
+        return None
+
+    return store, handoff["nbytes"], handoff["metadata"]
 
 
 @app.get("/result/{id}")
@@ -168,9 +496,80 @@ async def result(id: str) -> ResultModel:
         Iterator[ResultModel]: _description_
     """
 
+    handoff = await handoff_result(id)
+
+    if handoff is not None:
+
+        store, nbytes, metadata = handoff
+
+        async def stream_handoff():
+
+            start = 0
+
+            with metrics.DOWNLOAD.time(metadata.get("model_key")):
+
+                # Read a chunk at a time, so the API holds one chunk of each download
+                # rather than the whole result.
+                while start < nbytes:
+
+                    try:
+                        chunk = await run_in_threadpool(
+                            ray.get,
+                            store.read.remote(id, start, start + RESULT_CHUNK_BYTES),
+                        )
+                    except Exception:
+                        chunk = None
+
+                    if chunk is None:
+                        break
+
+                    yield chunk
+
+                    start += len(chunk)
+
+                # Expired to GridFS, or lost with the store, since the download started. The
+                # rest is read from GridFS, and if it isn't there the download is cut short.
+                if start < nbytes:
+
+                    gridout = await run_in_threadpool(
+                        ResultModel.load, db_connection, id, stream=True
+                    )
+
+                    if gridout is not None:
+
+                        with gridout:
+
+                            gridout.seek(start)
+
+                            while True:
+
+                                chunk = await run_in_threadpool(
+                                    gridout.read, RESULT_CHUNK_BYTES
+                                )
+
+                                if not chunk:
+                                    break
+
+                                yield chunk
+
+            store.delete.remote(id)
+            # In case the store expired it to GridFS while it was downloaded.
+            ResultModel.delete(db_connection, id, logger=logger)
+            ResponseModel.delete(db_connection, id, logger=logger)
+
+        return StreamingResponse(
+            content=stream_handoff(),
+            media_type="application/octet-stream",
+            headers={"Content-Length": str(nbytes)},
+        )
+
     # Get cursor to bytes stored in data backend.
     result: gridfs.GridOut = ResultModel.load(db_connection, id, stream=True)
 
+    # Already downloaded, expired or evicted.
+    if result is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Result not found")
+
     # Inform client the total size of result in bytes.
     headers = {
         "Content-Length": str(result.length),
@@ -178,8 +577,12 @@ async def result(id: str) -> ResultModel:
 
     async def stream_gridfs(gridout: gridfs.GridOut):
 
-        for chunk in gridout:
-            yield chunk
+        model_key = (gridout.metadata or {}).get("model_key")
+
+        with metrics.DOWNLOAD.time(model_key):
+
+            for chunk in gridout:
+                yield chunk
 
         ResultModel.delete(db_connection, id, logger=logger)
         ResponseModel.delete(db_connection, id, logger=logger)
@@ -214,15 +617,16 @@ async def status():
 
         if application_name.startswith("Model"):
 
-            deployment = application.deployments["ModelDeployment"]
-
             num_running_replicas = 0
 
-            for replica_status in deployment.replica_states:
+            # ModelDeployment, or MultiplexedModelDeployment for apps of several models.
+            for deployment in application.deployments.values():
+
+                for replica_status in deployment.replica_states:
 
-                if replica_status == "RUNNING":
+                    if replica_status == "RUNNING":
 
-                    num_running_replicas += 1
+                        num_running_replicas += 1
 
             if num_running_replicas > 0:
 
@@ -242,7 +646,21 @@ async def status():
     return response
 
 
-# FastAPIInstrumentor.instrument_app(app)
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Endpoint to scrape metrics in the Prometheus text format.
+
+    Returns:
+        Response: Metrics.
+    """
+
+    return Response(
+        content=metrics.generate_latest(), media_type=metrics.CONTENT_TYPE_LATEST
+    )
+
+
+if tracing.enabled():
+    FastAPIInstrumentor.instrument_app(app)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,13 @@
-# from opentelemetry import trace
-# from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-# from opentelemetry.sdk.resources import Resource
-# from opentelemetry.sdk.trace import TracerProvider
-# from opentelemetry.sdk.trace.export import BatchSpanProcessor
-# import os
+def post_fork(server, worker):
+    server.log.info("Worker spawned (pid: %s)", worker.pid)
 
-# def post_fork(server, worker):
-#     server.log.info("Worker spawned (pid: %s)", worker.pid)
+    from src.telemetry import tracing
 
-#     resource = Resource.create(attributes={
-#         "service.name": "api-service"
-#     })
+    tracing.init("api")
 
-#     trace.set_tracer_provider(TracerProvider(resource=resource))
-#     span_processor = BatchSpanProcessor(
-#         OTLPSpanExporter(endpoint=os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"))
-#     )
-#     trace.get_tracer_provider().add_span_processor(span_processor)
\ No newline at end of file
+
+def child_exit(server, worker):
+
+    from src.telemetry import metrics
+
+    metrics.mark_process_dead(worker.pid)
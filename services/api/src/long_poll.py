@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Set
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+from starlette.concurrency import run_in_threadpool
+
+from .schema import ResponseModel
+
+logger = logging.getLogger("gunicorn.error")
+
+
+class Waiter:
+    """One parked long-poll.
+
+    Attributes:
+        status (ResponseModel.JobStatus): Status the client has already seen. None until loaded.
+    """
+
+    def __init__(self) -> None:
+
+        self.event = asyncio.Event()
+        self.status: Optional[ResponseModel.JobStatus] = None
+
+    async def wait(self, timeout: float) -> bool:
+        """Returns whether the response changed before timeout seconds passed."""
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+
+class StatusWatcher:
+    """Wakes long-polls of /response/{id} when their response changes.
+
+    Changes are fed by one Mongo change stream over the responses collection per API worker,
+    read in a background thread, so parked requests cost no queries while they wait. Mongo
+    only supports change streams on replica sets; against a standalone Mongo, the watcher
+    instead checks the statuses of all waited-on responses in one query every poll_interval
+    seconds.
+
+    Attributes:
+        client (MongoClient): Connection to the database holding responses.
+        poll_interval (float): Seconds between checks when change streams are not available.
+    """
+
+    def __init__(self, client: MongoClient, poll_interval: float = 1.0) -> None:
+
+        self.client = client
+        self.poll_interval = poll_interval
+
+        self._waiters: Dict[str, Set[Waiter]] = {}
+
+        self._loop: asyncio.AbstractEventLoop = None
+        self._stream = None
+        self._stopped = threading.Event()
+        self._poll_task: asyncio.Task = None
+
+    @property
+    def collection(self):
+
+        return self.client["ndif_database"]["responses"]
+
+    def register(self, id: str) -> Waiter:
+        """Parks a waiter on id. Register before loading the response so no change is missed."""
+
+        waiter = Waiter()
+
+        self._waiters.setdefault(id, set()).add(waiter)
+
+        return waiter
+
+    def unregister(self, id: str, waiter: Waiter) -> None:
+
+        waiters = self._waiters.get(id)
+
+        if waiters is not None:
+
+            waiters.discard(waiter)
+
+            if not waiters:
+                del self._waiters[id]
+
+    def notify(self, id: str) -> None:
+        """Wakes every waiter on id. Must be called on the event loop."""
+
+        for waiter in self._waiters.get(id, ()):
+            waiter.event.set()
+
+    def notify_all(self) -> None:
+
+        for id in list(self._waiters):
+            self.notify(id)
+
+    def _watch(self) -> None:
+
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "replace", "update"]}}},
+            {"$project": {"documentKey": 1}},
+        ]
+
+        while not self._stopped.is_set():
+
+            try:
+
+                with self.collection.watch(pipeline) as stream:
+
+                    self._stream = stream
+
+                    # Changes may have been missed while (re)connecting.
+                    self._loop.call_soon_threadsafe(self.notify_all)
+
+                    for change in stream:
+                        self._loop.call_soon_threadsafe(
+                            self.notify, str(change["documentKey"]["_id"])
+                        )
+
+            except OperationFailure as exception:
+
+                if self._stopped.is_set():
+                    return
+
+                # Not a replica set.
+                logger.warning(
+                    f"Change streams unavailable, polling response statuses instead: {exception}"
+                )
+
+                self._loop.call_soon_threadsafe(self._start_polling)
+
+                return
+
+            except PyMongoError as exception:
+
+                if self._stopped.is_set():
+                    return
+
+                logger.warning(
+                    f"Response change stream failed, reconnecting: {exception}"
+                )
+
+                self._stopped.wait(self.poll_interval)
+
+    def _statuses(self, ids: List[str]) -> Dict[str, ResponseModel.JobStatus]:
+
+        return {
+            str(doc["_id"]): ResponseModel.JobStatus(doc["status"])
+            for doc in self.collection.find(
+                {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"status": True}
+            )
+        }
+
+    def _start_polling(self) -> None:
+
+        self._poll_task = asyncio.create_task(self._poll())
+
+    async def _poll(self) -> None:
+
+        while True:
+
+            await asyncio.sleep(self.poll_interval)
+
+            waiting = {
+                id: waiters
+                for id, waiters in self._waiters.items()
+                if any(waiter.status is not None for waiter in waiters)
+            }
+
+            if not waiting:
+                continue
+
+            try:
+                statuses = await run_in_threadpool(self._statuses, list(waiting))
+            except PyMongoError as exception:
+                logger.warning(f"Failed to poll response statuses: {exception}")
+                continue
+
+            for id, waiters in waiting.items():
+
+                status = statuses.get(id)
+
+                for waiter in waiters:
+
+                    if waiter.status is not None and waiter.status != status:
+                        waiter.event.set()
+
+    async def start(self) -> None:
+
+        self._loop = asyncio.get_running_loop()
+
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    async def stop(self) -> None:
+
+        self._stopped.set()
+
+        if self._stream is not None:
+            self._stream.close()
+
+        if self._poll_task is not None:
+            self._poll_task.cancel()
@@ -0,0 +1,355 @@
+import abc
+import math
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+from pydantic import BaseModel
+from pymongo import MongoClient, ReturnDocument
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from .schema.Usage import UsageModel
+from .util import SingleFlight
+
+
+class Limits(BaseModel):
+    """Limits of one API key. None means unlimited.
+
+    Attributes:
+        rate (float): Requests per second the token bucket refills at.
+        burst (float): Capacity of the token bucket. Defaults to rate.
+        gpu_seconds_per_day (float): GPU-seconds of execution per UTC day.
+        max_execution_seconds (float): Longest one request may execute for. Enforced by the
+            model replicas.
+    """
+
+    rate: Optional[float] = None
+    burst: Optional[float] = None
+    gpu_seconds_per_day: Optional[float] = None
+    max_execution_seconds: Optional[float] = None
+
+    @property
+    def capacity(self) -> float:
+
+        return max(1, self.burst if self.burst is not None else self.rate)
+
+
+class LimitStore(abc.ABC):
+    """Shared state of the rate limiter. Methods are blocking and run in a threadpool."""
+
+    @abc.abstractmethod
+    def take(self, key_id: str, limits: Limits, count: int) -> Tuple[int, float]:
+        """Refills the key's token bucket and takes up to count tokens from it.
+
+        Returns:
+            Tuple[int, float]: Tokens taken and tokens left in the bucket.
+        """
+
+    @abc.abstractmethod
+    def limits(self, key_id: str) -> Optional[Dict]:
+        """Fields overriding the default limits for the key, if any."""
+
+    @abc.abstractmethod
+    def usage(self, key_id: str) -> float:
+        """GPU-seconds used by the key today."""
+
+
+class MongoLimitStore(LimitStore):
+    """Keeps token buckets in `ndif_database.rate_limits` and per-key overrides in
+    `ndif_database.limits`, shared by all API workers. Usage is recorded by the model
+    deployments in `ndif_database.usage`."""
+
+    def __init__(self, client: MongoClient) -> None:
+
+        self.client = client
+
+        self._indexed = False
+
+    @property
+    def buckets(self):
+
+        return self.client["ndif_database"]["rate_limits"]
+
+    def take(self, key_id: str, limits: Limits, count: int) -> Tuple[int, float]:
+
+        if not self._indexed:
+
+            # Idle buckets are full again after burst / rate seconds, no need to keep them.
+            self.buckets.create_index("updated", expireAfterSeconds=3600)
+
+            self._indexed = True
+
+        now = datetime.utcnow()
+
+        elapsed_seconds = {
+            "$divide": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, 1000]
+        }
+
+        # Refill and take in one atomic update so concurrent workers never overdraw the bucket.
+        doc = self.buckets.find_one_and_update(
+            {"_id": key_id},
+            [
+                {
+                    "$set": {
+                        "tokens": {
+                            "$min": [
+                                limits.capacity,
+                                {
+                                    "$add": [
+                                        {"$ifNull": ["$tokens", limits.capacity]},
+                                        {"$multiply": [elapsed_seconds, limits.rate]},
+                                    ]
+                                },
+                            ]
+                        },
+                        "updated": now,
+                    }
+                },
+                {"$set": {"taken": {"$min": [count, {"$floor": "$tokens"}]}}},
+                {"$set": {"tokens": {"$subtract": ["$tokens", "$taken"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        return int(doc["taken"]), doc["tokens"]
+
+    def limits(self, key_id: str) -> Optional[Dict]:
+
+        return self.client["ndif_database"]["limits"].find_one(
+            {"_id": key_id}, {"_id": False}
+        )
+
+    def usage(self, key_id: str) -> float:
+
+        return UsageModel.load(self.client, key_id).gpu_seconds
+
+
+class LocalLimitStore(LimitStore):
+    """Stand-in store for a single API worker without Mongo. Knows no usage, so GPU-second
+    quotas are not enforced."""
+
+    def __init__(self) -> None:
+
+        self._buckets: Dict[str, Tuple[float, datetime]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key_id: str, limits: Limits, count: int) -> Tuple[int, float]:
+
+        now = datetime.utcnow()
+
+        with self._lock:
+
+            tokens, updated = self._buckets.get(key_id, (limits.capacity, now))
+
+            tokens = min(
+                limits.capacity,
+                tokens + (now - updated).total_seconds() * limits.rate,
+            )
+
+            taken = min(count, math.floor(tokens))
+
+            self._buckets[key_id] = (tokens - taken, now)
+
+        return taken, tokens - taken
+
+    def limits(self, key_id: str) -> Optional[Dict]:
+
+        return None
+
+    def usage(self, key_id: str) -> float:
+
+        return 0.0
+
+
+class RateLimiter:
+    """Enforces per-key token-bucket rate limits and daily GPU-second quotas.
+
+    Checks are answered from in-process state whenever possible. Instead of taking one token
+    per request from the shared bucket, a worker leases a batch of tokens and spends them
+    locally; leased tokens expire after lease_ttl seconds so an idle worker does not hold on
+    to them. Usage and per-key overrides are cached for usage_ttl and limits_ttl seconds, so a
+    quota can be overrun by up to usage_ttl seconds worth of requests.
+
+    Attributes:
+        store (LimitStore): Shared state.
+        default_limits (Limits): Limits of keys without overrides.
+        lease_ttl (float): Seconds leased tokens are valid for.
+        usage_ttl (float): Seconds to cache usage.
+        limits_ttl (float): Seconds to cache per-key overrides.
+    """
+
+    def __init__(
+        self,
+        store: LimitStore,
+        default_limits: Limits,
+        lease_ttl: float = 1,
+        usage_ttl: float = 5,
+        limits_ttl: float = 60,
+        maxsize: int = 65536,
+    ) -> None:
+
+        self.store = store
+        self.default_limits = default_limits
+        self.lease_ttl = lease_ttl
+
+        self._tokens = TTLCache(maxsize=maxsize, ttl=lease_ttl)
+        self._usage = TTLCache(maxsize=maxsize, ttl=usage_ttl)
+        self._limits = TTLCache(maxsize=maxsize, ttl=limits_ttl)
+        self._lock = threading.Lock()
+
+        self._single_flight = SingleFlight()
+
+    def _get_limits(self, key_id: str) -> Limits:
+
+        overrides = self.store.limits(key_id)
+
+        if not overrides:
+            return self.default_limits
+
+        return self.default_limits.model_copy(update=overrides)
+
+    async def limits(self, key_id: str) -> Limits:
+
+        limits = self._limits.get(key_id)
+
+        if limits is None:
+
+            limits = await self._single_flight.run(
+                ("limits", key_id), self._get_limits, key_id
+            )
+
+            self._limits[key_id] = limits
+
+        return limits
+
+    async def usage(self, key_id: str) -> float:
+
+        usage = self._usage.get(key_id)
+
+        if usage is None:
+
+            usage = await self._single_flight.run(
+                ("usage", key_id), self.store.usage, key_id
+            )
+
+            self._usage[key_id] = usage
+
+        return usage
+
+    def _take_local(self, key_id: str) -> bool:
+
+        with self._lock:
+
+            tokens = self._tokens.get(key_id, 0)
+
+            if tokens <= 0:
+                return False
+
+            self._tokens[key_id] = tokens - 1
+
+        return True
+
+    def _lease(self, key_id: str, limits: Limits) -> float:
+
+        # About what one worker spends within a lease at the full rate.
+        count = max(
+            1, min(math.floor(limits.capacity), int(limits.rate * self.lease_ttl))
+        )
+
+        taken, tokens = self.store.take(key_id, limits, count)
+
+        if taken > 0:
+
+            with self._lock:
+                self._tokens[key_id] = self._tokens.get(key_id, 0) + taken
+
+        return tokens
+
+    async def check(self, api_key: str) -> None:
+        """Spends one request of the key's limits.
+
+        Raises:
+            HTTPException: 429 with a Retry-After header if a limit is exceeded.
+        """
+
+        key_id = UsageModel.key_id_from_api_key(api_key)
+
+        limits = await self.limits(key_id)
+
+        if limits.gpu_seconds_per_day is not None:
+
+            if await self.usage(key_id) >= limits.gpu_seconds_per_day:
+
+                now = datetime.utcnow()
+                midnight = datetime.combine(
+                    now.date() + timedelta(days=1), datetime.min.time()
+                )
+
+                raise HTTPException(
+                    status_code=HTTP_429_TOO_MANY_REQUESTS,
+                    detail=f"Daily quota of {limits.gpu_seconds_per_day} GPU-seconds exceeded",
+                    headers={
+                        "Retry-After": str(math.ceil((midnight - now).total_seconds()))
+                    },
+                )
+
+        if limits.rate is None:
+            return
+
+        while not self._take_local(key_id):
+
+            # Concurrent checks for the key wait on one lease and then compete for its tokens.
+            tokens = await self._single_flight.run(
+                ("tokens", key_id), self._lease, key_id, limits
+            )
+
+            # The shared bucket still has tokens, lease again if others took this lease.
+            if tokens >= 1:
+                continue
+
+            if self._take_local(key_id):
+                return
+
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Rate limit of {limits.rate} requests per second exceeded",
+                headers={
+                    "Retry-After": str(max(1, math.ceil((1 - tokens) / limits.rate)))
+                },
+            )
+
+
+def _limit_from_env(name: str) -> Optional[float]:
+
+    value = os.environ.get(name)
+
+    return None if value is None else float(value)
+
+
+DEFAULT_LIMITS = Limits(
+    rate=_limit_from_env("RATE_LIMIT_PER_SECOND"),
+    burst=_limit_from_env("RATE_LIMIT_BURST"),
+    gpu_seconds_per_day=_limit_from_env("GPU_SECONDS_PER_DAY"),
+    max_execution_seconds=_limit_from_env("MAX_EXECUTION_SECONDS"),
+)
+
+rate_limiter: Optional[RateLimiter] = None
+
+if (
+    DEFAULT_LIMITS.rate is not None
+    or DEFAULT_LIMITS.gpu_seconds_per_day is not None
+    or DEFAULT_LIMITS.max_execution_seconds is not None
+):
+
+    rate_limiter = RateLimiter(
+        (
+            MongoLimitStore(MongoClient(os.environ["DATABASE_URL"]))
+            if "DATABASE_URL" in os.environ
+            else LocalLimitStore()
+        ),
+        DEFAULT_LIMITS,
+    )
@@ -0,0 +1,172 @@
+import asyncio
+from typing import Optional
+
+import socketio
+from bidict import ValueDuplicationError
+
+from .telemetry import metrics
+
+try:
+    import aio_pika
+except:
+    pass
+
+# Between the host id of the worker a session is connected to and the rest of its sid.
+SEPARATOR = "."
+
+
+def session_owner(sid: str) -> Optional[str]:
+    """Host id of the worker holding a session, from its sid, or None for sids this manager
+    didn't issue (and rooms)."""
+
+    host_id, separator, _ = sid.partition(SEPARATOR)
+
+    if not separator or len(host_id) != 32:
+        return None
+
+    return host_id
+
+
+class AffinityAioPikaManager(socketio.AsyncAioPikaManager):
+    """Socket.IO client manager sending emits to a session only to the API worker holding it.
+
+    AsyncAioPikaManager publishes every emit to a fanout exchange, which every worker reads,
+    although only one holds the session. Here the sid is the registry of which worker that
+    is: sids are issued as "{host_id}.{id}", and each worker's queue is also bound to a
+    direct exchange by its host id. An emit to a session of this worker is sent to its
+    socket without RabbitMQ, to a session of another worker is published to that worker's
+    queue only, and otherwise (sids of other managers, rooms, callbacks, disconnects) is
+    broadcast as before.
+    """
+
+    name = "asyncaiopika-affinity"
+
+    def __init__(self, *args, **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+
+        self.publisher_direct_connection = None
+        self.publisher_direct_exchange = None
+
+    @property
+    def direct_channel(self) -> str:
+
+        return f"{self.channel}.direct"
+
+    async def connect(self, eio_sid, namespace):
+
+        sid = f"{self.host_id}{SEPARATOR}{self.server.eio.generate_id()}"
+
+        # As BaseManager.connect, with the sid naming this worker.
+        try:
+            self.basic_enter_room(sid, namespace, None, eio_sid=eio_sid)
+        except ValueDuplicationError:
+            return None
+
+        self.basic_enter_room(sid, namespace, sid, eio_sid=eio_sid)
+
+        return sid
+
+    async def emit(
+        self,
+        event,
+        data,
+        namespace=None,
+        room=None,
+        skip_sid=None,
+        callback=None,
+        to=None,
+        **kwargs,
+    ):
+
+        room = to or room
+        # AsyncPubSubManager only defaults it when publishing.
+        namespace = namespace or "/"
+
+        if (
+            not kwargs.get("ignore_queue")
+            and callback is None
+            and isinstance(room, str)
+            and self.is_connected(room, namespace)
+        ):
+
+            metrics.SOCKETIO_EMITS.inc("local")
+
+            kwargs["ignore_queue"] = True
+
+        return await super().emit(
+            event,
+            data,
+            namespace=namespace,
+            room=room,
+            skip_sid=skip_sid,
+            callback=callback,
+            **kwargs,
+        )
+
+    async def _direct_exchange(self, channel):
+
+        return await channel.declare_exchange(
+            self.direct_channel, aio_pika.ExchangeType.DIRECT
+        )
+
+    async def _queue(self, channel, exchange):
+
+        queue = await super()._queue(channel, exchange)
+
+        await queue.bind(await self._direct_exchange(channel), routing_key=self.host_id)
+
+        return queue
+
+    async def _publish(self, data):
+
+        if data.get("method") != "emit":
+            return await super()._publish(data)
+
+        owner = None
+
+        if data.get("callback") is None and isinstance(data.get("room"), str):
+            owner = session_owner(data["room"])
+
+        if owner is None:
+
+            metrics.SOCKETIO_EMITS.inc("broadcast")
+
+            return await super()._publish(data)
+
+        metrics.SOCKETIO_EMITS.inc("direct")
+
+        if self.publisher_direct_exchange is None:
+
+            async with self._lock:
+
+                if self.publisher_direct_exchange is None:
+
+                    self.publisher_direct_connection = await self._connection()
+
+                    self.publisher_direct_exchange = await self._direct_exchange(
+                        await self._channel(self.publisher_direct_connection)
+                    )
+
+        try:
+
+            await self.publisher_direct_exchange.publish(
+                aio_pika.Message(
+                    body=self.json.dumps(data).encode(),
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=owner,
+            )
+
+        except aio_pika.exceptions.ChannelInvalidStateError:
+            # As AsyncAioPikaManager, aio_pika raises this when the task is cancelled.
+            raise asyncio.CancelledError()
+
+        except Exception as exception:
+
+            self._get_logger().error(
+                f"Cannot publish to the worker of `{data['room']}`, broadcasting: "
+                f"{exception}"
+            )
+
+            await super()._publish(data)
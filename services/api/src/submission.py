@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Set
+
+from ray import serve
+from ray.serve.handle import DeploymentHandle
+
+from .schema import RequestModel
+from .telemetry import metrics
+
+logger = logging.getLogger("gunicorn.error")
+
+
+class SubmissionRejected(Exception):
+    """Raised when the submitter has max_in_flight requests in flight for longer than it
+    waits for a slot."""
+
+
+class Submitter:
+    """Sends requests to the Request app in batches, from one background task per API worker.
+
+    The app handle is looked up once and cached until a submission fails. Requests submitted
+    within batch_wait_seconds of each other go out in one call to the app's batch method,
+    up to max_batch of them, so bursts cost few Ray client round trips. The call is
+    awaited, so failures on the Ray side (the app being unavailable, its replica dying)
+    reach on_error for every request of the batch instead of being dropped.
+
+    Attributes:
+        on_error (Callable[[RequestModel, Exception], Awaitable[None]]): Called for each
+            request of a batch that failed.
+        max_in_flight (int): Most requests waiting for or in a call to the Request app.
+        max_batch (int): Most requests per call.
+        batch_wait_seconds (float): How long the first request of a batch waits for others.
+        slot_wait_seconds (float): How long a submission waits for a slot before it is rejected.
+    """
+
+    def __init__(
+        self,
+        on_error: Callable[[RequestModel, Exception], Awaitable[None]],
+        max_in_flight: int = 1024,
+        max_batch: int = 32,
+        batch_wait_seconds: float = 0.005,
+        slot_wait_seconds: float = 1.0,
+    ) -> None:
+
+        self.on_error = on_error
+        self.max_in_flight = max_in_flight
+        self.max_batch = max_batch
+        self.batch_wait_seconds = batch_wait_seconds
+        self.slot_wait_seconds = slot_wait_seconds
+
+        self._handle: Optional[DeploymentHandle] = None
+        self._queue: asyncio.Queue = None
+        self._slots: asyncio.Semaphore = None
+        self._task: asyncio.Task = None
+        self._sends: Set[asyncio.Task] = set()
+
+    @property
+    def handle(self) -> DeploymentHandle:
+
+        if self._handle is None:
+            self._handle = serve.get_app_handle("Request")
+
+        return self._handle
+
+    async def start(self) -> None:
+
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+
+        if self._task is not None:
+
+            self._task.cancel()
+
+            # Let batches already sent finish, so their errors are still reported.
+            await asyncio.gather(*self._sends, return_exceptions=True)
+
+    async def submit(self, request: RequestModel) -> None:
+        """Queues the request for the next batch.
+
+        Raises:
+            SubmissionRejected: If no slot frees up within slot_wait_seconds.
+        """
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.slot_wait_seconds)
+        except asyncio.TimeoutError:
+
+            metrics.SUBMISSIONS.inc("rejected")
+
+            raise SubmissionRejected(
+                f"The server is at capacity with {self.max_in_flight} requests being "
+                "submitted. Please try again later."
+            )
+
+        self._queue.put_nowait(request)
+
+    async def run(self) -> None:
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+
+            batch = [await self._queue.get()]
+
+            deadline = loop.time() + self.batch_wait_seconds
+
+            while len(batch) < self.max_batch:
+
+                timeout = deadline - loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            send = asyncio.create_task(self.send(batch))
+
+            self._sends.add(send)
+            send.add_done_callback(self._sends.discard)
+
+    async def send(self, batch: List[RequestModel]) -> None:
+
+        try:
+
+            with metrics.SUBMIT.time():
+                await self.handle.batch.remote(batch)
+
+            metrics.SUBMISSIONS.inc("submitted", len(batch))
+
+        except Exception as exception:
+
+            logger.exception(f"Failed to submit {len(batch)} requests: {exception}")
+
+            metrics.SUBMISSIONS.inc("failed", len(batch))
+
+            # Look the app up again, in case it was redeployed.
+            self._handle = None
+
+            for request in batch:
+
+                try:
+                    await self.on_error(request, exception)
+                except Exception:
+                    logger.exception(f"Failed to report error of `{request.id}`")
+
+        finally:
+
+            for _ in batch:
+                self._slots.release()
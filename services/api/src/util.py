@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Callable, Dict, Hashable
+
+from starlette.concurrency import run_in_threadpool
+
+
+class SingleFlight:
+    """Runs blocking calls in a threadpool, deduplicating concurrent calls by key.
+
+    While a call for a key is in flight, other callers for that key await its result instead of
+    making their own call.
+    """
+
+    def __init__(self) -> None:
+
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, fn: Callable, *args: Any) -> Any:
+
+        future = self._inflight.get(key)
+
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+
+        self._inflight[key] = future
+
+        try:
+
+            result = await run_in_threadpool(fn, *args)
+
+        except Exception as exception:
+
+            future.set_exception(exception)
+
+            # Retrieve the exception so it is not reported as never retrieved when no one waits.
+            future.exception()
+
+            raise
+
+        else:
+
+            future.set_result(result)
+
+        finally:
+
+            del self._inflight[key]
+
+        return result
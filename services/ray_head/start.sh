@@ -2,13 +2,20 @@
 
 resources=`python -m src.ray.resources --head`
 
+# Pack replicas onto the fullest node that fits them, leaving whole GPUs free for large models.
+export RAY_scheduler_spread_threshold=1.0
+
+# CUDA indices match NVML's, which topology discovery reads NVLink peers from.
+export CUDA_DEVICE_ORDER=PCI_BUS_ID
+
 ray start --head \
     --resources="$resources" \
     --port=6379 \
     --object-manager-port=8076 \
     --include-dashboard=true \
     --dashboard-host=0.0.0.0 \
-    --dashboard-port=8265
+    --dashboard-port=8265 \
+    --metrics-export-port=8080
 
 serve deploy src/ray/config/ray_config.yml
 
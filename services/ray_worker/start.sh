@@ -2,4 +2,10 @@
 
 resources=`python -m src.ray.resources`
 
-ray start --resources "$resources" --address $RAY_ADDRESS --block
\ No newline at end of file
+# Pack replicas onto the fullest node that fits them, leaving whole GPUs free for large models.
+export RAY_scheduler_spread_threshold=1.0
+
+# CUDA indices match NVML's, which topology discovery reads NVLink peers from.
+export CUDA_DEVICE_ORDER=PCI_BUS_ID
+
+ray start --resources "$resources" --address $RAY_ADDRESS --metrics-export-port=8080 --block
\ No newline at end of file
@@ -0,0 +1,468 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+import ray
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except:
+    pass
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+TIME_BUCKETS = [
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+]
+
+BYTE_BUCKETS = [
+    1e3,
+    1e4,
+    1e5,
+    1e6,
+    1e7,
+    1e8,
+    5e8,
+    1e9,
+    5e9,
+    1e10,
+]
+
+
+def in_ray_worker() -> bool:
+    """Whether this process is a Ray worker (actor/replica) rather than a driver or Ray client.
+
+    Metrics recorded inside Ray workers are exported by the node's Ray metrics agent,
+    everywhere else they are kept in the prometheus_client registry and exposed on /metrics.
+    """
+
+    return (
+        ray.is_initialized()
+        and ray.get_runtime_context().worker.mode == ray.WORKER_MODE
+    )
+
+
+class Histogram:
+    """Histogram labeled by model key.
+
+    The backing metric is created lazily on first use, so module level histograms can be
+    imported by both the API and the Ray deployments and bind to the correct exporter. It is
+    created under a lock, as prometheus_client rejects a second metric of the same name.
+
+    Attributes:
+        name (str): Metric name.
+        description (str): Metric description.
+        buckets (List[float]): Bucket boundaries.
+    """
+
+    def __init__(self, name: str, description: str, buckets: List[float]) -> None:
+
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+        self._histogram = None
+        self._ray = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+
+        if self._histogram is not None:
+            return self._histogram
+
+        with self._lock:
+
+            if self._histogram is not None:
+                return self._histogram
+
+            self._ray = in_ray_worker()
+
+            if self._ray:
+
+                from ray.util.metrics import Histogram as RayHistogram
+
+                self._histogram = RayHistogram(
+                    self.name,
+                    description=self.description,
+                    boundaries=self.buckets,
+                    tag_keys=("model_key",),
+                )
+
+            else:
+
+                try:
+                    self._histogram = prometheus_client.Histogram(
+                        self.name,
+                        self.description,
+                        ["model_key"],
+                        buckets=self.buckets,
+                    )
+                # prometheus_client is not installed, observations are dropped.
+                except NameError:
+                    self._histogram = False
+
+            return self._histogram
+
+    def observe(self, value: float, model_key: str = None) -> None:
+
+        histogram = self._get()
+
+        if histogram is False:
+            return
+
+        model_key = model_key or "unknown"
+
+        if self._ray:
+            histogram.observe(value, tags={"model_key": model_key})
+        else:
+            histogram.labels(model_key=model_key).observe(value)
+
+    @contextmanager
+    def time(self, model_key: str = None) -> Iterator["Timer"]:
+
+        timer = Timer()
+
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.perf_counter() - timer.start
+
+            self.observe(timer.elapsed, model_key=model_key)
+
+
+class Timer:
+    """Yielded by Histogram.time. elapsed is set on exit."""
+
+    def __init__(self) -> None:
+
+        self.start = time.perf_counter()
+        self.elapsed: float = None
+
+
+class LabeledMetric:
+    """Gauge or counter with a single label, created lazily like Histogram.
+
+    Attributes:
+        name (str): Metric name.
+        description (str): Metric description.
+        label (str): Label name.
+    """
+
+    # Class name in both ray.util.metrics and prometheus_client.
+    metric_type: str = None
+
+    def __init__(self, name: str, description: str, label: str) -> None:
+
+        self.name = name
+        self.description = description
+        self.label = label
+
+        self._metric = None
+        self._ray = None
+        self._lock = threading.Lock()
+
+    def _prometheus_kwargs(self) -> Dict[str, Any]:
+        """Keyword arguments of the prometheus_client metric, beyond its name, description
+        and label."""
+
+        return {}
+
+    def _get(self):
+
+        if self._metric is not None:
+            return self._metric
+
+        with self._lock:
+
+            if self._metric is not None:
+                return self._metric
+
+            self._ray = in_ray_worker()
+
+            if self._ray:
+
+                import ray.util.metrics
+
+                self._metric = getattr(ray.util.metrics, self.metric_type)(
+                    self.name, description=self.description, tag_keys=(self.label,)
+                )
+
+            else:
+
+                try:
+                    self._metric = getattr(prometheus_client, self.metric_type)(
+                        self.name,
+                        self.description,
+                        [self.label],
+                        **self._prometheus_kwargs(),
+                    )
+                # prometheus_client is not installed, updates are dropped.
+                except NameError:
+                    self._metric = False
+
+            return self._metric
+
+
+class Gauge(LabeledMetric):
+    """Gauge with a single label.
+
+    Attributes:
+        multiprocess_mode (str): How the values of gunicorn workers are combined when
+            PROMETHEUS_MULTIPROC_DIR is set, one of prometheus_client's (e.g. livesum,
+            mostrecent). Ray workers export their own series.
+    """
+
+    metric_type = "Gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label: str,
+        multiprocess_mode: str = "livesum",
+    ) -> None:
+
+        super().__init__(name, description, label)
+
+        self.multiprocess_mode = multiprocess_mode
+
+    def _prometheus_kwargs(self) -> Dict[str, Any]:
+
+        return {"multiprocess_mode": self.multiprocess_mode}
+
+    def set(self, value: float, label_value: str) -> None:
+
+        gauge = self._get()
+
+        if gauge is False:
+            return
+
+        if self._ray:
+            gauge.set(value, tags={self.label: label_value})
+        else:
+            gauge.labels(label_value).set(value)
+
+
+class Counter(LabeledMetric):
+
+    metric_type = "Counter"
+
+    def inc(self, label_value: str, value: float = 1) -> None:
+
+        counter = self._get()
+
+        if counter is False:
+            return
+
+        if self._ray:
+            counter.inc(value, tags={self.label: label_value})
+        else:
+            counter.labels(label_value).inc(value)
+
+
+REQUEST_STAGE = Histogram(
+    "ndif_request_stage_seconds",
+    "Time to stream a binary request into the staging store.",
+    TIME_BUCKETS,
+)
+REQUEST_BYTES = Histogram(
+    "ndif_request_bytes",
+    "Size of binary requests in bytes, as submitted.",
+    BYTE_BUCKETS,
+)
+SUBMIT = Histogram(
+    "ndif_submit_seconds",
+    "Time for the Request app to take a batch of requests from the API.",
+    TIME_BUCKETS,
+)
+SUBMISSIONS = Counter(
+    "ndif_submissions",
+    "Requests the API sent to the Request app, by outcome: submitted, rejected (too many in "
+    "flight) and failed (the Request app raised).",
+    "outcome",
+)
+QUEUE_WAIT = Histogram(
+    "ndif_queue_wait_seconds",
+    "Time from the API receiving a request to a model replica starting it.",
+    TIME_BUCKETS,
+)
+DISPATCH = Histogram(
+    "ndif_dispatch_seconds",
+    "Time from the API receiving a request to the Request app dispatching it to a model.",
+    TIME_BUCKETS,
+)
+DESERIALIZE = Histogram(
+    "ndif_deserialize_seconds",
+    "Time to deserialize a request against the model.",
+    TIME_BUCKETS,
+)
+EXECUTE = Histogram(
+    "ndif_execute_seconds",
+    "Time to execute a request on the model.",
+    TIME_BUCKETS,
+)
+POSTPROCESS = Histogram(
+    "ndif_postprocess_seconds",
+    "Time to postprocess the saved values of an executed request.",
+    TIME_BUCKETS,
+)
+RESULT_SERIALIZE = Histogram(
+    "ndif_result_serialize_seconds",
+    "Time to serialize a result with torch.save.",
+    TIME_BUCKETS,
+)
+RESULT_WRITE = Histogram(
+    "ndif_result_write_seconds",
+    "Time to write a serialized result to GridFS.",
+    TIME_BUCKETS,
+)
+RESULT_BYTES = Histogram(
+    "ndif_result_bytes",
+    "Size of serialized results in bytes.",
+    BYTE_BUCKETS,
+)
+RESPONSE_SAVE = Histogram(
+    "ndif_response_save_seconds",
+    "Time to save a response document to Mongo.",
+    TIME_BUCKETS,
+)
+NOTIFY = Histogram(
+    "ndif_notify_seconds",
+    "Time for the blocking_response call notifying the API of a status change.",
+    TIME_BUCKETS,
+)
+MODEL_LOAD = Histogram(
+    "ndif_model_load_seconds",
+    "Time for a multiplexed replica to bring a model onto its device, including offloads.",
+    TIME_BUCKETS,
+)
+MODEL_OFFLOAD = Histogram(
+    "ndif_model_offload_seconds",
+    "Time for a multiplexed replica to demote a model to host memory or disk.",
+    TIME_BUCKETS,
+)
+RESULT_WRITER_WAIT = Histogram(
+    "ndif_result_writer_wait_seconds",
+    "Time a model replica waited for room in its result writer before its next job.",
+    TIME_BUCKETS,
+)
+WARMUP = Histogram(
+    "ndif_warmup_seconds",
+    "Latency of the synthetic requests a new model replica runs before taking real ones, "
+    "once warm.",
+    TIME_BUCKETS,
+)
+DOWNLOAD = Histogram(
+    "ndif_download_seconds",
+    "Time to stream a result to the client.",
+    TIME_BUCKETS,
+)
+
+BATCH_SEQUENCES = Gauge(
+    "ndif_batch_sequences",
+    "Sequences in the continuous batch of a model replica.",
+    "model_key",
+    multiprocess_mode="livesum",
+)
+GENERATED_TOKENS = Counter(
+    "ndif_generated_tokens",
+    "Tokens decoded by continuous batching, per model.",
+    "model_key",
+)
+
+SAVE_TRANSFER = Counter(
+    "ndif_save_transfer_bytes",
+    "Bytes of saved values copied to the host during execution, by destination: pinned "
+    "(host memory) or spilled (disk).",
+    "destination",
+)
+
+JOBS_STOPPED = Counter(
+    "ndif_jobs_stopped",
+    "Jobs stopped before they finished, by reason: CANCELLED (by their user) or TIMEOUT "
+    "(out of execution time).",
+    "reason",
+)
+RESULT_HANDOFF = Counter(
+    "ndif_result_handoff",
+    "Results through the object store handoff: stored, rejected (store full), served "
+    "(downloaded from it) and persisted (expired to GridFS).",
+    "outcome",
+)
+
+SOCKETIO_EMITS = Counter(
+    "ndif_socketio_emits",
+    "Socket.IO emits of an API worker, by route: local (to a session it holds), direct (to "
+    "the queue of the worker holding the session) and broadcast (to every worker).",
+    "route",
+)
+
+STORAGE_BYTES = Gauge(
+    "ndif_storage_bytes",
+    "Bytes of data (excluding indexes) stored per collection.",
+    "collection",
+    # Every process reads the same collections, so the latest value is right (as below).
+    multiprocess_mode="mostrecent",
+)
+STORAGE_INDEX_BYTES = Gauge(
+    "ndif_storage_index_bytes",
+    "Bytes of indexes per collection.",
+    "collection",
+    multiprocess_mode="mostrecent",
+)
+STORAGE_DOCUMENTS = Gauge(
+    "ndif_storage_documents",
+    "Documents per collection.",
+    "collection",
+    multiprocess_mode="mostrecent",
+)
+STORAGE_SWEPT = Counter(
+    "ndif_storage_swept",
+    "Results, responses and chunks removed by the storage sweeper, by reason.",
+    "reason",
+)
+
+
+def generate_latest() -> bytes:
+    """Renders the prometheus_client metrics of this process, or of all gunicorn workers when
+    PROMETHEUS_MULTIPROC_DIR is set.
+
+    Returns:
+        bytes: Metrics in the Prometheus text exposition format.
+    """
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    else:
+
+        registry = prometheus_client.REGISTRY
+
+    return prometheus_client.generate_latest(registry)
+
+
+def mark_process_dead(pid: int) -> None:
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,169 @@
+import os
+from contextlib import contextmanager
+from importlib import import_module
+from typing import Any, Dict, Iterator
+
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import (
+        BatchSpanProcessor,
+        ConsoleSpanExporter,
+        SimpleSpanProcessor,
+        SpanExporter,
+    )
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+except:
+    pass
+
+# Exporter used when none is passed to `init`. One of:
+#   otlp                  OTLP over gRPC to OTEL_EXPORTER_OTLP_ENDPOINT.
+#   console               JSON spans on stdout.
+#   file:<path>           One JSON span per line appended to <path>.
+#   memory                Kept in `MEMORY_EXPORTER`, for local inspection.
+#   <module>:<attribute>  Import path of a SpanExporter class or factory.
+TRACE_EXPORTER = os.environ.get("NDIF_TRACE_EXPORTER", None)
+
+MEMORY_EXPORTER = None
+
+_initialized = False
+
+
+def _get_exporter(exporter: str) -> "SpanExporter":
+
+    global MEMORY_EXPORTER
+
+    if exporter == "otlp":
+
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        return OTLPSpanExporter(endpoint=os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"))
+
+    if exporter == "console":
+
+        return ConsoleSpanExporter()
+
+    if exporter == "memory":
+
+        if MEMORY_EXPORTER is None:
+            MEMORY_EXPORTER = InMemorySpanExporter()
+
+        return MEMORY_EXPORTER
+
+    if exporter.startswith("file:"):
+
+        return ConsoleSpanExporter(
+            out=open(exporter[len("file:") :], "a"),
+            formatter=lambda span: span.to_json(indent=None) + os.linesep,
+        )
+
+    module_path, attribute = exporter.split(":", 1)
+
+    return getattr(import_module(module_path), attribute)()
+
+
+def init(service_name: str, exporter: str = None, **attributes: Any) -> bool:
+    """Sets the global tracer provider of this process. Does nothing if no exporter is configured,
+    OpenTelemetry is not installed or tracing was already initialized.
+
+    Args:
+        service_name (str): Value of the `service.name` resource attribute.
+        exporter (str, optional): Exporter spec, see `TRACE_EXPORTER`. Defaults to NDIF_TRACE_EXPORTER.
+        attributes (Any): Additional resource attributes.
+
+    Returns:
+        bool: If tracing is enabled.
+    """
+
+    global _initialized
+
+    exporter = exporter or TRACE_EXPORTER
+
+    if _initialized or exporter is None:
+        return _initialized
+
+    try:
+        resource = Resource.create(
+            attributes={"service.name": service_name, **attributes}
+        )
+    except NameError:
+        return False
+
+    span_exporter = _get_exporter(exporter)
+
+    # Spans kept in memory should be visible as soon as they end.
+    processor = (
+        SimpleSpanProcessor(span_exporter)
+        if isinstance(span_exporter, InMemorySpanExporter)
+        else BatchSpanProcessor(span_exporter)
+    )
+
+    provider = TracerProvider(resource=resource)
+    provider.add_span_processor(processor)
+
+    trace.set_tracer_provider(provider)
+
+    _initialized = True
+
+    return _initialized
+
+
+def enabled() -> bool:
+
+    return _initialized
+
+
+def inject(request) -> None:
+    """Stores the current trace context in `request.trace_context` so it travels with the request
+    to the next stage.
+    """
+
+    if not _initialized:
+        return
+
+    carrier: Dict[str, str] = {}
+
+    propagate.inject(carrier)
+
+    request.trace_context = carrier
+
+
+@contextmanager
+def span(name: str, request=None, **attributes: Any) -> Iterator[Any]:
+    """Opens a span as a child of the current span.
+
+    When `request` is given, the span is instead parented to the trace context the request
+    carries, and is tagged with the request id. Use this at the entry of each stage.
+
+    Args:
+        name (str): Span name.
+        request (RequestModel, optional): Request whose trace to continue. Defaults to None.
+        attributes (Any): Span attributes.
+
+    Yields:
+        Span: Span, or None if tracing is not enabled.
+    """
+
+    if not _initialized:
+        yield None
+        return
+
+    context = None
+
+    if request is not None:
+
+        context = propagate.extract(request.trace_context or {})
+
+        attributes["ndif.request_id"] = request.id
+
+    attributes = {key: value for key, value in attributes.items() if value is not None}
+
+    with trace.get_tracer("ndif").start_as_current_span(
+        name, context=context, attributes=attributes
+    ) as _span:
+        yield _span